@@ -0,0 +1,47 @@
+-- Latest Features per Entity {FraudFinder}
+-- One row per customer / terminal holding the features of its most recent transaction,
+-- kept current by merge_latest_features.sql. Clustered on the id so the online
+-- processor's lookup is a keyed point read instead of a window over 15 days of history.
+
+CREATE TABLE IF NOT EXISTS tx.customer_latest_features (
+  customer_id STRING NOT NULL,
+  feature_ts TIMESTAMP NOT NULL,
+  customer_id_nb_tx_15min_window INT64,
+  customer_id_nb_tx_30min_window INT64,
+  customer_id_nb_tx_60min_window INT64,
+  customer_id_nb_tx_1day_window INT64,
+  customer_id_nb_tx_7day_window INT64,
+  customer_id_nb_tx_14day_window INT64,
+  customer_id_avg_amount_15min_window FLOAT64,
+  customer_id_avg_amount_30min_window FLOAT64,
+  customer_id_avg_amount_60min_window FLOAT64,
+  customer_id_avg_amount_1day_window FLOAT64,
+  customer_id_avg_amount_7day_window FLOAT64,
+  customer_id_avg_amount_14day_window FLOAT64
+)
+CLUSTER BY customer_id;
+
+CREATE TABLE IF NOT EXISTS tx.terminal_latest_features (
+  terminal_id STRING NOT NULL,
+  feature_ts TIMESTAMP NOT NULL,
+  terminal_id_nb_tx_15min_window INT64,
+  terminal_id_nb_tx_30min_window INT64,
+  terminal_id_nb_tx_60min_window INT64,
+  terminal_id_nb_tx_1day_window INT64,
+  terminal_id_nb_tx_7day_window INT64,
+  terminal_id_nb_tx_14day_window INT64,
+  terminal_id_risk_15min_window FLOAT64,
+  terminal_id_risk_30min_window FLOAT64,
+  terminal_id_risk_60min_window FLOAT64,
+  terminal_id_risk_1day_window FLOAT64,
+  terminal_id_risk_7day_window FLOAT64,
+  terminal_id_risk_14day_window FLOAT64
+)
+CLUSTER BY terminal_id;
+
+-- TX_TS up to which tx.tx has been merged into the latest feature tables
+CREATE TABLE IF NOT EXISTS tx.latest_features_watermark (
+  name STRING NOT NULL,
+  watermark TIMESTAMP NOT NULL,
+  updated_at TIMESTAMP NOT NULL
+);
@@ -0,0 +1,155 @@
+-- Incremental Maintenance of the Latest Feature Tables {FraudFinder}
+-- Run after latest_feature_tables.sql, then on a schedule (e.g. a BigQuery scheduled query every minute).
+--
+-- Only customers and terminals with transactions since the last watermark are recomputed:
+-- new rows are read from the tx.tx partitions at or after the watermark, and the features
+-- come from the C2 views filtered on those ids, so both paths share one definition.
+-- Transactions that land in tx.tx late, with TX_TS up to an hour before the watermark, are
+-- caught by re-scanning that hour on every run; re-merging an entity whose latest row is
+-- unchanged is harmless. A transaction later than that, and labels that arrive for older
+-- transactions, are picked up on the entity's next transaction;
+-- delete the watermark row to rebuild everything from the last 15 days.
+
+DECLARE watermark TIMESTAMP DEFAULT (
+  SELECT
+    IFNULL(MAX(watermark), TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 15 DAY))
+  FROM
+    tx.latest_features_watermark
+  WHERE
+    name = 'latest_features'
+);
+-- Start of the overlap re-scanned for late transactions
+DECLARE rescan_from TIMESTAMP DEFAULT TIMESTAMP_SUB(watermark, INTERVAL 1 HOUR);
+DECLARE new_watermark TIMESTAMP DEFAULT (
+  SELECT
+    MAX(TX_TS)
+  FROM
+    tx.tx
+  WHERE
+    DATE(TX_TS) >= DATE(watermark)
+    AND TX_TS > watermark
+    AND TX_TS <= CURRENT_TIMESTAMP()
+);
+
+IF new_watermark IS NOT NULL THEN
+
+  CREATE TEMP TABLE new_tx AS
+  SELECT DISTINCT
+    CUSTOMER_ID,
+    TERMINAL_ID
+  FROM
+    tx.tx
+  WHERE
+    DATE(TX_TS) >= DATE(rescan_from)
+    AND TX_TS > rescan_from
+    AND TX_TS <= new_watermark;
+
+  BEGIN TRANSACTION;
+
+  -- Customer features of each customer's latest transaction --------------------------------------------------------------------------
+  MERGE tx.customer_latest_features T
+  USING (
+    SELECT
+      *
+    FROM
+      tx.customer_spending_features
+    WHERE
+      customer_id IN (SELECT CUSTOMER_ID FROM new_tx)
+      AND feature_ts <= new_watermark
+    QUALIFY
+      ROW_NUMBER() OVER (PARTITION BY customer_id ORDER BY feature_ts DESC) = 1
+  ) S
+  ON T.customer_id = S.customer_id
+  WHEN MATCHED AND S.feature_ts >= T.feature_ts THEN
+    UPDATE SET
+      feature_ts = S.feature_ts,
+      customer_id_nb_tx_15min_window = S.customer_id_nb_tx_15min_window,
+      customer_id_nb_tx_30min_window = S.customer_id_nb_tx_30min_window,
+      customer_id_nb_tx_60min_window = S.customer_id_nb_tx_60min_window,
+      customer_id_nb_tx_1day_window = S.customer_id_nb_tx_1day_window,
+      customer_id_nb_tx_7day_window = S.customer_id_nb_tx_7day_window,
+      customer_id_nb_tx_14day_window = S.customer_id_nb_tx_14day_window,
+      customer_id_avg_amount_15min_window = S.customer_id_avg_amount_15min_window,
+      customer_id_avg_amount_30min_window = S.customer_id_avg_amount_30min_window,
+      customer_id_avg_amount_60min_window = S.customer_id_avg_amount_60min_window,
+      customer_id_avg_amount_1day_window = S.customer_id_avg_amount_1day_window,
+      customer_id_avg_amount_7day_window = S.customer_id_avg_amount_7day_window,
+      customer_id_avg_amount_14day_window = S.customer_id_avg_amount_14day_window
+  WHEN NOT MATCHED THEN
+    INSERT (
+      customer_id, feature_ts,
+      customer_id_nb_tx_15min_window, customer_id_nb_tx_30min_window, customer_id_nb_tx_60min_window,
+      customer_id_nb_tx_1day_window, customer_id_nb_tx_7day_window, customer_id_nb_tx_14day_window,
+      customer_id_avg_amount_15min_window, customer_id_avg_amount_30min_window, customer_id_avg_amount_60min_window,
+      customer_id_avg_amount_1day_window, customer_id_avg_amount_7day_window, customer_id_avg_amount_14day_window
+    )
+    VALUES (
+      S.customer_id, S.feature_ts,
+      S.customer_id_nb_tx_15min_window, S.customer_id_nb_tx_30min_window, S.customer_id_nb_tx_60min_window,
+      S.customer_id_nb_tx_1day_window, S.customer_id_nb_tx_7day_window, S.customer_id_nb_tx_14day_window,
+      S.customer_id_avg_amount_15min_window, S.customer_id_avg_amount_30min_window, S.customer_id_avg_amount_60min_window,
+      S.customer_id_avg_amount_1day_window, S.customer_id_avg_amount_7day_window, S.customer_id_avg_amount_14day_window
+    );
+
+  -- Terminal risk features of each terminal's latest transaction ---------------------------------------------------------------------
+  MERGE tx.terminal_latest_features T
+  USING (
+    SELECT
+      *
+    FROM
+      tx.terminal_risk_features
+    WHERE
+      terminal_id IN (SELECT TERMINAL_ID FROM new_tx)
+      AND feature_ts <= new_watermark
+    QUALIFY
+      ROW_NUMBER() OVER (PARTITION BY terminal_id ORDER BY feature_ts DESC) = 1
+  ) S
+  ON T.terminal_id = S.terminal_id
+  WHEN MATCHED AND S.feature_ts >= T.feature_ts THEN
+    UPDATE SET
+      feature_ts = S.feature_ts,
+      terminal_id_nb_tx_15min_window = S.terminal_id_nb_tx_15min_window,
+      terminal_id_nb_tx_30min_window = S.terminal_id_nb_tx_30min_window,
+      terminal_id_nb_tx_60min_window = S.terminal_id_nb_tx_60min_window,
+      terminal_id_nb_tx_1day_window = S.terminal_id_nb_tx_1day_window,
+      terminal_id_nb_tx_7day_window = S.terminal_id_nb_tx_7day_window,
+      terminal_id_nb_tx_14day_window = S.terminal_id_nb_tx_14day_window,
+      terminal_id_risk_15min_window = S.terminal_id_risk_15min_window,
+      terminal_id_risk_30min_window = S.terminal_id_risk_30min_window,
+      terminal_id_risk_60min_window = S.terminal_id_risk_60min_window,
+      terminal_id_risk_1day_window = S.terminal_id_risk_1day_window,
+      terminal_id_risk_7day_window = S.terminal_id_risk_7day_window,
+      terminal_id_risk_14day_window = S.terminal_id_risk_14day_window
+  WHEN NOT MATCHED THEN
+    INSERT (
+      terminal_id, feature_ts,
+      terminal_id_nb_tx_15min_window, terminal_id_nb_tx_30min_window, terminal_id_nb_tx_60min_window,
+      terminal_id_nb_tx_1day_window, terminal_id_nb_tx_7day_window, terminal_id_nb_tx_14day_window,
+      terminal_id_risk_15min_window, terminal_id_risk_30min_window, terminal_id_risk_60min_window,
+      terminal_id_risk_1day_window, terminal_id_risk_7day_window, terminal_id_risk_14day_window
+    )
+    VALUES (
+      S.terminal_id, S.feature_ts,
+      S.terminal_id_nb_tx_15min_window, S.terminal_id_nb_tx_30min_window, S.terminal_id_nb_tx_60min_window,
+      S.terminal_id_nb_tx_1day_window, S.terminal_id_nb_tx_7day_window, S.terminal_id_nb_tx_14day_window,
+      S.terminal_id_risk_15min_window, S.terminal_id_risk_30min_window, S.terminal_id_risk_60min_window,
+      S.terminal_id_risk_1day_window, S.terminal_id_risk_7day_window, S.terminal_id_risk_14day_window
+    );
+
+  -- The views only look back 15 days; an entity without a transaction since then has no features ----------------------------------
+  DELETE FROM tx.customer_latest_features
+  WHERE feature_ts < TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 15 DAY);
+  DELETE FROM tx.terminal_latest_features
+  WHERE feature_ts < TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 15 DAY);
+
+  MERGE tx.latest_features_watermark W
+  USING (SELECT 'latest_features' AS name, new_watermark AS watermark) S
+  ON W.name = S.name
+  WHEN MATCHED THEN
+    UPDATE SET watermark = S.watermark, updated_at = CURRENT_TIMESTAMP()
+  WHEN NOT MATCHED THEN
+    INSERT (name, watermark, updated_at) VALUES (S.name, S.watermark, CURRENT_TIMESTAMP());
+
+  COMMIT TRANSACTION;
+
+END IF;
@@ -0,0 +1,49 @@
+--export the trained models as artifacts for local scoring (C4 local_model.py)
+--save each result as JSON, e.g. with bq query --format=json, and wrap it as shown
+
+--logistic regression: {"model_type": "logistic_reg", "weights": [<rows>], "feature_info": [<rows>]}
+--feature_info holds the training means BQML substitutes for NULL inputs
+SELECT
+  processed_input,
+  weight
+FROM
+  ML.WEIGHTS(MODEL `tx.fraud_detection_logreg`);
+
+SELECT
+  input,
+  mean
+FROM
+  ML.FEATURE_INFO(MODEL `tx.fraud_detection_logreg`);
+
+--xgboost: {"model_type": "boosted_tree_classifier", "feature_names": [...], "trees": [<dump>]}
+--feature_names come from assets/model_metadata.json of the export, the trees from
+--xgboost.Booster(model_file="model.bst").get_dump(dump_format="json")
+EXPORT MODEL `tx.fraud_detection_xgboost`
+OPTIONS(URI = 'gs://{BUCKET_NAME}/models/fraud_detection_xgboost');
+
+--kmeans: {"model_type": "kmeans", "centroids": [<rows>], "feature_info": [<rows>], "distance_threshold": <value>}
+SELECT
+  centroid_id,
+  feature,
+  numerical_value
+FROM
+  ML.CENTROIDS(MODEL `tx.fraud_detection_kmeans`, STRUCT(TRUE AS standardize));
+
+SELECT
+  input,
+  mean,
+  stddev
+FROM
+  ML.FEATURE_INFO(MODEL `tx.fraud_detection_kmeans`);
+
+--distance to the nearest centroid that 2% of the training data exceeds (contamination 0.02)
+SELECT
+  APPROX_QUANTILES((
+    SELECT MIN(d.DISTANCE) FROM UNNEST(NEAREST_CENTROIDS_DISTANCE) d), 100)[OFFSET(98)] AS distance_threshold
+FROM
+  ML.PREDICT(MODEL `tx.fraud_detection_kmeans`,
+    (
+    SELECT
+      *
+    FROM
+      tx.train_data));
@@ -0,0 +1,156 @@
+# AIMD concurrency limit with backpressure for the asyncio pipeline
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class AdaptiveConcurrencyController:
+    """
+    Limits how many messages AsyncFraudPipeline processes at once and adapts
+    the limit with additive increase / multiplicative decrease:
+
+    - after every window of about `limit` completed messages, the limit grows
+      by `increase` if the window was healthy, and is multiplied by
+      `decrease_factor` if its mean latency exceeded target_latency_ms or its
+      error rate exceeded max_error_rate
+    - the endpoint running slower than endpoint_latency_ms (exponentially
+      weighted) counts as unhealthy, so a struggling Vertex AI endpoint gets
+      less traffic even while messages still succeed
+    - while the prediction writer holds more than writer_high_watermark rows,
+      no new message starts and the window counts as unhealthy
+
+    Pub/Sub flow control cannot change on a running subscription, so the
+    subscriber is opened with max_limit and messages above the current limit
+    wait here, with their leases extended by the client library.
+
+    All methods except `limit`/`stats` must be called on the event loop
+    """
+
+    def __init__(self, initial_limit=8, min_limit=1, max_limit=64, target_latency_ms=500.0, max_error_rate=0.05,
+                 increase=1.0, decrease_factor=0.7, endpoint_latency_ms=None, prediction_writer=None,
+                 writer_high_watermark=None):
+        """
+        Args:
+            initial_limit, min_limit, max_limit: bounds of the concurrency limit
+            target_latency_ms: mean message latency above which the limit shrinks
+            max_error_rate: share of failed messages above which the limit shrinks
+            increase: added to the limit after a healthy window
+            decrease_factor: multiplies the limit after an unhealthy window
+            endpoint_latency_ms: predict latency above which the limit shrinks (None ignores it)
+            prediction_writer: PredictionWriter whose queue depth is watched
+            writer_high_watermark: queued rows above which intake pauses (None ignores the writer)
+        """
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency_ms / 1000.0
+        self.max_error_rate = max_error_rate
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.endpoint_latency = endpoint_latency_ms / 1000.0 if endpoint_latency_ms else None
+        self.prediction_writer = prediction_writer
+        self.writer_high_watermark = writer_high_watermark
+
+        self._limit = float(max(min_limit, min(max_limit, initial_limit)))
+        self._in_flight = 0
+        self._condition = None
+        self._window_count = 0
+        self._window_errors = 0
+        self._window_seconds = 0.0
+        self._endpoint_ewma = None
+        self._increases = 0
+        self._decreases = 0
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def writer_behind(self):
+        if self.prediction_writer is None or self.writer_high_watermark is None:
+            return False
+        return self.prediction_writer.queue_depth > self.writer_high_watermark
+
+    async def acquire(self):
+        """Wait for a slot under the current limit (and for the writer to catch up)"""
+        condition = self._get_condition()
+        async with condition:
+            while self._in_flight >= self.limit or self.writer_behind():
+                try:
+                    # The writer drains on its own thread; poll it while waiting
+                    await asyncio.wait_for(condition.wait(), timeout=0.05)
+                except asyncio.TimeoutError:
+                    pass
+            self._in_flight += 1
+
+    async def release(self, seconds, ok):
+        """
+        Free a slot and record how the message went
+        Args:
+            seconds: processing time of the message
+            ok: False if the message was nacked
+        """
+        condition = self._get_condition()
+        async with condition:
+            self._in_flight -= 1
+            self._window_count += 1
+            self._window_seconds += seconds
+            if not ok:
+                self._window_errors += 1
+            if self._window_count >= max(1, self.limit):
+                self._adjust()
+            condition.notify_all()
+
+    def observe_endpoint(self, seconds):
+        """Record the latency of one predict call"""
+        if self._endpoint_ewma is None:
+            self._endpoint_ewma = seconds
+        else:
+            self._endpoint_ewma += 0.2 * (seconds - self._endpoint_ewma)
+
+    async def wait_idle(self):
+        """Wait until no message is in flight"""
+        condition = self._get_condition()
+        async with condition:
+            await condition.wait_for(lambda: self._in_flight == 0)
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'in_flight': self._in_flight,
+            'increases': self._increases,
+            'decreases': self._decreases,
+            'endpoint_latency_ms': None if self._endpoint_ewma is None else round(self._endpoint_ewma * 1000, 1),
+        }
+
+    def _adjust(self):
+        mean_latency = self._window_seconds / self._window_count
+        error_rate = self._window_errors / self._window_count
+        endpoint_slow = (self.endpoint_latency is not None and self._endpoint_ewma is not None
+                         and self._endpoint_ewma > self.endpoint_latency)
+        writer_behind = self.writer_behind()
+
+        previous = self.limit
+        if mean_latency > self.target_latency or error_rate > self.max_error_rate or endpoint_slow or writer_behind:
+            self._limit = max(float(self.min_limit), self._limit * self.decrease_factor)
+            self._decreases += 1
+        else:
+            self._limit = min(float(self.max_limit), self._limit + self.increase)
+            self._increases += 1
+        if self.limit != previous:
+            logger.debug("Concurrency limit %d -> %d (latency %.0f ms, errors %.1f%%, endpoint slow %s, "
+                         "writer behind %s)", previous, self.limit, mean_latency * 1000, error_rate * 100,
+                         endpoint_slow, writer_behind)
+
+        self._window_count = 0
+        self._window_errors = 0
+        self._window_seconds = 0.0
+
+    def _get_condition(self):
+        # Created lazily so it binds to the pipeline's event loop
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
@@ -0,0 +1,228 @@
+# asyncio-based concurrent processing engine for FraudDetectionProcessor
+import asyncio
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from deadline import DeadlineExceeded
+from transaction_record import TransactionRecord
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncFraudPipeline:
+    """
+    Processes many Pub/Sub messages concurrently on an asyncio event loop.
+
+    The BigQuery and Vertex AI clients are blocking, so each remote call runs
+    in a thread pool and the loop only coordinates. Up to max_in_flight
+    messages are processed at once; within a message the customer and
+    terminal feature lookups run concurrently, and feature fetch, prediction
+    and persistence of different messages overlap.
+
+    With an AdaptiveConcurrencyController the number of messages in flight
+    follows the controller's limit instead, capped at its max_limit
+    """
+
+    def __init__(self, processor, max_in_flight=32, max_workers=None, concurrency=None):
+        self.processor = processor
+        self.concurrency = concurrency
+        self.max_in_flight = concurrency.max_limit if concurrency is not None else max_in_flight
+        # Each message can have two feature queries in flight at once, twice
+        # over while hedged, and abandoned lookups keep their threads until
+        # they return
+        if max_workers is None:
+            max_workers = 2 * self.max_in_flight
+            if processor.hedger is not None:
+                max_workers = 2 * (2 * self.max_in_flight + processor.hedger.max_abandoned)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix="fraud-io"
+        )
+        self._loop = asyncio.new_event_loop()
+        self._semaphore = None
+        self._thread = threading.Thread(target=self._run_loop, name="fraud-event-loop", daemon=True)
+        self._started = threading.Event()
+
+    def start_loop(self):
+        """Start the event loop thread (idempotent)"""
+        if not self._thread.is_alive():
+            self._thread.start()
+            self._started.wait()
+
+    def close(self):
+        """Stop the event loop once in-flight messages are done"""
+        if self._thread.is_alive():
+            asyncio.run_coroutine_threadsafe(self._drain(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+        self._executor.shutdown(wait=True)
+
+    def submit(self, message):
+        """
+        Schedule a message on the event loop; used as the Pub/Sub subscriber
+        callback, so it returns immediately
+        """
+        return asyncio.run_coroutine_threadsafe(self.handle_message(message), self._loop)
+
+    async def handle_message(self, message):
+        """Process one message once an in-flight slot is free"""
+        if self.concurrency is None:
+            async with self._semaphore:
+                await self.process_message(message)
+            return
+
+        await self.concurrency.acquire()
+        start = time.perf_counter()
+        ok = False
+        try:
+            ok = await self.process_message(message)
+        finally:
+            await self.concurrency.release(time.perf_counter() - start, ok)
+
+    async def process_message(self, message):
+        """
+        Async counterpart of FraudDetectionProcessor.process_message
+        Args:
+            message: Pub/Sub message
+        Returns:
+            bool: False if the message was nacked
+        """
+        processor = self.processor
+        try:
+            metrics = processor.metrics
+            with metrics.stage("decode"):
+                message_data = TransactionRecord.from_json(message.data)
+
+            done, prediction_data = processor.check_redelivery(message_data, message)
+            if done:
+                return True
+
+            if prediction_data is None:
+                deadline = processor.new_deadline()
+                with metrics.stage("features"):
+                    features, degraded = await self.get_features_within(message_data, deadline)
+
+                with metrics.stage("predict"):
+                    if processor.local_model is not None:
+                        # In-process scoring is CPU-bound and fast; no need to leave the loop
+                        probabilities, model_version = processor.predict([features])
+                    else:
+                        predict_start = time.perf_counter()
+                        probabilities, model_version = await self.predict_within([features], deadline)
+                        if self.concurrency is not None:
+                            self.concurrency.observe_endpoint(time.perf_counter() - predict_start)
+                if degraded:
+                    model_version = processor.degraded_model_version(model_version)
+                else:
+                    processor.score_shadows([message_data], [features], probabilities, model_version)
+
+                prediction_data = {
+                    'TX_ID': message_data.tx_id,
+                    'TX_TS': message_data.tx_ts,
+                    'fraud_probability': probabilities[0],
+                    'model_version': model_version
+                }
+                processor.remember_prediction(prediction_data)
+            # Acks now, or from the prediction writer once the row is flushed
+            await self._run(processor.persist_prediction, prediction_data, message)
+            logger.info("Successfully processed transaction %s", message_data.tx_id,
+                        extra={'tx_id': message_data.tx_id})
+            return True
+
+        except Exception as e:
+            logger.exception("Error processing message: %s; message data: %s", e, message.data)
+            message.nack()
+            return False
+
+    async def get_features(self, transaction_data):
+        """
+        Build the feature vector, looking up the customer and terminal halves
+        concurrently (and only the halves the feature cache cannot serve)
+        """
+        processor = self.processor
+        if processor.window_features is not None:
+            return processor.window_features.get_features(transaction_data)
+        if processor.feature_store is not None:
+            return processor.feature_store.get_features(transaction_data)
+
+        customer_features = terminal_features = None
+        if processor.feature_cache is not None:
+            customer_features = processor.feature_cache.get_customer(
+                transaction_data['CUSTOMER_ID'], transaction_data['TX_TS'])
+            terminal_features = processor.feature_cache.get_terminal(
+                transaction_data['TERMINAL_ID'], transaction_data['TX_TS'])
+
+        lookups = []
+        if customer_features is None:
+            lookups.append(self._run(processor.get_customer_features, transaction_data))
+        if terminal_features is None:
+            lookups.append(self._run(processor.get_terminal_features, transaction_data))
+        results = iter(await asyncio.gather(*lookups))
+        if customer_features is None:
+            customer_features = next(results)
+        if terminal_features is None:
+            terminal_features = next(results)
+
+        features = {'tx_amount': float(transaction_data['TX_AMOUNT'])}
+        features.update(customer_features)
+        features.update(terminal_features)
+        return features
+
+    async def get_features_within(self, transaction_data, deadline):
+        """Async counterpart of FraudDetectionProcessor.get_features_within"""
+        processor = self.processor
+        step = processor.feature_step(deadline)
+        if step is None:
+            return await self.get_features(transaction_data), False
+        hedge_after, timeout = step
+        try:
+            # The whole concurrent lookup is hedged, not the serial processor.get_features
+            features = await processor.hedger.call_async(
+                "features", lambda: self.get_features(transaction_data), hedge_after, timeout)
+            return features, False
+        except DeadlineExceeded:
+            logger.warning("Feature lookup of transaction %s ran out of budget; using fallback features",
+                           transaction_data['TX_ID'], extra={'tx_id': transaction_data['TX_ID']})
+            processor.metrics.degraded.inc("features")
+            return processor.fallback_features(transaction_data), True
+
+    async def predict_within(self, features_list, deadline):
+        """Async counterpart of FraudDetectionProcessor.predict_within"""
+        processor = self.processor
+        step = processor.predict_step(deadline)
+        if step is None:
+            return await self._run(processor.predict, features_list)
+        hedge_after, timeout = step
+        try:
+            return await processor.hedger.call_async(
+                "predict", lambda: self._run(processor.predict, features_list), hedge_after, timeout)
+        except DeadlineExceeded:
+            logger.warning("Prediction ran out of budget; scoring with the fallback model")
+            return processor.fallback_predict(features_list)
+
+    async def _run(self, func, *args, **kwargs):
+        """Run a blocking client call in the I/O thread pool"""
+        return await self._loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def _drain(self):
+        if self.concurrency is not None:
+            await self.concurrency.wait_idle()
+        else:
+            # Every slot free means nothing is in flight
+            for _ in range(self.max_in_flight):
+                await self._semaphore.acquire()
+            for _ in range(self.max_in_flight):
+                self._semaphore.release()
+        # Calls abandoned by a hedge or a spent budget may still be running
+        leftovers = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        if leftovers:
+            await asyncio.wait(leftovers)
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        self._loop.call_soon(self._started.set)
+        self._loop.run_forever()
@@ -0,0 +1,349 @@
+# Batch re-scoring of historical transactions into online_fraud_prediction rows
+#
+#   python backfill.py tx_export/*.parquet --local-model model.json --score-from "2024-05-01"
+#   python backfill.py predict_data.csv --output predictions.parquet
+#
+# Input is a local Parquet or CSV export of either
+# - tx.tx (TX_ID, TX_TS, CUSTOMER_ID, TERMINAL_ID, TX_AMOUNT, optionally TX_FRAUD
+#   from tx.txlabels): features are computed by the same backends as the online
+#   processor. The default replays the transactions through StreamingWindowFeatures,
+#   so the export must be in TX_TS order and start 15 days before --score-from
+#   (earlier rows only fill the windows). --features offline computes them for the
+#   whole export at once with offline_features.py instead
+# - tx.predict_data: the feature columns are already there and are scored as is.
+#   It has no TX_ID, so its predictions can only go to a local --output file
+import argparse
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from google.cloud import bigquery
+
+import fraud_online_inference as inference
+from export_files import CHUNK_ROWS, expand_paths, read_chunks
+from log_setup import configure_logging
+from window_features import StreamingWindowFeatures
+
+logger = logging.getLogger(__name__)
+
+FEATURE_COLUMNS = ['tx_amount'] + inference.CUSTOMER_FEATURE_COLUMNS + inference.TERMINAL_FEATURE_COLUMNS
+TRANSACTION_COLUMNS = ['TX_ID', 'TX_TS', 'CUSTOMER_ID', 'TERMINAL_ID', 'TX_AMOUNT']
+
+# Transactions per feature query when the features come from BigQuery
+FEATURE_BATCH_SIZE = 1000
+# Instances per Vertex AI predict request, and requests in flight, when scoring on the endpoint
+ENDPOINT_BATCH_SIZE = 500
+ENDPOINT_CONCURRENCY = 8
+
+
+def offline_feature_chunks(paths, chunk_rows=CHUNK_ROWS):
+    """
+    Read the whole input, compute every transaction's features with the
+    vectorized offline_features engine (windows need all earlier rows), and
+    yield it back in chunks with the feature columns attached
+    """
+    from offline_features import transaction_features
+
+    transactions = pd.concat(read_chunks(paths, chunk_rows), ignore_index=True)
+    logger.info("Computing offline features for %d transactions", len(transactions))
+    transactions = pd.concat([transactions, transaction_features(transactions)], axis=1)
+    for start in range(0, len(transactions), chunk_rows):
+        yield transactions.iloc[start:start + chunk_rows]
+
+
+class BackfillScorer:
+    """
+    Runs the feature-plus-score steps of FraudDetectionProcessor over whole
+    chunks: features come from the processor's backend in one call per chunk,
+    a local model scores the chunk as one matrix, and the endpoint is called
+    with ENDPOINT_BATCH_SIZE instances per request, several requests at a time
+    """
+
+    def __init__(self, processor, score_from=None, score_until=None,
+                 endpoint_batch_size=ENDPOINT_BATCH_SIZE, endpoint_concurrency=ENDPOINT_CONCURRENCY):
+        """
+        Args:
+            processor: FraudDetectionProcessor providing the feature backend and model
+            score_from, score_until: only transactions with score_from <= TX_TS < score_until
+                are scored; earlier ones still fill the streaming windows
+            endpoint_batch_size: instances per predict request
+            endpoint_concurrency: predict requests (and BigQuery feature queries) in flight
+        """
+        self.processor = processor
+        self.score_from = pd.Timestamp(score_from, tz="UTC") if score_from is not None else None
+        self.score_until = pd.Timestamp(score_until, tz="UTC") if score_until is not None else None
+        self.endpoint_batch_size = endpoint_batch_size
+        self._executor = ThreadPoolExecutor(max_workers=endpoint_concurrency, thread_name_prefix="backfill-predict")
+
+    def close(self):
+        self._executor.shutdown()
+
+    def score_chunk(self, chunk):
+        """
+        Score one chunk of a tx.tx or tx.predict_data export
+        Args:
+            chunk: DataFrame
+        Returns:
+            DataFrame of online_fraud_prediction rows (may be empty)
+        """
+        chunk = chunk.rename(columns={'timestamp': 'TX_TS'})
+        chunk['TX_TS'] = pd.to_datetime(chunk['TX_TS'], utc=True)
+        chunk = chunk.sort_values('TX_TS', kind='stable').reset_index(drop=True)
+        in_range = np.ones(len(chunk), dtype=bool)
+        if self.score_from is not None:
+            in_range &= (chunk['TX_TS'] >= self.score_from).to_numpy()
+        if self.score_until is not None:
+            in_range &= (chunk['TX_TS'] < self.score_until).to_numpy()
+
+        if all(column in chunk.columns for column in FEATURE_COLUMNS):
+            # NULL features of the LEFT JOINs are sent as 0, like the online query does
+            features = chunk.loc[in_range, FEATURE_COLUMNS].astype(float).fillna(0.0)
+        else:
+            missing = [column for column in TRANSACTION_COLUMNS if column not in chunk.columns]
+            if missing:
+                raise ValueError(f"Input has neither the tx.predict_data feature columns nor {missing}")
+            features = self._compute_features(chunk, in_range)
+
+        scored = chunk[in_range]
+        if scored.empty:
+            return self.prediction_rows(scored, np.empty(0), None)
+        probabilities, model_version = self.score(features)
+        return self.prediction_rows(scored, probabilities, model_version)
+
+    def _compute_features(self, chunk, in_range):
+        """Feature vectors of the in-range transactions of a TX_TS-sorted chunk"""
+        columns = TRANSACTION_COLUMNS + (['TX_FRAUD'] if 'TX_FRAUD' in chunk.columns else [])
+        transactions = chunk[columns].copy()
+        # The string form sent on ff-tx; every feature backend accepts it
+        transactions['TX_TS'] = transactions['TX_TS'].dt.strftime('%Y-%m-%d %H:%M:%S UTC')
+        transactions['TX_AMOUNT'] = transactions['TX_AMOUNT'].astype(float)
+        if 'TX_FRAUD' in transactions.columns:
+            # NaN from CSV or a nullable Int64 column both mean "no label"
+            labels = transactions['TX_FRAUD']
+            transactions['TX_FRAUD'] = labels.astype(object).where(labels.notna(), None)
+        records = transactions.to_dict('records')
+
+        window_features = self.processor.window_features
+        if window_features is not None:
+            # Replay in TX_TS order, each transaction observed with its label just
+            # before its lookup, so the windows hold exactly the history up to it
+            features_list = []
+            for record, keep in zip(records, in_range):
+                label = record.get('TX_FRAUD')
+                window_features.observe(record, None if label is None else int(label))
+                if keep:
+                    features_list.append(window_features.get_features(record))
+            return pd.DataFrame(features_list, columns=FEATURE_COLUMNS)
+
+        scored_records = [record for record, keep in zip(records, in_range) if keep]
+        if self.processor.feature_store is not None:
+            return pd.DataFrame(self.processor.get_features_batch(scored_records), columns=FEATURE_COLUMNS)
+
+        # BigQuery backends: several multi-transaction queries at a time
+        batches = [scored_records[start:start + FEATURE_BATCH_SIZE]
+                   for start in range(0, len(scored_records), FEATURE_BATCH_SIZE)]
+        features_list = [features for batch in self._executor.map(self.processor.get_features_batch, batches)
+                         for features in batch]
+        return pd.DataFrame(features_list, columns=FEATURE_COLUMNS)
+
+    def score(self, features):
+        """
+        Args:
+            features: DataFrame of FEATURE_COLUMNS
+        Returns:
+            (array of fraud probabilities, model_version)
+        """
+        local_model = self.processor.local_model
+        if local_model is not None:
+            X = features.reindex(columns=local_model.feature_names).to_numpy(dtype=float)
+            return np.asarray(local_model.predict_proba(X), dtype=float), local_model.model_version
+
+        records = features.to_dict('records')
+        batches = [records[start:start + self.endpoint_batch_size]
+                   for start in range(0, len(records), self.endpoint_batch_size)]
+        results = list(self._executor.map(self.processor.predict, batches))
+        probabilities = np.concatenate([np.asarray(batch_probabilities, dtype=float)
+                                        for batch_probabilities, _ in results])
+        return probabilities, results[0][1]
+
+    @staticmethod
+    def prediction_rows(scored, probabilities, model_version, created_at=None):
+        """
+        online_fraud_prediction rows of a scored chunk, built column-wise
+        (see FraudDetectionProcessor.prediction_row)
+        Returns:
+            DataFrame with the columns of the BigQuery table
+        """
+        if created_at is None:
+            created_at = datetime.now(timezone.utc)
+        if 'TX_ID' in scored.columns:
+            tx_id = scored['TX_ID'].astype(str).to_numpy()
+        else:
+            # tx.predict_data has no TX_ID
+            tx_id = np.full(len(scored), None, dtype=object)
+        return pd.DataFrame({
+            'TX_ID': tx_id,
+            'prediction_timestamp': scored['TX_TS'].to_numpy(),
+            'fraud_probability': probabilities,
+            'is_fraud': probabilities > 0.5,
+            'model_version': model_version,
+            'created_at': pd.Timestamp(created_at),
+        })
+
+
+class FileSink:
+    """Appends prediction rows to a local Parquet or CSV file"""
+
+    def __init__(self, path):
+        if not path.endswith((".parquet", ".csv")):
+            raise ValueError(f"Unsupported output file {path}, expected .parquet or .csv")
+        self.path = path
+        self._writer = None
+        self._header = True
+
+    def write(self, rows):
+        if self.path.endswith(".csv"):
+            rows.to_csv(self.path, mode="w" if self._header else "a", header=self._header, index=False)
+            self._header = False
+            return
+        table = pa.Table.from_pandas(rows, preserve_index=False)
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.path, table.schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+class BigQuerySink:
+    """
+    Appends prediction rows to online_fraud_prediction with load jobs, one per
+    chunk, keeping up to max_pending jobs running. Load jobs are free and far
+    faster than streaming inserts for this volume
+    """
+
+    def __init__(self, bq_client, table, max_pending=4):
+        self.bq_client = bq_client
+        self.table = table
+        self.max_pending = max_pending
+        self._job_config = bigquery.LoadJobConfig(
+            schema=table.schema,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND
+        )
+        self._pending = []
+
+    def write(self, rows):
+        if rows['TX_ID'].isna().any():
+            # TX_ID keys the table (and the online path's redelivery handling)
+            raise ValueError("Rows without TX_ID (a tx.predict_data export) cannot be appended to "
+                             f"{self.table}; write them to a local --output file instead")
+        self._pending.append(self.bq_client.load_table_from_dataframe(rows, self.table, job_config=self._job_config))
+        while len(self._pending) >= self.max_pending:
+            self._pending.pop(0).result()
+
+    def close(self):
+        while self._pending:
+            self._pending.pop(0).result()
+
+
+def build_backfill_processor(args):
+    """FraudDetectionProcessor with the feature backend and model chosen on the command line"""
+    window_features = StreamingWindowFeatures() if args.features == "window" else None
+    feature_store = None
+    if args.features == "store":
+        from local_feature_store import LocalFeatureStore
+        feature_store = LocalFeatureStore(args.local_feature_store)
+    local_model = None
+    if args.local_model:
+        from local_model import load_model
+        local_model = load_model(args.local_model)
+    return inference.FraudDetectionProcessor(
+        project_id=inference.PROJECT_ID,
+        endpoint_id=inference.ENDPOINT_ID,
+        location=inference.LOCATION,
+        window_features=window_features,
+        local_model=local_model,
+        latest_feature_tables=args.features == "latest",
+        feature_store=feature_store
+    )
+
+
+def run_backfill(chunks, scorer, sink):
+    """
+    Score every chunk and write the rows to sink
+    Returns:
+        dict of rows read and written, and seconds taken
+    """
+    start = time.monotonic()
+    rows_read = rows_written = 0
+    for chunk in chunks:
+        rows = scorer.score_chunk(chunk)
+        if not rows.empty:
+            sink.write(rows)
+        rows_read += len(chunk)
+        rows_written += len(rows)
+        elapsed = time.monotonic() - start
+        logger.info("Read %d rows, wrote %d predictions (%.0f rows/s)", rows_read, rows_written,
+                    rows_read / elapsed if elapsed else 0.0)
+    sink.close()
+    return {'rows_read': rows_read, 'rows_written': rows_written, 'seconds': time.monotonic() - start}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Re-score historical transactions into online_fraud_prediction")
+    parser.add_argument("inputs", nargs="+", help="Parquet/CSV files, directories or glob patterns")
+    parser.add_argument("--output", default="",
+                        help="local .parquet/.csv file; empty appends to the online_fraud_prediction table")
+    parser.add_argument("--features", choices=["window", "offline", "view", "latest", "store"], default="window",
+                        help="feature backend for tx.tx exports: streaming windows replayed from the export, "
+                             "the vectorized offline engine over the whole export, the C2 views, "
+                             "the latest-feature tables or a local feature store")
+    parser.add_argument("--local-feature-store", default="", help="SQLite file for --features store")
+    parser.add_argument("--local-model", default=inference.LOCAL_MODEL_PATH,
+                        help="local model artifact (see local_model.py); empty uses the endpoint")
+    parser.add_argument("--score-from", default=None, help="first TX_TS to score (earlier rows only fill windows)")
+    parser.add_argument("--score-until", default=None, help="TX_TS to stop scoring at (exclusive)")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    parser.add_argument("--endpoint-batch-size", type=int, default=ENDPOINT_BATCH_SIZE)
+    parser.add_argument("--endpoint-concurrency", type=int, default=ENDPOINT_CONCURRENCY)
+    parser.add_argument("--log-level", default=inference.LOG_LEVEL)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    background_logging = configure_logging(args.log_level, 1.0)
+    try:
+        if args.features == "store" and not args.local_feature_store:
+            raise ValueError("--features store needs --local-feature-store")
+        processor = build_backfill_processor(args)
+        if args.output:
+            sink = FileSink(args.output)
+        else:
+            inference.authenticate()
+            sink = BigQuerySink(processor.bq_client, processor.table)
+        scorer = BackfillScorer(processor, args.score_from, args.score_until,
+                                args.endpoint_batch_size, args.endpoint_concurrency)
+        try:
+            paths = expand_paths(args.inputs)
+            if args.features == "offline":
+                chunks = offline_feature_chunks(paths, args.chunk_rows)
+            else:
+                chunks = read_chunks(paths, args.chunk_rows)
+            results = run_backfill(chunks, scorer, sink)
+        finally:
+            scorer.close()
+        logger.info("Backfill done: %d rows read, %d predictions written in %.1f s",
+                    results['rows_read'], results['rows_written'], results['seconds'])
+    finally:
+        background_logging.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,566 @@
+# Offline benchmark for FraudDetectionProcessor against in-memory stand-ins
+# for Pub/Sub, BigQuery and Vertex AI. Needs no network or GCP credentials.
+#
+#   python benchmark.py --suite
+#   python benchmark.py --messages 5000 --max-in-flight 32 --bq-latency-ms 40 --bq-error-rate 0.01
+import argparse
+import functools
+import json
+import os
+import queue
+import random
+import resource
+import threading
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import fraud_online_inference as inference
+from feature_cache import FeatureCache
+from log_setup import configure_logging
+from prediction_writer import PredictionWriter
+from redelivery_index import RedeliveryIndex
+from sharded import ShardedSupervisor
+from window_features import StreamingWindowFeatures
+
+
+class FakeServiceError(Exception):
+    """Injected failure of a fake remote call"""
+
+
+class FakeService:
+    """
+    Latency and failure model shared by the fakes: every call sleeps
+    latency_ms plus an exponentially distributed tail with mean jitter_ms,
+    then fails with probability error_rate
+    """
+
+    def __init__(self, name, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, seed=None):
+        self.name = name
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+
+    def call(self):
+        with self._lock:
+            self.calls += 1
+            delay_ms = self.latency_ms
+            if self.jitter_ms > 0:
+                delay_ms += self._random.expovariate(1.0 / self.jitter_ms)
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        if delay_ms > 0:
+            time.sleep(delay_ms / 1000.0)
+        if failed:
+            raise FakeServiceError(f"Injected {self.name} failure")
+
+    def stats(self):
+        return {'calls': self.calls, 'errors': self.errors}
+
+
+class FakeField:
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeTable:
+    """Stands in for the online_fraud_prediction Table; only the schema is read"""
+
+    schema = [FakeField(name) for name in (
+        'TX_ID', 'prediction_timestamp', 'fraud_probability', 'is_fraud', 'model_version', 'created_at'
+    )]
+
+
+class FakeQueryJob:
+    def __init__(self, service, rows):
+        self._service = service
+        self._rows = rows
+
+    def result(self):
+        self._service.call()
+        return self._rows
+
+
+class FakeBigQueryClient:
+    """
+    Answers the processor's feature queries with synthetic rows and accepts
+    streaming inserts. Feature rows are plain dicts, which support the same
+    row['column'] and row.items() access as bigquery.Row
+    """
+
+    def __init__(self, query_service, insert_service):
+        self.query_service = query_service
+        self.insert_service = insert_service
+        self._lock = threading.Lock()
+        self.rows_inserted = 0
+
+    def get_table(self, table_id):
+        return FakeTable()
+
+    def query(self, query, job_config=None):
+        parameters = {}
+        if job_config is not None:
+            parameters = {parameter.name: parameter for parameter in job_config.query_parameters}
+
+        if 'transactions' in parameters:
+            # get_features_batch: one row per transaction struct
+            rows = []
+            for struct in parameters['transactions'].values:
+                values = struct.struct_values
+                row = {'idx': values['idx'], 'tx_amount': values['tx_amount']}
+                row.update(self._features(inference.CUSTOMER_FEATURE_COLUMNS))
+                row.update(self._features(inference.TERMINAL_FEATURE_COLUMNS))
+                row['customer_feature_ts'] = row['terminal_feature_ts'] = values['tx_ts']
+                rows.append(row)
+        elif 'entity_id' in parameters:
+            # get_customer_features / get_terminal_features (views or latest-feature tables)
+            columns = (inference.CUSTOMER_FEATURE_COLUMNS if 'customer_' in query
+                       else inference.TERMINAL_FEATURE_COLUMNS)
+            # The latest-feature table lookup has no @tx_ts; its row predates every generated transaction
+            feature_ts = parameters['tx_ts'].value if 'tx_ts' in parameters else "2023-12-31 00:00:00 UTC"
+            row = {'feature_ts': feature_ts}
+            row.update(self._features(columns))
+            rows = [row]
+        else:
+            # get_features: combined customer and terminal row
+            row = {'tx_amount': parameters['tx_amount'].value}
+            row.update(self._features(inference.CUSTOMER_FEATURE_COLUMNS))
+            row.update(self._features(inference.TERMINAL_FEATURE_COLUMNS))
+            row['customer_feature_ts'] = row['terminal_feature_ts'] = parameters['tx_ts'].value
+            rows = [row]
+        return FakeQueryJob(self.query_service, rows)
+
+    def insert_rows_json(self, table, json_rows, row_ids=None):
+        self.insert_service.call()
+        with self._lock:
+            self.rows_inserted += len(json_rows)
+        return []
+
+    @staticmethod
+    def _features(columns):
+        return {column: (1.0 if '_nb_tx_' in column else 0.5) for column in columns}
+
+
+class FakePredictionResponse:
+    def __init__(self, predictions, deployed_model_id):
+        self.predictions = predictions
+        self.deployed_model_id = deployed_model_id
+
+
+class FakeEndpoint:
+    """Answers Endpoint.predict in the BQML logistic regression format"""
+
+    def __init__(self, service):
+        self.service = service
+
+    def predict(self, instances):
+        self.service.call()
+        predictions = [
+            {'tx_fraud_values': ['1', '0'], 'tx_fraud_probs': [0.1, 0.9]}
+            for _ in instances
+        ]
+        return FakePredictionResponse(predictions, "benchmark-model")
+
+
+class FakeMessage:
+    """Pub/Sub message that reports its ack or nack to the fake subscriber"""
+
+    def __init__(self, data, subscriber, delivery_attempt=1):
+        self.data = data
+        self.message_id = uuid.uuid4().hex
+        self.delivery_attempt = delivery_attempt
+        self.delivered_at = None
+        self._subscriber = subscriber
+        self._settled = False
+        self._lock = threading.Lock()
+
+    def ack(self):
+        self._settle(True)
+
+    def nack(self):
+        self._settle(False)
+
+    def _settle(self, acked):
+        with self._lock:
+            if self._settled:
+                return
+            self._settled = True
+        self._subscriber.settle(self, acked)
+
+
+class FakeStreamingPullFuture:
+    def __init__(self, subscriber):
+        self._subscriber = subscriber
+
+    def result(self, timeout=None):
+        if not self._subscriber.done.wait(timeout):
+            raise TimeoutError("Benchmark did not finish in time")
+
+    def cancel(self):
+        self._subscriber.done.set()
+
+
+class FakeSubscriber:
+    """
+    Delivers a fixed list of payloads to the subscription callback like the
+    streaming pull client does: callbacks run on a thread pool and at most
+    flow_control.max_messages messages are outstanding (delivered but not yet
+    acked or nacked). A nacked message is redelivered up to max_redeliveries
+    times and counted as nacked after that
+    """
+
+    def __init__(self, payloads, callback_threads=10, max_redeliveries=0):
+        self.messages = [FakeMessage(json.dumps(payload).encode('utf-8'), self) for payload in payloads]
+        self.callback_threads = callback_threads
+        self.max_redeliveries = max_redeliveries
+        self.done = threading.Event()
+        self.started_at = None
+        self.finished_at = None
+        self.latencies = []
+        self.acked = 0
+        self.nacked = 0
+        self.redelivered = 0
+        self._lock = threading.Lock()
+        self._outstanding = None
+        self._deliveries = queue.Queue()
+        for message in self.messages:
+            self._deliveries.put(message)
+
+    def subscribe(self, subscription, callback, flow_control=None):
+        max_messages = flow_control.max_messages if flow_control is not None else 1000
+        self._outstanding = threading.BoundedSemaphore(max_messages)
+        self.started_at = time.perf_counter()
+        threading.Thread(target=self._dispatch, args=(callback,), name="fake-pubsub", daemon=True).start()
+        return FakeStreamingPullFuture(self)
+
+    def settle(self, message, acked):
+        latency = time.perf_counter() - message.delivered_at
+        if not acked and message.delivery_attempt <= self.max_redeliveries:
+            with self._lock:
+                self.redelivered += 1
+            self._outstanding.release()
+            self._deliveries.put(FakeMessage(message.data, self, message.delivery_attempt + 1))
+            return
+        with self._lock:
+            self.latencies.append(latency)
+            if acked:
+                self.acked += 1
+            else:
+                self.nacked += 1
+            finished = self.acked + self.nacked == len(self.messages)
+        self._outstanding.release()
+        if finished:
+            self.finished_at = time.perf_counter()
+            self.done.set()
+
+    def close(self):
+        pass
+
+    def _dispatch(self, callback):
+        with ThreadPoolExecutor(max_workers=self.callback_threads, thread_name_prefix="fake-callback") as pool:
+            while not self.done.is_set():
+                try:
+                    message = self._deliveries.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                self._outstanding.acquire()
+                if self.done.is_set():
+                    return
+                message.delivered_at = time.perf_counter()
+                pool.submit(callback, message)
+
+
+def generate_transactions(count, customers=5000, terminals=10000, seed=0):
+    """Synthetic ff-tx payloads with increasing timestamps"""
+    rng = random.Random(seed)
+    tx_ts = datetime(2024, 1, 1)
+    payloads = []
+    for _ in range(count):
+        tx_ts += timedelta(seconds=rng.randint(0, 5))
+        payloads.append({
+            'TX_ID': uuid.UUID(int=rng.getrandbits(128)).hex,
+            'TX_TS': tx_ts.strftime('%Y-%m-%d %H:%M:%S UTC'),
+            'CUSTOMER_ID': str(rng.randrange(customers)),
+            'TERMINAL_ID': str(rng.randrange(terminals)),
+            'TX_AMOUNT': round(rng.lognormvariate(3.5, 1.0), 2),
+        })
+    return payloads
+
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(q / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+
+def build_fake_processor(config):
+    """
+    FraudDetectionProcessor wired to the fakes; also the processor factory of
+    the worker processes when --workers is above 1
+    Args:
+        config: dict of benchmark options (see parse_args)
+    """
+    # Distinct failure sequences per worker process
+    seed = config['seed'] + 3 * os.getpid()
+    query_service = FakeService("BigQuery query", config['bq_latency_ms'], config['bq_jitter_ms'],
+                                config['bq_error_rate'], seed)
+    insert_service = FakeService("BigQuery insert", config['insert_latency_ms'], config['insert_jitter_ms'],
+                                 config['insert_error_rate'], seed + 1)
+    predict_service = FakeService("Vertex AI predict", config['predict_latency_ms'], config['predict_jitter_ms'],
+                                  config['predict_error_rate'], seed + 2)
+    bq_client = FakeBigQueryClient(query_service, insert_service)
+
+    local_model = None
+    if config['local_model']:
+        from local_model import load_model
+        local_model = load_model(config['local_model'])
+
+    fallback_model = None
+    if config['fallback_model']:
+        from local_model import load_model
+        fallback_model = load_model(config['fallback_model'])
+
+    feature_store = None
+    if config['local_feature_store']:
+        from local_feature_store import LocalFeatureStore
+        feature_store = LocalFeatureStore(config['local_feature_store'])
+
+    processor = inference.FraudDetectionProcessor(
+        project_id="benchmark",
+        endpoint_id="benchmark",
+        location="local",
+        window_features=StreamingWindowFeatures() if config['streaming_features'] else None,
+        feature_cache=FeatureCache(config['cache_entries']) if config['cache_entries'] > 0 else None,
+        local_model=local_model,
+        latest_feature_tables=config['latest_feature_tables'],
+        feature_store=feature_store,
+        bq_client=bq_client,
+        endpoint=FakeEndpoint(predict_service),
+        table=FakeTable(),
+        redelivery_index=RedeliveryIndex(config['redelivery_index']) if config['redelivery_index'] > 0 else None,
+        message_budget_ms=config['budget_ms'],
+        fallback_model=fallback_model,
+    )
+    if config['writer_rows'] > 0:
+        processor.prediction_writer = PredictionWriter(bq_client, processor.table, config['writer_rows'],
+                                                       config['writer_latency_ms'])
+    if config['shadow_models'] > 0:
+        from shadow_scoring import EndpointModel, ShadowScorer
+
+        # Shadow endpoints behave like the primary one; their rows go to a separate fake table
+        models = {
+            f"shadow-{idx}": EndpointModel(
+                FakeEndpoint(FakeService(f"Shadow predict {idx}", config['predict_latency_ms'],
+                                         config['predict_jitter_ms'], config['predict_error_rate'], seed + 5 + idx)),
+                processor.parse_prediction_value)
+            for idx in range(config['shadow_models'])
+        }
+        shadow_client = FakeBigQueryClient(query_service, FakeService(
+            "Shadow insert", config['insert_latency_ms'], config['insert_jitter_ms'], 0.0, seed + 4))
+        shadow_writer = PredictionWriter(shadow_client, FakeTable(), 500, config['writer_latency_ms'],
+                                         row_id=ShadowScorer.row_id)
+        processor.shadow_scorer = ShadowScorer(models, shadow_writer, config['shadow_workers'],
+                                               counter=processor.metrics.shadow)
+    return processor
+
+
+def run_benchmark(config):
+    """
+    Run one scenario end to end through FraudDetectionProcessor.start, or
+    through ShardedSupervisor.run when config['workers'] is above 1
+    Args:
+        config: dict of benchmark options (see parse_args)
+    Returns:
+        dict of results
+    """
+    payloads = generate_transactions(config['messages'], config['customers'], config['terminals'], config['seed'])
+    subscriber = FakeSubscriber(payloads, config['callback_threads'], config['redeliveries'])
+    subscription_path = "projects/benchmark/subscriptions/ff-tx-sub"
+    sharded = config['workers'] > 1
+    processor = None if sharded else build_fake_processor(config)
+
+    if config['trace_memory']:
+        tracemalloc.start()
+    # Keep the cost of the processor's logging but not its output
+    log_file = None if config['verbose'] else os.devnull
+    log_stream = open(log_file, "w") if log_file else None
+    background_logging = configure_logging(config['log_level'], config['log_sample_rate'], log_stream)
+    try:
+        if sharded:
+            supervisor = ShardedSupervisor(
+                config['workers'], functools.partial(build_fake_processor, config), config['worker_lanes'],
+                config['log_level'], config['log_sample_rate'], log_file=log_file
+            )
+            supervisor.run(subscription_path, subscriber=subscriber)
+        else:
+            processor.start(
+                subscription_path,
+                batch_max_messages=config['batch_size'],
+                batch_max_latency_ms=config['batch_latency_ms'],
+                max_in_flight=config['max_in_flight'],
+                subscriber=subscriber,
+                adaptive_concurrency=config['adaptive'],
+            )
+    finally:
+        if processor is not None and processor.prediction_writer is not None:
+            processor.prediction_writer.close()
+        if processor is not None and processor.shadow_scorer is not None:
+            processor.shadow_scorer.close()
+        background_logging.stop()
+        if log_stream is not None:
+            log_stream.close()
+    # From subscribing to the last ack, so worker start-up is not counted
+    elapsed = (subscriber.finished_at or time.perf_counter()) - subscriber.started_at
+    traced_peak = None
+    if config['trace_memory']:
+        traced_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    latencies = sorted(subscriber.latencies)
+    settled = subscriber.acked + subscriber.nacked
+    results = {
+        'scenario': config['name'],
+        'messages': len(payloads),
+        'acked': subscriber.acked,
+        'nacked': subscriber.nacked,
+        'redelivered': subscriber.redelivered,
+        'nack_rate': subscriber.nacked / settled if settled else 0.0,
+        'seconds': elapsed,
+        'throughput_msg_s': settled / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': latencies[-1] * 1000 if latencies else 0.0,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    if traced_peak is not None:
+        results['traced_peak_mb'] = traced_peak / (1024 * 1024)
+    if sharded:
+        # Largest worker; the fakes' call counters live in the workers
+        results['worker_peak_rss_mb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+        return results
+
+    results['bq_queries'] = processor.bq_client.query_service.stats()
+    results['bq_inserts'] = processor.bq_client.insert_service.stats()
+    results['predict_calls'] = processor.endpoint.service.stats()
+    if processor.feature_cache is not None:
+        results['feature_cache'] = processor.feature_cache.stats()
+    if processor.redelivery_index is not None:
+        results['redelivery_index'] = processor.redelivery_index.stats()
+    if processor.hedger is not None:
+        results['hedges'] = processor.hedger.stats()
+        results['degraded'] = {reason: processor.metrics.degraded.value(reason) for reason in ("features", "model")}
+    if processor.shadow_scorer is not None:
+        results['shadow'] = processor.shadow_scorer.stats()
+        results['shadow_rows_written'] = processor.shadow_scorer.writer.stats()['rows_written']
+    return results
+
+
+# Scenarios run by --suite, as overrides of the command line options
+SUITE = [
+    ("serial", {}),
+    ("batch-50", {'batch_size': 50}),
+    ("async-32", {'max_in_flight': 32}),
+    ("async-32+cache", {'max_in_flight': 32, 'cache_entries': 100000}),
+    ("async-32+writer", {'max_in_flight': 32, 'writer_rows': 500}),
+    ("async-32+window", {'max_in_flight': 32, 'streaming_features': True}),
+    ("async-adaptive", {'max_in_flight': 8, 'adaptive': True}),
+    ("async-32+shadow", {'max_in_flight': 32, 'shadow_models': 2}),
+]
+
+
+def format_results(results):
+    line = (f"{results['scenario']:<18} {results['acked']:>7} {results['nacked']:>6} "
+            f"{results['throughput_msg_s']:>10.1f} {results['p50_ms']:>9.1f} {results['p95_ms']:>9.1f} "
+            f"{results['p99_ms']:>9.1f} {results['peak_rss_mb']:>9.1f}")
+    if 'traced_peak_mb' in results:
+        line += f" {results['traced_peak_mb']:>10.1f}"
+    return line
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark for FraudDetectionProcessor")
+    parser.add_argument("--suite", action="store_true", help="run every scenario in SUITE")
+    parser.add_argument("--name", default="custom")
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--customers", type=int, default=5000)
+    parser.add_argument("--terminals", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+
+    parser.add_argument("--max-in-flight", type=int, default=1)
+    parser.add_argument("--adaptive", action="store_true",
+                        help="adapt the in-flight limit, starting at --max-in-flight (see adaptive_concurrency.py)")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--batch-latency-ms", type=float, default=50)
+    parser.add_argument("--workers", type=int, default=1, help="worker processes (see sharded.py)")
+    parser.add_argument("--worker-lanes", type=int, default=8)
+    parser.add_argument("--callback-threads", type=int, default=10,
+                        help="subscriber callback threads (the Pub/Sub client default is 10)")
+    parser.add_argument("--cache-entries", type=int, default=0)
+    parser.add_argument("--redelivery-index", type=int, default=0,
+                        help="TX_IDs remembered by the redelivery index (see redelivery_index.py)")
+    parser.add_argument("--redeliveries", type=int, default=0, help="times a nacked message is redelivered")
+    parser.add_argument("--writer-rows", type=int, default=0)
+    parser.add_argument("--writer-latency-ms", type=float, default=50)
+    parser.add_argument("--streaming-features", action="store_true")
+    parser.add_argument("--latest-feature-tables", action="store_true")
+    parser.add_argument("--local-feature-store", default="",
+                        help="SQLite file (or :memory:) of a local feature store (see local_feature_store.py)")
+    parser.add_argument("--local-model", default="", help="local model artifact (see local_model.py)")
+    parser.add_argument("--budget-ms", type=float, default=0,
+                        help="per-message latency budget with hedged calls (see deadline.py)")
+    parser.add_argument("--fallback-model", default="", help="local model artifact scoring once the budget runs out")
+    parser.add_argument("--shadow-models", type=int, default=0,
+                        help="shadow models on fake endpoints, scored on the primary's features")
+    parser.add_argument("--shadow-workers", type=int, default=2, help="threads per shadow model")
+
+    parser.add_argument("--bq-latency-ms", type=float, default=20)
+    parser.add_argument("--bq-jitter-ms", type=float, default=5)
+    parser.add_argument("--bq-error-rate", type=float, default=0.0)
+    parser.add_argument("--predict-latency-ms", type=float, default=15)
+    parser.add_argument("--predict-jitter-ms", type=float, default=5)
+    parser.add_argument("--predict-error-rate", type=float, default=0.0)
+    parser.add_argument("--insert-latency-ms", type=float, default=10)
+    parser.add_argument("--insert-jitter-ms", type=float, default=3)
+    parser.add_argument("--insert-error-rate", type=float, default=0.0)
+
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="also report peak Python allocations (slows the run down)")
+    parser.add_argument("--json", action="store_true", help="print results as JSON lines")
+    parser.add_argument("--log-level", default=inference.LOG_LEVEL)
+    parser.add_argument("--log-sample-rate", type=float, default=inference.LOG_SAMPLE_RATE)
+    parser.add_argument("--verbose", action="store_true", help="show the processor's own log output")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    base = vars(args).copy()
+    scenarios = SUITE if args.suite else [(args.name, {})]
+
+    if not args.json:
+        header = (f"{'scenario':<18} {'acked':>7} {'nacked':>6} {'msg/s':>10} {'p50 ms':>9} "
+                  f"{'p95 ms':>9} {'p99 ms':>9} {'rss MB':>9}")
+        if args.trace_memory:
+            header += f" {'traced MB':>10}"
+        print(header)
+
+    for name, overrides in scenarios:
+        config = dict(base, name=name)
+        config.update(overrides)
+        results = run_benchmark(config)
+        print(json.dumps(results) if args.json else format_results(results))
+
+
+if __name__ == "__main__":
+    main()
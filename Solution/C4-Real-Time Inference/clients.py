@@ -0,0 +1,98 @@
+# Lazily constructed Google Cloud clients, shared by the whole process
+import os
+import threading
+import time
+
+# Keep-alive connections per BigQuery client; raise it with the number of concurrent messages
+BIGQUERY_HTTP_POOL_SIZE = 64
+
+_IMPORTED_AT = time.monotonic()
+
+_bigquery_lock = threading.Lock()
+_subscriber_lock = threading.Lock()
+_vertex_lock = threading.Lock()
+
+_bigquery_clients = {}
+_subscriber = None
+_vertex_initialized = set()
+_endpoints = {}
+
+
+def bigquery_client(project=None):
+    """
+    Shared BigQuery client for a project, created on first use with a
+    connection pool large enough for concurrent feature queries and inserts
+    """
+    with _bigquery_lock:
+        client = _bigquery_clients.get(project)
+        if client is None:
+            import google.auth
+            from google.auth.transport.requests import AuthorizedSession
+            from google.cloud import bigquery
+            from requests.adapters import HTTPAdapter
+
+            # The client uses a session passed as _http as is, so it must carry the credentials
+            credentials, default_project = google.auth.default(scopes=bigquery.Client.SCOPE)
+            session = AuthorizedSession(credentials)
+            session.mount("https://", HTTPAdapter(
+                pool_connections=BIGQUERY_HTTP_POOL_SIZE,
+                pool_maxsize=BIGQUERY_HTTP_POOL_SIZE
+            ))
+            client = bigquery.Client(project=project or default_project, credentials=credentials, _http=session)
+            _bigquery_clients[project] = client
+        return client
+
+
+def subscriber_client():
+    """Shared Pub/Sub subscriber client, created on first use"""
+    global _subscriber
+    with _subscriber_lock:
+        if _subscriber is None:
+            from google.cloud import pubsub_v1
+
+            _subscriber = pubsub_v1.SubscriberClient()
+        return _subscriber
+
+
+def close_subscriber():
+    """Close the shared subscriber client, if it was created"""
+    global _subscriber
+    with _subscriber_lock:
+        if _subscriber is not None:
+            _subscriber.close()
+            _subscriber = None
+
+
+def vertex_endpoint(endpoint_id, project, location):
+    """
+    Shared Vertex AI endpoint handle. google.cloud.aiplatform takes seconds
+    to import, so it is only imported here, the first time an endpoint is
+    actually needed
+    """
+    with _vertex_lock:
+        endpoint = _endpoints.get((project, location, endpoint_id))
+        if endpoint is None:
+            from google.cloud import aiplatform
+
+            if (project, location) not in _vertex_initialized:
+                aiplatform.init(project=project, location=location)
+                _vertex_initialized.add((project, location))
+            endpoint = aiplatform.Endpoint(endpoint_id)
+            _endpoints[(project, location, endpoint_id)] = endpoint
+        return endpoint
+
+
+def process_uptime():
+    """
+    Seconds since the operating system started this process, falling back to
+    the time since this module was imported where /proc is not available
+    """
+    try:
+        with open("/proc/self/stat") as f:
+            # Fields after the command name; starttime is field 22 of the full line
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            system_uptime = float(f.read().split()[0])
+        return system_uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return time.monotonic() - _IMPORTED_AT
@@ -0,0 +1,211 @@
+# Per-message latency budget and hedged remote calls
+import asyncio
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class DeadlineExceeded(TimeoutError):
+    """A hedged call did not return within its share of the message budget"""
+
+
+def _retrieve_exception(task):
+    # An abandoned call may fail after its result stopped mattering
+    if not task.cancelled():
+        task.exception()
+
+
+class Deadline:
+    """Latency budget of one message, counted from when its processing starts"""
+
+    def __init__(self, budget_seconds, clock=time.monotonic):
+        self._clock = clock
+        self.expires_at = clock() + budget_seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - self._clock())
+
+
+class Hedger:
+    """
+    Runs a blocking call and, if it has not returned after hedge_after
+    seconds, a duplicate of it; the first successful result wins. A call
+    still running when the other returned (or the timeout passed) is left to
+    finish in the background, since client calls cannot be cancelled.
+
+    Those abandoned calls are bounded: while max_abandoned of them are still
+    running no duplicates are sent, and a step with a timeout fails at once
+    with DeadlineExceeded ("shed") instead of queueing behind them. The
+    thread pool has room for a primary and a duplicate call per message in
+    flight on top of the abandoned ones, so a slow backend cannot fill it.
+
+    hedges, if given, is a Counter labelled (step, outcome) that counts the
+    duplicates "sent", the ones that "won", the steps that ran out of time
+    ("timeout"), the calls left running ("abandoned") and the steps "shed"
+    """
+
+    def __init__(self, max_in_flight=1, max_abandoned=32, hedges=None):
+        """
+        Args:
+            max_in_flight: messages making hedged calls at once
+            max_abandoned: abandoned calls allowed to run before shedding
+            hedges: Counter labelled (step, outcome)
+        """
+        self.max_in_flight = max_in_flight
+        self.max_abandoned = max_abandoned
+        self._executor = None
+        self._hedges = hedges
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.won = 0
+        self.timeouts = 0
+        self.abandoned = 0
+        self.shed = 0
+        # Abandoned calls still running
+        self.outstanding = 0
+
+    def size_for(self, max_in_flight):
+        """Size the thread pool for max_in_flight messages making hedged calls at once"""
+        with self._lock:
+            self.max_in_flight = max_in_flight
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            # Calls already running on the old pool finish there
+            executor.shutdown(wait=False)
+
+    def call(self, step, func, args, hedge_after, timeout):
+        """
+        Call func(*args) from the hedge thread pool
+        Args:
+            step: name of the step, for the counters ("features", "predict")
+            func, args: the blocking call
+            hedge_after: seconds before sending the duplicate (None never sends one)
+            timeout: seconds to wait for a result (None waits indefinitely)
+        Returns:
+            the first successful result
+        Raises:
+            DeadlineExceeded once timeout has passed, or at once if too many
+            abandoned calls are running; the first call's error if both fail
+        """
+        hedge_after = self._admit(step, hedge_after, timeout)
+        executor = self._pool()
+        started = time.monotonic()
+        first = executor.submit(func, *args)
+        calls = [first]
+        if hedge_after is not None and (timeout is None or hedge_after < timeout):
+            done, _ = wait(calls, timeout=hedge_after)
+            if not done:
+                calls.append(executor.submit(func, *args))
+                self._count(step, "sent")
+
+        pending = set(calls)
+        try:
+            while pending:
+                remaining = None if timeout is None else max(0.0, timeout - (time.monotonic() - started))
+                done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+                if not done:
+                    self._count(step, "timeout")
+                    raise DeadlineExceeded(f"{step} did not return within {timeout:.3f}s")
+                for future in done:
+                    if future.exception() is None:
+                        if future is not first:
+                            self._count(step, "won")
+                        return future.result()
+        finally:
+            self._abandon(step, pending)
+        # Every call failed
+        return first.result()
+
+    async def call_async(self, step, make_call, hedge_after, timeout):
+        """
+        Asyncio counterpart of call
+        Args:
+            make_call: zero-argument function returning a new awaitable of
+                the call, e.g. one running it off the event loop with
+                AsyncFraudPipeline._run
+        """
+        hedge_after = self._admit(step, hedge_after, timeout)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        first = asyncio.ensure_future(make_call())
+        first.add_done_callback(_retrieve_exception)
+        calls = [first]
+        if hedge_after is not None and (timeout is None or hedge_after < timeout):
+            done, _ = await asyncio.wait(calls, timeout=hedge_after)
+            if not done:
+                hedge = asyncio.ensure_future(make_call())
+                hedge.add_done_callback(_retrieve_exception)
+                calls.append(hedge)
+                self._count(step, "sent")
+
+        pending = set(calls)
+        try:
+            while pending:
+                remaining = None if timeout is None else max(0.0, timeout - (loop.time() - started))
+                done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    self._count(step, "timeout")
+                    raise DeadlineExceeded(f"{step} did not return within {timeout:.3f}s")
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self._count(step, "won")
+                        return task.result()
+        finally:
+            self._abandon(step, pending)
+        return first.result()
+
+    def stats(self):
+        with self._lock:
+            return {'sent': self.sent, 'won': self.won, 'timeouts': self.timeouts,
+                    'abandoned': self.abandoned, 'shed': self.shed, 'outstanding': self.outstanding}
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=2 * self.max_in_flight + self.max_abandoned, thread_name_prefix="fraud-hedge")
+            return self._executor
+
+    def _admit(self, step, hedge_after, timeout):
+        """hedge_after to use for a new step; raises DeadlineExceeded to shed it"""
+        with self._lock:
+            saturated = self.outstanding >= self.max_abandoned
+        if not saturated:
+            return hedge_after
+        if timeout is not None:
+            self._count(step, "shed")
+            raise DeadlineExceeded(f"{step} shed: {self.max_abandoned} abandoned calls still running")
+        # Waiting indefinitely never abandons the call; just do not duplicate it
+        return None
+
+    def _abandon(self, step, pending):
+        for call in pending:
+            self._count(step, "abandoned")
+            call.add_done_callback(self._release)
+
+    def _release(self, _call):
+        with self._lock:
+            self.outstanding -= 1
+
+    def _count(self, step, outcome):
+        with self._lock:
+            if outcome == "sent":
+                self.sent += 1
+            elif outcome == "won":
+                self.won += 1
+            elif outcome == "abandoned":
+                self.abandoned += 1
+                self.outstanding += 1
+            elif outcome == "shed":
+                self.shed += 1
+            else:
+                self.timeouts += 1
+        if self._hedges is not None:
+            self._hedges.inc(step, outcome)
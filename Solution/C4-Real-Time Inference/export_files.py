@@ -0,0 +1,43 @@
+# Reading local Parquet/CSV exports; shared by the batch tools and kept free of
+# the processor's (and so the Google Cloud clients') imports
+import glob
+import os
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+# Rows read at a time
+CHUNK_ROWS = 100000
+
+
+def expand_paths(inputs):
+    """
+    Expand files, directories and glob patterns into a sorted list of
+    .parquet/.csv files
+    """
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            matches = glob.glob(os.path.join(item, "*.parquet")) + glob.glob(os.path.join(item, "*.csv"))
+        else:
+            matches = glob.glob(item)
+        if not matches:
+            raise FileNotFoundError(f"No input files match {item}")
+        paths.extend(sorted(matches))
+    return paths
+
+
+def read_chunks(paths, chunk_rows=CHUNK_ROWS):
+    """
+    Stream the input files as DataFrames of at most chunk_rows rows, without
+    loading a whole file
+    """
+    for path in paths:
+        if path.endswith(".parquet"):
+            for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows):
+                yield batch.to_pandas()
+        elif path.endswith(".csv"):
+            yield from pd.read_csv(path, chunksize=chunk_rows, dtype={'TX_ID': str, 'CUSTOMER_ID': str,
+                                                                      'TERMINAL_ID': str})
+        else:
+            raise ValueError(f"Unsupported input file {path}, expected .parquet or .csv")
@@ -0,0 +1,137 @@
+# Bounded TTL/LRU cache for the customer and terminal halves of the feature vector
+import threading
+import time
+from collections import OrderedDict
+
+from window_features import to_unix_seconds
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries also expire after max_age_seconds.
+    Evicts the least recently used entry once max_entries is reached
+    """
+
+    def __init__(self, max_entries, max_age_seconds, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_seconds
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def get(self, key, is_usable=None, max_age_seconds=None):
+        """
+        Return the cached value for key, or None if missing or too old
+        Args:
+            key: cache key
+            is_usable: optional predicate; a value it rejects counts as a miss
+            max_age_seconds: overrides the cache's max_age_seconds for this lookup
+        """
+        now = self._clock()
+        if max_age_seconds is None:
+            max_age_seconds = self.max_age_seconds
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            stored_at, value = entry
+            if now - stored_at > max_age_seconds:
+                # Left in place (until refreshed or evicted) as a fallback for a longer max age
+                self.expirations += 1
+                self.misses += 1
+                return None
+            if is_usable is not None and not is_usable(value):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Store value for key, evicting the least recently used entries if full"""
+        now = self._clock()
+        with self._lock:
+            self._entries[key] = (now, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Counters and current size"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'expirations': self.expirations,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+class FeatureCache:
+    """
+    Caches the customer and terminal halves of the feature vector separately,
+    keyed on customer_id and terminal_id.
+
+    An entry is served only while it is younger than max_staleness_seconds and
+    its feature_ts is not after the transaction being scored, so a cached row
+    is always one the views could have returned for that transaction.
+    max_staleness_seconds bounds how many of the entity's newest transactions
+    the cached windows may be missing
+    """
+
+    def __init__(self, max_entries=100000, max_staleness_seconds=60.0):
+        self.customers = TTLCache(max_entries, max_staleness_seconds)
+        self.terminals = TTLCache(max_entries, max_staleness_seconds)
+
+    def get_customer(self, customer_id, tx_ts, max_staleness_seconds=None):
+        """Cached customer features for a transaction at tx_ts, or None"""
+        return self._get(self.customers, customer_id, tx_ts, max_staleness_seconds)
+
+    def put_customer(self, customer_id, feature_ts, features):
+        """Cache customer features; feature_ts is None when the view had no row"""
+        self._put(self.customers, customer_id, feature_ts, features)
+
+    def get_terminal(self, terminal_id, tx_ts, max_staleness_seconds=None):
+        """Cached terminal features for a transaction at tx_ts, or None"""
+        return self._get(self.terminals, terminal_id, tx_ts, max_staleness_seconds)
+
+    def put_terminal(self, terminal_id, feature_ts, features):
+        """Cache terminal features; feature_ts is None when the view had no row"""
+        self._put(self.terminals, terminal_id, feature_ts, features)
+
+    def stats(self):
+        return {'customers': self.customers.stats(), 'terminals': self.terminals.stats()}
+
+    @staticmethod
+    def _get(cache, key, tx_ts, max_staleness_seconds=None):
+        tx_seconds = to_unix_seconds(tx_ts)
+
+        # A cached row newer than this transaction (late or replayed message) is unusable
+        def is_usable(entry):
+            feature_ts, _ = entry
+            return feature_ts is None or feature_ts <= tx_seconds
+
+        entry = cache.get(key, is_usable, max_staleness_seconds)
+        if entry is None:
+            return None
+        return entry[1]
+
+    @staticmethod
+    def _put(cache, key, feature_ts, features):
+        if feature_ts is not None:
+            feature_ts = to_unix_seconds(feature_ts)
+        cache.put(key, (feature_ts, features))
@@ -1,53 +1,277 @@
 # Import required libraries
+# google.cloud (bigquery, pubsub_v1, aiplatform), numpy and sharded are imported lazily
+# (see clients.py), only when used
 import os
-from concurrent.futures import TimeoutError
-from google.cloud import pubsub_v1
-from google.cloud import bigquery
-from google.cloud import aiplatform
+import sys
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 import json
+import logging
 from datetime import datetime
+import threading
 import time
-from decimal import Decimal
 
-# Authentication (run this if not already authenticated)
-from google.colab import auth
-auth.authenticate_user()
+import clients
+from async_pipeline import AsyncFraudPipeline
+from deadline import Deadline, DeadlineExceeded, Hedger
+from feature_cache import FeatureCache
+from log_setup import configure_logging
+from metrics import InferenceMetrics, MetricsServer
+from prediction_writer import PredictionWriter
+from redelivery_index import DONE, RedeliveryIndex
+from transaction_record import TransactionRecord
+from window_features import HISTORY_SECONDS, LABEL_DELAY_SECONDS, StreamingWindowFeatures, to_unix_seconds
+
+logger = logging.getLogger(__name__)
 
 # Configuration
 PROJECT_ID = ""
 SUBSCRIPTION_PATH = "projects//subscriptions/ff-tx-sub"
+LABELS_SUBSCRIPTION_PATH = "projects//subscriptions/ff-txlabels-sub"
 LOCATION = "us-central1"
 ENDPOINT_ID = ""
 DATASET_ID = "tx"
 BQ_TABLE = f"{PROJECT_ID}.{DATASET_ID}.online_fraud_prediction"
 
-# Initialize clients
-subscriber = pubsub_v1.SubscriberClient()
-bq_client = bigquery.Client(project=PROJECT_ID)
-aiplatform.init(project=PROJECT_ID, location=LOCATION)
+# Concurrent asyncio pipeline (MAX_IN_FLIGHT_MESSAGES = 1 processes one message at a time)
+MAX_IN_FLIGHT_MESSAGES = 1
+
+# Let the asyncio pipeline adapt its in-flight limit (AIMD, see adaptive_concurrency.py)
+# between the MIN and MAX below, starting at MAX_IN_FLIGHT_MESSAGES. The limit shrinks when
+# message latency, the error rate or the endpoint latency exceed their targets, and intake
+# pauses while more than PREDICTION_WRITER_MAX_ROWS rows wait for the prediction writer
+ADAPTIVE_CONCURRENCY = False
+ADAPTIVE_MIN_IN_FLIGHT = 1
+ADAPTIVE_MAX_IN_FLIGHT = 64
+ADAPTIVE_TARGET_LATENCY_MS = 500
+ADAPTIVE_ENDPOINT_LATENCY_MS = 300
+ADAPTIVE_MAX_ERROR_RATE = 0.05
+
+# Micro-batching, used when the asyncio pipeline is off (BATCH_MAX_MESSAGES = 1 disables it)
+BATCH_MAX_MESSAGES = 1
+BATCH_MAX_LATENCY_MS = 200
+
+# Serve window features from memory instead of querying the C2 views
+USE_STREAMING_FEATURES = False
+
+# Look features up by key in the latest-feature tables kept by C2-FE/merge_latest_features.sql
+# instead of the views; a transaction older than an entity's latest row still uses the view
+USE_LATEST_FEATURE_TABLES = False
+LATEST_FEATURE_TABLES = {
+    "customer_spending_features": "customer_latest_features",
+    "terminal_risk_features": "terminal_latest_features",
+}
+
+# Serve features from a local SQLite copy of the C2 views (see local_feature_store.py).
+# The store is loaded from the views at startup and then updated every
+# LOCAL_FEATURE_STORE_SYNC_SECONDS with the rows since its newest one, less
+# LOCAL_FEATURE_STORE_SYNC_LAG_SECONDS for transactions that land late. Labels arrive up to
+# the label delay after their transaction, so every LOCAL_FEATURE_STORE_RESYNC_INTERVAL_SECONDS
+# (0 never) a sync re-reads the last LOCAL_FEATURE_STORE_RESYNC_SECONDS instead, about half
+# the views' history; empty path disables the store. With WORKER_PROCESSES > 1 the workers
+# share the file and only the supervisor syncs it
+LOCAL_FEATURE_STORE_PATH = ""
+LOCAL_FEATURE_STORE_SYNC_SECONDS = 60
+LOCAL_FEATURE_STORE_SYNC_LAG_SECONDS = 300
+LOCAL_FEATURE_STORE_RESYNC_INTERVAL_SECONDS = 6 * 3600
+LOCAL_FEATURE_STORE_RESYNC_SECONDS = LABEL_DELAY_SECONDS
+
+# Cache customer/terminal features for repeat entities (0 disables the cache)
+FEATURE_CACHE_MAX_ENTRIES = 0
+FEATURE_CACHE_MAX_STALENESS_SECONDS = 60
+
+# Score in-process from an exported BQML model artifact instead of the endpoint
+# (see local_model.py; empty uses ENDPOINT_ID)
+LOCAL_MODEL_PATH = ""
+
+# Write predictions from a background thread in batches of up to N rows, acking each
+# message once its row is written (0 writes synchronously inside the callback).
+# Only useful with MAX_IN_FLIGHT_MESSAGES or BATCH_MAX_MESSAGES above 1
+PREDICTION_WRITER_MAX_ROWS = 0
+PREDICTION_WRITER_MAX_LATENCY_MS = 500
+PREDICTION_WRITER_QUEUE_SIZE = 10000
+
+# Latency budget of each message (0 disables it). The feature lookup gets
+# BUDGET_FEATURE_SHARE of the budget and the prediction the rest. A remote call still
+# running after HEDGE_AFTER_FRACTION of its share is sent again and the first answer wins.
+# Once a share runs out the message is scored in degraded mode instead of waiting: with
+# cached features however stale (0 for entities not in the cache), or with the local
+# FALLBACK_MODEL_PATH model; model_version then ends in DEGRADED_FEATURES_TAG or
+# FALLBACK_MODEL_TAG. Without a fallback model the prediction waits for the endpoint.
+# Calls left running by a hedge or a spent budget are capped at HEDGE_MAX_ABANDONED_CALLS;
+# past that no duplicates are sent and steps go straight to degraded mode
+MESSAGE_BUDGET_MS = 0
+BUDGET_FEATURE_SHARE = 0.5
+HEDGE_AFTER_FRACTION = 0.5
+HEDGE_MAX_ABANDONED_CALLS = 32
+FALLBACK_MODEL_PATH = ""
+DEGRADED_FEATURES_TAG = "+stale-features"
+FALLBACK_MODEL_TAG = "+fallback"
+
+# Remember up to N recently seen TX_IDs for REDELIVERY_INDEX_TTL_SECONDS (0 disables it).
+# A redelivered message whose row was already written is only acked, and one whose
+# prediction was computed but not written reuses it instead of scoring again
+REDELIVERY_INDEX_MAX_ENTRIES = 0
+REDELIVERY_INDEX_TTL_SECONDS = 3600
 
-def convert_decimal_to_float(obj):
-    """Convert Decimal objects to float"""
-    if isinstance(obj, Decimal):
-        return float(obj)
-    elif isinstance(obj, dict):
-        return {k: convert_decimal_to_float(v) for k, v in obj.items()}
-    return obj
+# Shadow models scored on the same feature vectors as the primary model (empty disables
+# it), e.g. {"xgboost": "xgboost.json", "kmeans": "endpoint:<ENDPOINT_ID>"}: a local model
+# artifact (local_model.py) or a Vertex AI endpoint per name. Each model is called from
+# SHADOW_WORKERS_PER_MODEL background threads with up to SHADOW_MAX_BATCH queued
+# transactions at a time, and never delays, fails or nacks a message; transactions beyond
+# SHADOW_QUEUE_SIZE waiting per model are dropped. Their predictions are written in
+# batches to SHADOW_BQ_TABLE, next to the primary model's prediction
+SHADOW_MODELS = {}
+SHADOW_BQ_TABLE = f"{PROJECT_ID}.{DATASET_ID}.shadow_fraud_prediction"
+SHADOW_WORKERS_PER_MODEL = 2
+SHADOW_MAX_BATCH = 100
+SHADOW_QUEUE_SIZE = 10000
+SHADOW_WRITER_MAX_ROWS = 500
+SHADOW_WRITER_MAX_LATENCY_MS = 1000
+
+# Worker processes for the multi-process mode (1 runs everything in this process).
+# Messages are sharded by CUSTOMER_ID; each worker scores WORKER_LANES messages
+# at a time, keeping every customer's transactions in order
+WORKER_PROCESSES = 1
+WORKER_LANES = 8
+
+# Serve per-stage latency and throughput metrics on http://<host>:<port>/metrics
+# (Prometheus text format); 0 disables the endpoint, the metrics are still collected.
+# The endpoint has no authentication: METRICS_HOST stays on loopback unless a scraper
+# on another host needs it (e.g. "0.0.0.0" inside a pod scraped by Prometheus)
+METRICS_PORT = 0
+METRICS_HOST = "127.0.0.1"
+
+# Log level, and the fraction of transactions whose per-message INFO/DEBUG lines
+# are logged (errors are always logged in full). Use DEBUG to see features and predictions
+LOG_LEVEL = "INFO"
+LOG_SAMPLE_RATE = 0.01
+
+# Feature columns, in the order the model was trained on
+FEATURE_WINDOWS = ["15min", "30min", "60min", "1day", "7day", "14day"]
+CUSTOMER_FEATURE_COLUMNS = [
+    column
+    for window in FEATURE_WINDOWS
+    for column in (f"customer_id_nb_tx_{window}_window", f"customer_id_avg_amount_{window}_window")
+]
+TERMINAL_FEATURE_COLUMNS = [
+    column
+    for window in FEATURE_WINDOWS
+    for column in (f"terminal_id_nb_tx_{window}_window", f"terminal_id_risk_{window}_window")
+]
+# The whole vector; the feature queries select the columns in this order
+FEATURE_COLUMNS = ['tx_amount'] + CUSTOMER_FEATURE_COLUMNS + TERMINAL_FEATURE_COLUMNS
+
+def authenticate():
+    """Authenticate the notebook user (run this if not already authenticated)"""
+    # Only needed, and only possible, inside a Colab / BigQuery notebook runtime
+    if "google.colab" in sys.modules:
+        from google.colab import auth
+        auth.authenticate_user()
 
 class FraudDetectionProcessor:
-    def __init__(self, project_id, endpoint_id, location):
+    def __init__(self, project_id, endpoint_id, location, window_features=None, feature_cache=None,
+                 local_model=None, prediction_writer=None, bq_client=None, endpoint=None, table=None,
+                 metrics=None, latest_feature_tables=False, feature_store=None, redelivery_index=None,
+                 message_budget_ms=0, fallback_model=None, shadow_scorer=None):
             self.project_id = project_id
+            self.endpoint_id = endpoint_id
             self.location = location
 
-            # Initialize Vertex AI
-            aiplatform.init(project=project_id, location=location)
-            self.endpoint = aiplatform.Endpoint(endpoint_id)
+            # Optional in-memory feature engine (window_features.StreamingWindowFeatures)
+            self.window_features = window_features
+
+            # Optional local point-in-time feature store (local_feature_store.LocalFeatureStore)
+            self.feature_store = feature_store
+
+            # Optional cache for the customer and terminal halves (feature_cache.FeatureCache)
+            self.feature_cache = feature_cache
+
+            # Point lookups in the LATEST_FEATURE_TABLES instead of the window views
+            self.latest_feature_tables = latest_feature_tables
+
+            # Optional in-process scorer (local_model.LocalModel) used instead of the endpoint
+            self.local_model = local_model
+
+            # Optional background writer (prediction_writer.PredictionWriter) used by persist_prediction
+            self.prediction_writer = prediction_writer
 
-            # Initialize BigQuery client
-            self.bq_client = bigquery.Client()
+            # Optional index of recently seen TX_IDs (redelivery_index.RedeliveryIndex)
+            self.redelivery_index = redelivery_index
 
-            # Get the table schema
-            self.table = self.bq_client.get_table(BQ_TABLE)
+            # Stage latencies, in-flight messages, nack rate and event-time lag (metrics.InferenceMetrics)
+            self.metrics = metrics or InferenceMetrics()
+
+            # Per-message latency budget with hedged remote calls (deadline.Hedger), and the
+            # optional local model (local_model.LocalModel) scoring when the budget runs out
+            self.message_budget_seconds = message_budget_ms / 1000.0
+            self.fallback_model = fallback_model
+            self.hedger = None
+            if message_budget_ms > 0:
+                self.hedger = Hedger(max_abandoned=HEDGE_MAX_ABANDONED_CALLS, hedges=self.metrics.hedges)
+                self.metrics.gauge(
+                    "fraud_inference_abandoned_calls", "Hedged or timed-out remote calls still running",
+                    lambda: self.hedger.outstanding
+                )
+
+            # Optional shadow models scored on the same features (shadow_scoring.ShadowScorer)
+            self.shadow_scorer = shadow_scorer
+
+            # Clients, endpoint and table schema are resolved on first use (or by warm_up)
+            self._bq_client = bq_client
+            self._endpoint = endpoint
+            self._table = table
+
+            # Set once warm_up has resolved everything the hot path needs
+            self.ready = threading.Event()
+            self.cold_start_seconds = None
+
+    @property
+    def bq_client(self):
+        """Process-wide BigQuery client"""
+        if self._bq_client is None:
+            self._bq_client = clients.bigquery_client(self.project_id)
+        return self._bq_client
+
+    @property
+    def endpoint(self):
+        """Vertex AI endpoint; importing aiplatform is deferred until it is needed"""
+        if self._endpoint is None:
+            self._endpoint = clients.vertex_endpoint(self.endpoint_id, self.project_id, self.location)
+        return self._endpoint
+
+    @property
+    def table(self):
+        """online_fraud_prediction table, with its schema"""
+        if self._table is None:
+            self._table = self.bq_client.get_table(BQ_TABLE)
+        return self._table
+
+    def warm_up(self):
+        """
+        Resolve the endpoint and the prediction table schema in parallel so
+        the first message does not pay for them, then mark the processor ready
+        Returns:
+            float: seconds from process start until ready
+        """
+        started = time.perf_counter()
+        steps = {'table schema': lambda: self.table}
+        if self.local_model is None:
+            steps['endpoint'] = lambda: self.endpoint
+
+        with ThreadPoolExecutor(max_workers=len(steps)) as pool:
+            futures = {name: pool.submit(step) for name, step in steps.items()}
+            for name, future in futures.items():
+                future.result()
+
+        self.cold_start_seconds = clients.process_uptime()
+        self.ready.set()
+        logger.info("Warm-up (%s) took %.0f ms; ready %.0f ms after process start",
+                    ", ".join(steps), (time.perf_counter() - started) * 1000, self.cold_start_seconds * 1000)
+        return self.cold_start_seconds
+
+    def is_ready(self):
+        """Readiness signal: True once warm_up has completed"""
+        return self.ready.is_set()
 
     def get_features(self, transaction_data):
         """
@@ -58,6 +282,28 @@ class FraudDetectionProcessor:
         Returns:
             dict of features ready to send to the model
         """
+        if self.window_features is not None:
+            return self.window_features.get_features(transaction_data)
+        if self.feature_store is not None:
+            return self.feature_store.get_features(transaction_data)
+
+        if self.feature_cache is not None:
+            customer_features = self.feature_cache.get_customer(transaction_data['CUSTOMER_ID'], transaction_data['TX_TS'])
+            terminal_features = self.feature_cache.get_terminal(transaction_data['TERMINAL_ID'], transaction_data['TX_TS'])
+            if customer_features is not None or terminal_features is not None:
+                # Only query the half that is missing or stale
+                if customer_features is None:
+                    customer_features = self.get_customer_features(transaction_data)
+                if terminal_features is None:
+                    terminal_features = self.get_terminal_features(transaction_data)
+                features = {'tx_amount': float(transaction_data['TX_AMOUNT'])}
+                features.update(customer_features)
+                features.update(terminal_features)
+                return features
+
+        if self.latest_feature_tables:
+            return self._query_latest_features_batch([transaction_data])[0]
+
         features_query = f"""
         WITH transaction_data AS (
             SELECT
@@ -140,11 +386,17 @@ class FraudDetectionProcessor:
             COALESCE(t.terminal_id_nb_tx_14day_window, 0) as terminal_id_nb_tx_14day_window,
             COALESCE(t.terminal_id_risk_14day_window, 0) as terminal_id_risk_14day_window,
 
+            /* Row timestamps, used to keep the feature cache point-in-time correct */
+            c.feature_ts as customer_feature_ts,
+            t.feature_ts as terminal_feature_ts
+
         FROM transaction_data d
         LEFT JOIN customer_features c ON c.customer_id = d.customer_id AND c.rn = 1
         LEFT JOIN terminal_features t ON t.terminal_id = d.terminal_id AND t.rn = 1
         """
 
+        from google.cloud import bigquery
+
         job_config = bigquery.QueryJobConfig(
             query_parameters=[
                 bigquery.ScalarQueryParameter("tx_amount", "FLOAT", float(transaction_data['TX_AMOUNT'])),
@@ -155,23 +407,512 @@ class FraudDetectionProcessor:
         )
 
         try:
-            features_df = bq_client.query(features_query, job_config=job_config).to_dataframe()
+            rows = list(self.bq_client.query(features_query, job_config=job_config).result())
 
-            # Convert features to dictionary
+            # Read the row by position: FEATURE_COLUMNS, then the two feature_ts
             features = {}
-            if not features_df.empty:
-                features = features_df.iloc[0].to_dict()
-                # Convert all values to float for consistency
-                features = {k: float(v) if not isinstance(v, str) else v for k, v in features.items()}
+            if rows:
+                values = tuple(rows[0].values())
+                features = dict(zip(FEATURE_COLUMNS, map(float, values)))
+                self._cache_features(transaction_data, features, values[-2], values[-1])
 
-            print(f"Successfully extracted features for TX_ID: {transaction_data['TX_ID']}")
+            logger.debug("Successfully extracted features for TX_ID: %s", transaction_data['TX_ID'],
+                         extra={'tx_id': transaction_data['TX_ID']})
             return features
 
         except Exception as e:
-            print(f"Error extracting features: {str(e)}")
-            print(f"Query parameters: {transaction_data}")
+            logger.error("Error extracting features: %s; query parameters: %s", e, transaction_data)
             raise
 
+    def get_customer_features(self, transaction_data):
+        """
+        Get only the customer half of the feature vector
+        Args:
+            transaction_data: dict containing transaction information
+        Returns:
+            dict of customer_id_* features
+        """
+        feature_ts, features = self._query_entity_features(
+            "customer_spending_features", "customer_id", transaction_data['CUSTOMER_ID'],
+            transaction_data['TX_TS'], CUSTOMER_FEATURE_COLUMNS
+        )
+        if self.feature_cache is not None:
+            self.feature_cache.put_customer(transaction_data['CUSTOMER_ID'], feature_ts, features)
+        return features
+
+    def get_terminal_features(self, transaction_data):
+        """
+        Get only the terminal half of the feature vector
+        Args:
+            transaction_data: dict containing transaction information
+        Returns:
+            dict of terminal_id_* features
+        """
+        feature_ts, features = self._query_entity_features(
+            "terminal_risk_features", "terminal_id", transaction_data['TERMINAL_ID'],
+            transaction_data['TX_TS'], TERMINAL_FEATURE_COLUMNS
+        )
+        if self.feature_cache is not None:
+            self.feature_cache.put_terminal(transaction_data['TERMINAL_ID'], feature_ts, features)
+        return features
+
+    def _query_entity_features(self, view, id_column, entity_id, tx_ts, columns):
+        """
+        Latest feature row of one entity at or before tx_ts
+        Returns:
+            (feature_ts, features) - feature_ts is None and every feature 0 if there is no row
+        """
+        if self.latest_feature_tables:
+            result = self._query_latest_entity_features(view, id_column, entity_id, tx_ts, columns)
+            if result is not None:
+                return result
+        return self._query_view_entity_features(view, id_column, entity_id, tx_ts, columns)
+
+    def _query_latest_entity_features(self, view, id_column, entity_id, tx_ts, columns):
+        """
+        Keyed lookup of an entity in the latest-feature table that mirrors view
+        Returns:
+            (feature_ts, features), or None if the entity's latest row is newer
+            than tx_ts and only the view has the right row
+        """
+        from google.cloud import bigquery
+
+        feature_columns = ",\n            ".join(columns)
+        features_query = f"""
+        SELECT
+            feature_ts,
+            {feature_columns}
+        FROM `{PROJECT_ID}.{DATASET_ID}.{LATEST_FEATURE_TABLES[view]}`
+        WHERE {id_column} = @entity_id
+        """
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ScalarQueryParameter("entity_id", "STRING", entity_id)]
+        )
+
+        try:
+            rows = list(self.bq_client.query(features_query, job_config=job_config).result())
+        except Exception as e:
+            logger.error("Error extracting %s for %s %s: %s", LATEST_FEATURE_TABLES[view], id_column, entity_id, e)
+            raise
+
+        if not rows:
+            return None, {column: 0.0 for column in columns}
+        feature_ts, *values = rows[0].values()
+        if to_unix_seconds(feature_ts) > to_unix_seconds(tx_ts):
+            return None
+        return feature_ts, dict(zip(columns, map(float, values)))
+
+    def _query_view_entity_features(self, view, id_column, entity_id, tx_ts, columns):
+        """Latest feature row of one entity at or before tx_ts, from the window view"""
+        from google.cloud import bigquery
+
+        feature_columns = ",\n            ".join(columns)
+        features_query = f"""
+        SELECT
+            feature_ts,
+            {feature_columns}
+        FROM `{PROJECT_ID}.{DATASET_ID}.{view}`
+        WHERE {id_column} = @entity_id
+        AND feature_ts <= TIMESTAMP(@tx_ts)
+        ORDER BY feature_ts DESC
+        LIMIT 1
+        """
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[
+                bigquery.ScalarQueryParameter("entity_id", "STRING", entity_id),
+                bigquery.ScalarQueryParameter("tx_ts", "STRING", tx_ts)
+            ]
+        )
+
+        try:
+            rows = list(self.bq_client.query(features_query, job_config=job_config).result())
+        except Exception as e:
+            logger.error("Error extracting %s for %s %s: %s", view, id_column, entity_id, e)
+            raise
+
+        if not rows:
+            return None, {column: 0.0 for column in columns}
+        feature_ts, *values = rows[0].values()
+        return feature_ts, dict(zip(columns, map(float, values)))
+
+    def _cache_features(self, transaction_data, features, customer_feature_ts, terminal_feature_ts):
+        """Store both halves of a freshly queried feature vector in the feature cache"""
+        if self.feature_cache is None:
+            return
+        self.feature_cache.put_customer(
+            transaction_data['CUSTOMER_ID'], customer_feature_ts,
+            {column: features[column] for column in CUSTOMER_FEATURE_COLUMNS}
+        )
+        self.feature_cache.put_terminal(
+            transaction_data['TERMINAL_ID'], terminal_feature_ts,
+            {column: features[column] for column in TERMINAL_FEATURE_COLUMNS}
+        )
+
+    def get_features_batch(self, transactions):
+        """
+        Get features for several transactions with a single BigQuery job.
+        Each transaction is matched to the latest customer and terminal feature
+        rows at or before its own timestamp, exactly like get_features
+        Args:
+            transactions: list of dicts containing transaction information
+        Returns:
+            list of feature dicts, in the same order as transactions
+        """
+        if self.window_features is not None:
+            return self.window_features.get_features_batch(transactions)
+        if self.feature_store is not None:
+            return self.feature_store.get_features_batch(transactions)
+
+        if self.feature_cache is None:
+            return self._query_features_batch(transactions)
+
+        # Serve transactions whose customer and terminal halves are both cached
+        features_list = []
+        for transaction_data in transactions:
+            customer_features = self.feature_cache.get_customer(transaction_data['CUSTOMER_ID'], transaction_data['TX_TS'])
+            terminal_features = self.feature_cache.get_terminal(transaction_data['TERMINAL_ID'], transaction_data['TX_TS'])
+            features = None
+            if customer_features is not None and terminal_features is not None:
+                features = {'tx_amount': float(transaction_data['TX_AMOUNT'])}
+                features.update(customer_features)
+                features.update(terminal_features)
+            features_list.append(features)
+
+        missing = [idx for idx, features in enumerate(features_list) if features is None]
+        if missing:
+            queried = self._query_features_batch([transactions[idx] for idx in missing])
+            for idx, features in zip(missing, queried):
+                features_list[idx] = features
+        return features_list
+
+    def _query_features_batch(self, transactions):
+        """Run the multi-transaction feature query for get_features_batch"""
+        from google.cloud import bigquery
+
+        if self.latest_feature_tables:
+            return self._query_latest_features_batch(transactions)
+
+        customer_columns = ",\n                ".join(f"c.{column}" for column in CUSTOMER_FEATURE_COLUMNS)
+        terminal_columns = ",\n                ".join(f"t.{column}" for column in TERMINAL_FEATURE_COLUMNS)
+        feature_columns = ",\n            ".join(
+            f"COALESCE({alias}.{column}, 0) as {column}"
+            for alias, columns in (("c", CUSTOMER_FEATURE_COLUMNS), ("t", TERMINAL_FEATURE_COLUMNS))
+            for column in columns
+        )
+
+        features_query = f"""
+        WITH transaction_data AS (
+            SELECT
+                tx.idx,
+                tx.tx_amount,
+                tx.terminal_id,
+                tx.customer_id,
+                TIMESTAMP(tx.tx_ts) as tx_timestamp
+            FROM UNNEST(@transactions) AS tx
+        ),
+        customer_features AS (
+            SELECT
+                d.idx,
+                c.feature_ts,
+                {customer_columns},
+                ROW_NUMBER() OVER (PARTITION BY d.idx ORDER BY c.feature_ts DESC) as rn
+            FROM transaction_data d
+            JOIN `{PROJECT_ID}.{DATASET_ID}.customer_spending_features` c
+            ON c.customer_id = d.customer_id
+            AND c.feature_ts <= d.tx_timestamp
+        ),
+        terminal_features AS (
+            SELECT
+                d.idx,
+                t.feature_ts,
+                {terminal_columns},
+                ROW_NUMBER() OVER (PARTITION BY d.idx ORDER BY t.feature_ts DESC) as rn
+            FROM transaction_data d
+            JOIN `{PROJECT_ID}.{DATASET_ID}.terminal_risk_features` t
+            ON t.terminal_id = d.terminal_id
+            AND t.feature_ts <= d.tx_timestamp
+        )
+        SELECT
+            d.idx,
+            d.tx_amount,
+            {feature_columns},
+            c.feature_ts as customer_feature_ts,
+            t.feature_ts as terminal_feature_ts
+        FROM transaction_data d
+        LEFT JOIN customer_features c ON c.idx = d.idx AND c.rn = 1
+        LEFT JOIN terminal_features t ON t.idx = d.idx AND t.rn = 1
+        """
+
+        job_config = bigquery.QueryJobConfig(query_parameters=[self._transactions_parameter(transactions)])
+
+        try:
+            rows = self.bq_client.query(features_query, job_config=job_config).result()
+
+            features_list = [None] * len(transactions)
+            for row in rows:
+                # idx, FEATURE_COLUMNS, then the two feature_ts
+                idx, *values = row.values()
+                features = dict(zip(FEATURE_COLUMNS, map(float, values)))
+                features_list[idx] = features
+                self._cache_features(transactions[idx], features, values[-2], values[-1])
+
+            missing = [transactions[idx]['TX_ID'] for idx, features in enumerate(features_list) if features is None]
+            if missing:
+                raise ValueError(f"No feature row returned for TX_IDs: {missing}")
+
+            logger.debug("Successfully extracted features for %d transactions", len(transactions))
+            return features_list
+
+        except Exception as e:
+            logger.error("Error extracting batch features: %s; batch TX_IDs: %s",
+                         e, [transaction_data['TX_ID'] for transaction_data in transactions])
+            raise
+
+    @staticmethod
+    def _transactions_parameter(transactions):
+        """@transactions: one STRUCT per transaction; idx maps result rows back to their message"""
+        from google.cloud import bigquery
+
+        return bigquery.ArrayQueryParameter("transactions", "STRUCT", [
+            bigquery.StructQueryParameter(
+                None,
+                bigquery.ScalarQueryParameter("idx", "INT64", idx),
+                bigquery.ScalarQueryParameter("tx_amount", "FLOAT64", float(transaction_data['TX_AMOUNT'])),
+                bigquery.ScalarQueryParameter("terminal_id", "STRING", transaction_data['TERMINAL_ID']),
+                bigquery.ScalarQueryParameter("customer_id", "STRING", transaction_data['CUSTOMER_ID']),
+                bigquery.ScalarQueryParameter("tx_ts", "STRING", transaction_data['TX_TS'])
+            )
+            for idx, transaction_data in enumerate(transactions)
+        ])
+
+    def _query_latest_features_batch(self, transactions):
+        """
+        Feature vectors for one or more transactions from keyed lookups in the
+        latest-feature tables. A half whose latest row is newer than the
+        transaction (a late or replayed message) is read from its view instead
+        Args:
+            transactions: list of dicts containing transaction information
+        Returns:
+            list of feature dicts, in the same order as transactions
+        """
+        from google.cloud import bigquery
+
+        feature_columns = ",\n            ".join(
+            f"COALESCE({alias}.{column}, 0) as {column}"
+            for alias, columns in (("c", CUSTOMER_FEATURE_COLUMNS), ("t", TERMINAL_FEATURE_COLUMNS))
+            for column in columns
+        )
+        features_query = f"""
+        SELECT
+            d.idx,
+            d.tx_amount,
+            {feature_columns},
+            c.feature_ts as customer_feature_ts,
+            t.feature_ts as terminal_feature_ts
+        FROM UNNEST(@transactions) AS d
+        LEFT JOIN `{PROJECT_ID}.{DATASET_ID}.{LATEST_FEATURE_TABLES['customer_spending_features']}` c
+        ON c.customer_id = d.customer_id
+        LEFT JOIN `{PROJECT_ID}.{DATASET_ID}.{LATEST_FEATURE_TABLES['terminal_risk_features']}` t
+        ON t.terminal_id = d.terminal_id
+        """
+        job_config = bigquery.QueryJobConfig(query_parameters=[self._transactions_parameter(transactions)])
+
+        try:
+            rows = self.bq_client.query(features_query, job_config=job_config).result()
+        except Exception as e:
+            logger.error("Error extracting latest features: %s; TX_IDs: %s",
+                         e, [transaction_data['TX_ID'] for transaction_data in transactions])
+            raise
+
+        features_list = [None] * len(transactions)
+        for row in rows:
+            # idx, FEATURE_COLUMNS, then the two feature_ts
+            idx, *values = row.values()
+            transaction_data = transactions[idx]
+            tx_seconds = to_unix_seconds(transaction_data['TX_TS'])
+            features = dict(zip(FEATURE_COLUMNS, map(float, values)))
+            customer_feature_ts, terminal_feature_ts = values[-2], values[-1]
+
+            if customer_feature_ts is not None and to_unix_seconds(customer_feature_ts) > tx_seconds:
+                customer_feature_ts, customer_features = self._query_view_entity_features(
+                    "customer_spending_features", "customer_id", transaction_data['CUSTOMER_ID'],
+                    transaction_data['TX_TS'], CUSTOMER_FEATURE_COLUMNS
+                )
+                features.update(customer_features)
+            if terminal_feature_ts is not None and to_unix_seconds(terminal_feature_ts) > tx_seconds:
+                terminal_feature_ts, terminal_features = self._query_view_entity_features(
+                    "terminal_risk_features", "terminal_id", transaction_data['TERMINAL_ID'],
+                    transaction_data['TX_TS'], TERMINAL_FEATURE_COLUMNS
+                )
+                features.update(terminal_features)
+
+            features_list[idx] = features
+            self._cache_features(transaction_data, features, customer_feature_ts, terminal_feature_ts)
+        return features_list
+
+    def load_window_history(self):
+        """
+        Warm the in-memory window features with the last 15 days of tx.tx and
+        tx.txlabels, the same history the C2 views read
+        Returns:
+            int: number of transactions loaded
+        """
+        history_query = f"""
+        SELECT
+            raw_tx.TX_ID,
+            raw_tx.TX_TS,
+            raw_tx.CUSTOMER_ID,
+            raw_tx.TERMINAL_ID,
+            raw_tx.TX_AMOUNT,
+            raw_lb.TX_FRAUD
+        FROM `{PROJECT_ID}.{DATASET_ID}.tx` raw_tx
+        LEFT JOIN `{PROJECT_ID}.{DATASET_ID}.txlabels` raw_lb
+        ON raw_tx.TX_ID = raw_lb.TX_ID
+        WHERE raw_tx.TX_TS >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {HISTORY_SECONDS} SECOND)
+        ORDER BY raw_tx.TX_TS
+        """
+        rows = self.bq_client.query(history_query).result()
+        loaded = self.window_features.load_history(rows)
+        logger.info("Loaded %d transactions into window features: %s", loaded, self.window_features.stats())
+        return loaded
+
+    def process_label_message(self, message):
+        """
+        Process a fraud label message (ff-txlabels) for the window features
+        Args:
+            message: Pub/Sub message with TX_ID and TX_FRAUD
+        """
+        try:
+            label_data = json.loads(message.data.decode('utf-8'))
+            self.window_features.observe_label(label_data['TX_ID'], int(label_data['TX_FRAUD']))
+            message.ack()
+        except Exception as e:
+            logger.exception("Error processing label message: %s; message data: %s", e, message.data)
+            message.nack()
+
+    def new_deadline(self):
+        """Deadline for a message starting now, or None without a message budget"""
+        if self.hedger is None:
+            return None
+        return Deadline(self.message_budget_seconds)
+
+    def fallback_features(self, transaction_data):
+        """
+        Degraded feature vector: cached halves however stale, 0 for an entity
+        that is not cached (as for an entity without history)
+        """
+        customer_features = terminal_features = None
+        if self.feature_cache is not None:
+            customer_features = self.feature_cache.get_customer(
+                transaction_data['CUSTOMER_ID'], transaction_data['TX_TS'], float("inf"))
+            terminal_features = self.feature_cache.get_terminal(
+                transaction_data['TERMINAL_ID'], transaction_data['TX_TS'], float("inf"))
+        features = {'tx_amount': float(transaction_data['TX_AMOUNT'])}
+        features.update(customer_features or {column: 0.0 for column in CUSTOMER_FEATURE_COLUMNS})
+        features.update(terminal_features or {column: 0.0 for column in TERMINAL_FEATURE_COLUMNS})
+        return features
+
+    def feature_step(self, deadline):
+        """
+        (hedge_after, timeout) of the feature lookup under a deadline, or None
+        if the lookup is local and needs neither
+        """
+        if deadline is None or self.window_features is not None or self.feature_store is not None:
+            return None
+        share = deadline.remaining() * BUDGET_FEATURE_SHARE
+        return share * HEDGE_AFTER_FRACTION, share
+
+    def predict_step(self, deadline):
+        """
+        (hedge_after, timeout) of the prediction under a deadline, or None if
+        scoring is local; timeout is None without a fallback model
+        """
+        if deadline is None or self.local_model is not None:
+            return None
+        share = deadline.remaining()
+        if self.fallback_model is None:
+            # Nothing to fall back to: hedge, but wait for the endpoint
+            return (share * HEDGE_AFTER_FRACTION if share > 0 else None), None
+        return share * HEDGE_AFTER_FRACTION, share
+
+    def get_features_within(self, transaction_data, deadline):
+        """
+        get_features under a message deadline
+        Returns:
+            (features, degraded): degraded is True if the lookup ran out of
+            budget and fallback_features were used
+        """
+        step = self.feature_step(deadline)
+        if step is None:
+            return self.get_features(transaction_data), False
+        hedge_after, timeout = step
+        try:
+            return self.hedger.call("features", self.get_features, (transaction_data,), hedge_after, timeout), False
+        except DeadlineExceeded:
+            logger.warning("Feature lookup of transaction %s ran out of budget; using fallback features",
+                           transaction_data['TX_ID'], extra={'tx_id': transaction_data['TX_ID']})
+            self.metrics.degraded.inc("features")
+            return self.fallback_features(transaction_data), True
+
+    def predict_within(self, features_list, deadline):
+        """
+        predict under a message deadline, scoring with the fallback model
+        once the budget runs out
+        Returns:
+            (list of fraud probabilities, model_version)
+        """
+        step = self.predict_step(deadline)
+        if step is None:
+            return self.predict(features_list)
+        hedge_after, timeout = step
+        try:
+            return self.hedger.call("predict", self.predict, (features_list,), hedge_after, timeout)
+        except DeadlineExceeded:
+            logger.warning("Prediction ran out of budget; scoring with the fallback model")
+            return self.fallback_predict(features_list)
+
+    @staticmethod
+    def degraded_model_version(model_version):
+        """model_version of a prediction made from fallback features"""
+        return model_version + DEGRADED_FEATURES_TAG
+
+    def fallback_predict(self, features_list):
+        """Score with the fallback model, tagging model_version with FALLBACK_MODEL_TAG"""
+        self.metrics.degraded.inc("model")
+        probabilities = self.fallback_model.score_features(features_list)
+        return probabilities, self.fallback_model.model_version + FALLBACK_MODEL_TAG
+
+    def score_shadows(self, transactions, features_list, probabilities, model_version):
+        """
+        Hand a scored batch to the shadow models, if any; returns immediately
+        Args:
+            transactions: decoded transactions
+            features_list: their feature dicts, as sent to the primary model
+            probabilities, model_version: the primary model's result
+        """
+        if self.shadow_scorer is not None:
+            self.shadow_scorer.submit(transactions, features_list, probabilities, model_version)
+
+    def predict(self, features_list):
+        """
+        Score feature vectors with the local model if one is loaded, otherwise
+        with one request to the Vertex AI endpoint
+        Args:
+            features_list: list of feature dicts
+        Returns:
+            (list of fraud probabilities, model_version)
+        """
+        if self.local_model is not None:
+            return self.local_model.score_features(features_list), self.local_model.model_version
+
+        prediction_response = self.endpoint.predict(instances=features_list)
+        if len(prediction_response.predictions) != len(features_list):
+            raise ValueError(
+                f"Expected {len(features_list)} predictions, got {len(prediction_response.predictions)}"
+            )
+        probabilities = [self.parse_prediction_value(pred_value) for pred_value in prediction_response.predictions]
+        return probabilities, prediction_response.deployed_model_id
+
     def extract_prediction_probability(self, prediction_response):
         """
         Extract the fraud probability from the prediction response
@@ -182,8 +923,18 @@ class FraudDetectionProcessor:
         """
         pred_value = prediction_response.predictions[0]
 
-        print(f"Prediction response structure: {pred_value}")
+        logger.debug("Prediction response structure: %s", pred_value)
+
+        return self.parse_prediction_value(pred_value)
 
+    def parse_prediction_value(self, pred_value):
+        """
+        Extract the fraud probability from a single prediction
+        Args:
+            pred_value: One element of the endpoint's predictions list
+        Returns:
+            float: Probability of fraud
+        """
         # BQML logistic regression model returns a specific format
         if isinstance(pred_value, dict):
             if 'tx_fraud_probs' in pred_value:
@@ -204,43 +955,143 @@ class FraudDetectionProcessor:
         else:
             return float(pred_value)
 
-    def save_prediction(self, prediction_data):
+    def prediction_row(self, prediction_data, current_time=None):
         """
-        Save prediction to BigQuery
+        Build an online_fraud_prediction row from a prediction result
         Args:
             prediction_data: dict containing prediction results
+            current_time: datetime used for created_at (defaults to now, UTC)
+        Returns:
+            dict matching the schema of the BigQuery table
         """
-        current_time = datetime.utcnow()
+        if current_time is None:
+            current_time = datetime.utcnow()
 
         # Ensure fraud_probability is a float
         fraud_probability = 0.0
         if prediction_data['fraud_probability'] is not None:
             fraud_probability = float(prediction_data['fraud_probability'])
 
+        self.metrics.observe_event_time_lag(prediction_data['TX_TS'], current_time)
+
         # Match the exact schema of the BigQuery table
-        rows_to_insert = [{
+        return {
             'TX_ID': prediction_data['TX_ID'],
             'prediction_timestamp': prediction_data['TX_TS'],
             'fraud_probability': fraud_probability,
             'is_fraud': bool(fraud_probability > 0.5),
             'model_version': prediction_data['model_version'],
             'created_at': current_time.strftime('%Y-%m-%d %H:%M:%S UTC')
-        }]
+        }
+
+    def save_prediction(self, prediction_data):
+        """
+        Save prediction to BigQuery
+        Args:
+            prediction_data: dict containing prediction results
+        """
+        rows_to_insert = [self.prediction_row(prediction_data)]
 
         try:
-            errors = self.bq_client.insert_rows_json(self.table, rows_to_insert)
+            # TX_ID as insertId lets BigQuery drop rows re-sent after a redelivery
+            errors = self.bq_client.insert_rows_json(self.table, rows_to_insert, row_ids=[prediction_data['TX_ID']])
             if errors:
-                print(f"Encountered errors while inserting rows: {errors}")
-                print(f"Table schema: {[field.name for field in self.table.schema]}")
-                print(f"Attempted to insert: {json.dumps(rows_to_insert, indent=2)}")
+                logger.error("Encountered errors while inserting rows: %s; table schema: %s; attempted to insert: %s",
+                             errors, [field.name for field in self.table.schema], rows_to_insert)
             else:
-                print(f"Successfully inserted prediction for TX_ID: {prediction_data['TX_ID']}")
+                logger.debug("Successfully inserted prediction for TX_ID: %s", prediction_data['TX_ID'],
+                             extra={'tx_id': prediction_data['TX_ID']})
+        except Exception as e:
+            logger.error("Error inserting into BigQuery: %s; table schema: %s; attempted to insert: %s",
+                         e, [field.name for field in self.table.schema], rows_to_insert)
+            raise
+
+    def save_predictions(self, predictions):
+        """
+        Save several predictions to BigQuery with a single streaming insert
+        Args:
+            predictions: list of dicts containing prediction results
+        Returns:
+            set of indexes into predictions whose rows were rejected
+        """
+        current_time = datetime.utcnow()
+        rows_to_insert = [self.prediction_row(prediction_data, current_time) for prediction_data in predictions]
+
+        try:
+            errors = self.bq_client.insert_rows_json(
+                self.table, rows_to_insert, row_ids=[row['TX_ID'] for row in rows_to_insert])
         except Exception as e:
-            print(f"Error inserting into BigQuery: {str(e)}")
-            print(f"Table schema: {[field.name for field in self.table.schema]}")
-            print(f"Attempted to insert: {json.dumps(rows_to_insert, indent=2)}")
+            logger.error("Error inserting into BigQuery: %s; table schema: %s",
+                         e, [field.name for field in self.table.schema])
             raise
 
+        if errors:
+            logger.error("Encountered errors while inserting rows: %s; table schema: %s",
+                         errors, [field.name for field in self.table.schema])
+        else:
+            logger.debug("Successfully inserted %d predictions", len(rows_to_insert))
+        return {error['index'] for error in errors}
+
+    def persist_prediction(self, prediction_data, message):
+        """
+        Save a prediction and ack its message once the row is written. With a
+        prediction writer the row is queued and the message is acked (or
+        nacked) from the writer thread after the flush
+        Args:
+            prediction_data: dict containing prediction results
+            message: Pub/Sub message the prediction belongs to
+        """
+        if self.prediction_writer is None:
+            with self.metrics.stage("persist"):
+                self.save_prediction(prediction_data)
+            self.mark_done(prediction_data['TX_ID'])
+            message.ack()
+            return
+
+        def on_written(written):
+            if written:
+                self.mark_done(prediction_data['TX_ID'])
+                message.ack()
+            else:
+                message.nack()
+
+        # With the writer, persist is the time to queue the row (including backpressure)
+        with self.metrics.stage("persist"):
+            self.prediction_writer.submit(self.prediction_row(prediction_data), on_written)
+
+    def check_redelivery(self, message_data, message):
+        """
+        Look a transaction up in the redelivery index
+        Args:
+            message_data: decoded message
+            message: Pub/Sub message, acked here if the transaction is done
+        Returns:
+            (done, prediction_data): done is True if the row was already written;
+            prediction_data is the prediction of an earlier delivery, or None
+        """
+        if self.redelivery_index is None:
+            return False, None
+        state = self.redelivery_index.lookup(message_data.tx_id)
+        if state is DONE:
+            logger.info("Transaction %s was already processed; acking the redelivery", message_data.tx_id,
+                        extra={'tx_id': message_data.tx_id})
+            self.metrics.redeliveries.inc("skipped")
+            message.ack()
+            return True, None
+        if state is not None:
+            self.metrics.redeliveries.inc("reused")
+        return False, state
+
+    def remember_prediction(self, prediction_data):
+        """Record a computed prediction so a redelivery does not score it again"""
+        if self.redelivery_index is not None:
+            self.redelivery_index.record_prediction(prediction_data)
+
+    def mark_done(self, tx_id):
+        """Record that the prediction row of tx_id has been written"""
+        if self.redelivery_index is not None:
+            self.redelivery_index.mark_done(tx_id)
+
     def process_message(self, message):
         """
         Process a single Pub/Sub message
@@ -248,61 +1099,227 @@ class FraudDetectionProcessor:
             message: Pub/Sub message
         """
         try:
-            message_data = json.loads(message.data.decode('utf-8'))
-            print(f"Processing transaction {message_data['TX_ID']}")
-
-            # Extract features with correct column names directly from the SQL query
-            features = self.get_features(message_data)
-            print(f"Features prepared: {json.dumps(features, indent=2)}")
-
-            # Send features directly to the endpoint - no mapping needed
-            prediction_response = self.endpoint.predict(instances=[features])
-            print(f"Prediction response: {prediction_response.predictions[0]}")
-
-            # Extract fraud probability
-            fraud_probability = self.extract_prediction_probability(prediction_response)
-            print(f"Extracted fraud probability: {fraud_probability}")
-
-            # Prepare prediction result
-            prediction_data = {
-                'TX_ID': message_data['TX_ID'],
-                'TX_TS': message_data['TX_TS'],
-                'fraud_probability': fraud_probability,
-                'model_version': prediction_response.deployed_model_id
-            }
-            print(f"Prediction result: {json.dumps(prediction_data, indent=2)}")
-
-            # Save prediction
-            self.save_prediction(prediction_data)
-
-            # Acknowledge the message
-            message.ack()
-            print(f"Successfully processed transaction {message_data['TX_ID']}")
+            with self.metrics.stage("decode"):
+                message_data = TransactionRecord.from_json(message.data)
+            # Per-message lines are sampled by TX_ID and formatted on the logging thread
+            log_extra = {'tx_id': message_data.tx_id}
+            logger.info("Processing transaction %s", message_data.tx_id, extra=log_extra)
 
-        except Exception as e:
-            print(f"Error processing message: {str(e)}")
-            print(f"Message data: {message.data.decode('utf-8')}")
+            # A redelivery of a finished transaction is only acked; a partly
+            # finished one reuses the prediction of the earlier delivery
+            done, prediction_data = self.check_redelivery(message_data, message)
+            if done:
+                return
+
+            if prediction_data is None:
+                # With MESSAGE_BUDGET_MS the remote steps are hedged and fall back once it is spent
+                deadline = self.new_deadline()
+
+                # Extract features with correct column names directly from the SQL query
+                with self.metrics.stage("features"):
+                    features, degraded = self.get_features_within(message_data, deadline)
+                logger.debug("Features prepared: %s", features, extra=log_extra)
+
+                # Send features directly to the endpoint (or local model) - no mapping needed
+                with self.metrics.stage("predict"):
+                    probabilities, model_version = self.predict_within([features], deadline)
+                if degraded:
+                    model_version = self.degraded_model_version(model_version)
+                fraud_probability = probabilities[0]
+                logger.debug("Extracted fraud probability: %s", fraud_probability, extra=log_extra)
+                if not degraded:
+                    self.score_shadows([message_data], [features], probabilities, model_version)
+
+                # Prepare prediction result
+                prediction_data = {
+                    'TX_ID': message_data.tx_id,
+                    'TX_TS': message_data.tx_ts,
+                    'fraud_probability': fraud_probability,
+                    'model_version': model_version
+                }
+                self.remember_prediction(prediction_data)
+            logger.debug("Prediction result: %s", prediction_data, extra=log_extra)
+
+            # Save prediction and acknowledge the message
+            self.persist_prediction(prediction_data, message)
+            logger.info("Successfully processed transaction %s", message_data.tx_id, extra=log_extra)
 
-            import traceback
-            print("Traceback:", traceback.format_exc())
+        except Exception as e:
+            logger.exception("Error processing message: %s; message data: %s", e, message.data)
 
             # Negative acknowledge the message to retry
             message.nack()
 
-    def start(self, subscription_path):
+    def process_batch(self, messages):
+        """
+        Process a micro-batch of Pub/Sub messages with one feature query, one
+        prediction request and one insert. Each message is acked or nacked
+        according to its own result
+        Args:
+            messages: list of Pub/Sub messages
+        """
+        decoded = []
+        for message in messages:
+            try:
+                with self.metrics.stage("decode"):
+                    decoded.append((message, TransactionRecord.from_json(message.data)))
+            except Exception as e:
+                logger.error("Error decoding message: %s; message data: %s", e, message.data)
+                message.nack()
+
+        # Redeliveries of finished transactions are acked; partly finished ones keep their prediction
+        scored = []
+        pending = []
+        for message, message_data in decoded:
+            done, prediction_data = self.check_redelivery(message_data, message)
+            if prediction_data is not None:
+                scored.append((message, prediction_data))
+            elif not done:
+                pending.append((message, message_data))
+
+        if not scored and not pending:
+            return
+
+        logger.debug("Processing batch of %d transactions", len(pending))
+
+        if pending:
+            try:
+                # Stage timings are per batch here
+                with self.metrics.stage("features"):
+                    features_list = self.get_features_batch([message_data for _, message_data in pending])
+                with self.metrics.stage("predict"):
+                    probabilities, model_version = self.predict(features_list)
+            except Exception as e:
+                # Nothing was scored, so every pending message in the batch has to be retried
+                logger.exception("Error processing batch: %s", e)
+                for message, _ in pending:
+                    message.nack()
+                pending = []
+                probabilities = []
+            else:
+                self.score_shadows([message_data for _, message_data in pending], features_list,
+                                   probabilities, model_version)
+
+            for (message, message_data), fraud_probability in zip(pending, probabilities):
+                prediction_data = {
+                    'TX_ID': message_data.tx_id,
+                    'TX_TS': message_data.tx_ts,
+                    'fraud_probability': fraud_probability,
+                    'model_version': model_version
+                }
+                self.remember_prediction(prediction_data)
+                scored.append((message, prediction_data))
+
+        if not scored:
+            return
+
+        if self.prediction_writer is not None:
+            for message, prediction_data in scored:
+                self.persist_prediction(prediction_data, message)
+            logger.debug("Queued %d of %d predictions", len(scored), len(messages))
+            return
+
+        try:
+            with self.metrics.stage("persist"):
+                failed = self.save_predictions([prediction_data for _, prediction_data in scored])
+        except Exception:
+            logger.exception("Error saving batch predictions")
+            for message, _ in scored:
+                message.nack()
+            return
+
+        for idx, (message, prediction_data) in enumerate(scored):
+            if idx in failed:
+                message.nack()
+            else:
+                self.mark_done(prediction_data['TX_ID'])
+                message.ack()
+        logger.debug("Successfully processed %d of %d transactions", len(scored) - len(failed), len(messages))
+
+    def build_concurrency_controller(self, initial_limit=MAX_IN_FLIGHT_MESSAGES):
+        """
+        AdaptiveConcurrencyController configured from the ADAPTIVE_* settings,
+        watching this processor's prediction writer, if any
+        """
+        from adaptive_concurrency import AdaptiveConcurrencyController
+
+        writer_high_watermark = None
+        if self.prediction_writer is not None:
+            # More than a full batch queued means flushes are not keeping up
+            writer_high_watermark = self.prediction_writer.max_batch_rows
+        concurrency = AdaptiveConcurrencyController(
+            initial_limit=initial_limit,
+            min_limit=ADAPTIVE_MIN_IN_FLIGHT,
+            max_limit=ADAPTIVE_MAX_IN_FLIGHT,
+            target_latency_ms=ADAPTIVE_TARGET_LATENCY_MS,
+            max_error_rate=ADAPTIVE_MAX_ERROR_RATE,
+            endpoint_latency_ms=ADAPTIVE_ENDPOINT_LATENCY_MS if self.local_model is None else None,
+            prediction_writer=self.prediction_writer,
+            writer_high_watermark=writer_high_watermark
+        )
+        self.metrics.gauge(
+            "fraud_inference_concurrency_limit", "Messages the asyncio pipeline may process at once",
+            lambda: concurrency.limit
+        )
+        return concurrency
+
+    def start(self, subscription_path, batch_max_messages=BATCH_MAX_MESSAGES,
+              batch_max_latency_ms=BATCH_MAX_LATENCY_MS, max_in_flight=MAX_IN_FLIGHT_MESSAGES, subscriber=None,
+              adaptive_concurrency=ADAPTIVE_CONCURRENCY):
             """
             Start processing messages from Pub/Sub
             Args:
                 subscription_path: Full path to the Pub/Sub subscription
+                batch_max_messages: Messages per micro-batch (1 disables batching)
+                batch_max_latency_ms: Longest time a message waits for its batch to fill
+                max_in_flight: Messages processed concurrently by the asyncio
+                    pipeline (1 disables it; takes precedence over batching)
+                subscriber: Subscriber client to use instead of the shared one
+                adaptive_concurrency: Adapt the pipeline's in-flight limit at
+                    runtime, starting from max_in_flight (implies the pipeline)
             """
-            subscriber = pubsub_v1.SubscriberClient()
+            from google.cloud import pubsub_v1
+
+            if subscriber is None:
+                subscriber = clients.subscriber_client()
+            batcher = None
+            pipeline = None
+            callback = self.process_message
+            max_messages = 1
+            if adaptive_concurrency:
+                concurrency = self.build_concurrency_controller(max_in_flight)
+                pipeline = AsyncFraudPipeline(self, concurrency=concurrency)
+                pipeline.start_loop()
+                callback = pipeline.submit
+                # Flow control is fixed for the subscription's lifetime; it only bounds the limit
+                max_messages = concurrency.max_limit
+            elif max_in_flight > 1:
+                pipeline = AsyncFraudPipeline(self, max_in_flight)
+                pipeline.start_loop()
+                callback = pipeline.submit
+                max_messages = max_in_flight
+            elif batch_max_messages > 1:
+                batcher = MessageBatcher(self.process_batch, batch_max_messages, batch_max_latency_ms)
+                callback = batcher.add
+                # Leave room for the next batch to fill while the current one is scored
+                max_messages = 2 * batch_max_messages
+            if self.hedger is not None:
+                self.hedger.size_for(max_messages)
+
+            # The subscriber is shared (see clients.py); it is closed by its owner, not here
+            streaming_pull_future = None
+            handler = callback
+
+            def tracked_callback(message):
+                # Every message is counted in flight until some code path acks or nacks it
+                handler(self.metrics.track(message))
 
             try:
-                print(f"Listening for messages on {subscription_path}")
+                logger.info("Listening for messages on %s", subscription_path)
                 streaming_pull_future = subscriber.subscribe(
                     subscription_path,
-                    callback=self.process_message,
-                    flow_control=pubsub_v1.types.FlowControl(max_messages=1)
+                    callback=tracked_callback,
+                    flow_control=pubsub_v1.types.FlowControl(max_messages=max_messages)
                 )
 
                 # Keep the main thread alive
@@ -310,38 +1327,257 @@ class FraudDetectionProcessor:
 
             except KeyboardInterrupt:
                 streaming_pull_future.cancel()
-                subscriber.close()
             except Exception as e:
-                print(f"Error in subscriber: {str(e)}")
-                print("Traceback:", traceback.format_exc())
-                subscriber.close()
+                logger.exception("Error in subscriber: %s", e)
+                if streaming_pull_future is not None:
+                    streaming_pull_future.cancel()
                 raise
+            finally:
+                if batcher is not None:
+                    batcher.close()
+                if pipeline is not None:
+                    pipeline.close()
 
-def main():
-    """Main function to run the processor"""
+
+class MessageBatcher:
+    """
+    Collects Pub/Sub messages and hands them to a handler in micro-batches of
+    up to max_messages, or after max_latency_ms since the first message of the
+    batch arrived, whichever comes first
+    """
+
+    def __init__(self, handler, max_messages=BATCH_MAX_MESSAGES, max_latency_ms=BATCH_MAX_LATENCY_MS):
+        self.handler = handler
+        self.max_messages = max_messages
+        self.max_latency = max_latency_ms / 1000.0
+
+        self._pending = []
+        self._deadline = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="message-batcher", daemon=True)
+        self._thread.start()
+
+    def add(self, message):
+        """Queue a message; used as the Pub/Sub subscriber callback"""
+        with self._condition:
+            if not self._pending:
+                self._deadline = time.monotonic() + self.max_latency
+            self._pending.append(message)
+            if len(self._pending) == 1 or len(self._pending) >= self.max_messages:
+                self._condition.notify()
+
+    def close(self):
+        """Flush whatever is pending and stop the batching thread"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._closed:
+                if self._pending:
+                    remaining = self._deadline - time.monotonic()
+                    if len(self._pending) >= self.max_messages or remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                else:
+                    self._condition.wait()
+
+            batch = self._pending[:self.max_messages]
+            self._pending = self._pending[self.max_messages:]
+            if self._pending:
+                self._deadline = time.monotonic() + self.max_latency
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+            try:
+                self.handler(batch)
+            except Exception as e:
+                logger.exception("Error processing batch: %s", e)
+                for message in batch:
+                    message.nack()
+
+def build_processor():
+    """
+    Build a FraudDetectionProcessor from the configuration above. Called once
+    per process; in the multi-process mode every worker calls it
+    Returns:
+        FraudDetectionProcessor
+    """
+    window_features = StreamingWindowFeatures() if USE_STREAMING_FEATURES else None
+    feature_cache = None
+    if FEATURE_CACHE_MAX_ENTRIES > 0:
+        feature_cache = FeatureCache(FEATURE_CACHE_MAX_ENTRIES, FEATURE_CACHE_MAX_STALENESS_SECONDS)
+    local_model = None
+    if LOCAL_MODEL_PATH:
+        # Pulls in numpy; not needed when scoring on the endpoint
+        from local_model import load_model
+        local_model = load_model(LOCAL_MODEL_PATH)
+    feature_store = None
+    if LOCAL_FEATURE_STORE_PATH:
+        from local_feature_store import LocalFeatureStore
+        feature_store = LocalFeatureStore(LOCAL_FEATURE_STORE_PATH)
+    fallback_model = None
+    if FALLBACK_MODEL_PATH:
+        from local_model import load_model
+        fallback_model = load_model(FALLBACK_MODEL_PATH)
+    redelivery_index = None
+    if REDELIVERY_INDEX_MAX_ENTRIES > 0:
+        redelivery_index = RedeliveryIndex(REDELIVERY_INDEX_MAX_ENTRIES, REDELIVERY_INDEX_TTL_SECONDS)
     processor = FraudDetectionProcessor(
         project_id=PROJECT_ID,
         endpoint_id=ENDPOINT_ID,
-        location=LOCATION
+        location=LOCATION,
+        window_features=window_features,
+        feature_cache=feature_cache,
+        local_model=local_model,
+        latest_feature_tables=USE_LATEST_FEATURE_TABLES,
+        feature_store=feature_store,
+        redelivery_index=redelivery_index,
+        message_budget_ms=MESSAGE_BUDGET_MS,
+        fallback_model=fallback_model
+    )
+    if SHADOW_MODELS:
+        processor.shadow_scorer = build_shadow_scorer(processor)
+    if PREDICTION_WRITER_MAX_ROWS > 0:
+        processor.prediction_writer = PredictionWriter(
+            processor.bq_client, processor.table,
+            PREDICTION_WRITER_MAX_ROWS, PREDICTION_WRITER_MAX_LATENCY_MS, PREDICTION_WRITER_QUEUE_SIZE
+        )
+        processor.metrics.gauge(
+            "fraud_inference_writer_queue_depth", "Prediction rows waiting for the background writer",
+            lambda: processor.prediction_writer.queue_depth
+        )
+    return processor
+
+
+def build_shadow_scorer(processor):
+    """
+    ShadowScorer for the SHADOW_MODELS, writing to SHADOW_BQ_TABLE with the
+    processor's BigQuery client
+    """
+    from shadow_scoring import EndpointModel, LocalShadowModel, ShadowScorer
+
+    models = {}
+    for name, source in SHADOW_MODELS.items():
+        if source.startswith("endpoint:"):
+            endpoint_id = source[len("endpoint:"):]
+            models[name] = EndpointModel(
+                lambda endpoint_id=endpoint_id: clients.vertex_endpoint(endpoint_id, PROJECT_ID, LOCATION),
+                processor.parse_prediction_value)
+        else:
+            from local_model import load_model
+            models[name] = LocalShadowModel(load_model(source))
+    writer = PredictionWriter(
+        processor.bq_client, processor.bq_client.get_table(SHADOW_BQ_TABLE),
+        SHADOW_WRITER_MAX_ROWS, SHADOW_WRITER_MAX_LATENCY_MS, PREDICTION_WRITER_QUEUE_SIZE,
+        row_id=ShadowScorer.row_id
     )
+    logger.info("Shadow models %s write to %s", ", ".join(models), SHADOW_BQ_TABLE)
+    return ShadowScorer(models, writer, SHADOW_WORKERS_PER_MODEL, SHADOW_MAX_BATCH, SHADOW_QUEUE_SIZE,
+                        processor.metrics.shadow)
+
+
+def sync_feature_store(feature_store, bq_client):
+    """Load the local feature store from the C2 views and keep it up to date"""
+    # Also catches up on labels that arrived while the process was down
+    loaded = feature_store.resync_labels(bq_client, PROJECT_ID, DATASET_ID, LOCAL_FEATURE_STORE_RESYNC_SECONDS)
+    logger.info("Loaded %d feature rows into %s: %s", loaded, feature_store.path, feature_store.stats())
+    feature_store.start_sync(bq_client, PROJECT_ID, DATASET_ID, LOCAL_FEATURE_STORE_SYNC_SECONDS,
+                             LOCAL_FEATURE_STORE_SYNC_LAG_SECONDS, LOCAL_FEATURE_STORE_RESYNC_INTERVAL_SECONDS,
+                             LOCAL_FEATURE_STORE_RESYNC_SECONDS)
+
+
+def run_sharded():
+    """Run WORKER_PROCESSES worker processes behind one subscription"""
+    from sharded import ShardedSupervisor
 
-    # Callback function for received messages
-    def callback(message):
-        processor.process_message(message)
+    if USE_STREAMING_FEATURES:
+        # A worker only sees its own customers, so its terminal windows would miss transactions
+        raise ValueError("USE_STREAMING_FEATURES is not supported with WORKER_PROCESSES > 1")
 
-    # Start subscribing to messages
-    streaming_pull_future = subscriber.subscribe(
-        SUBSCRIPTION_PATH, callback=callback
+    feature_store = None
+    if LOCAL_FEATURE_STORE_PATH:
+        # One writer for the file; the workers only read it
+        from local_feature_store import LocalFeatureStore
+        feature_store = LocalFeatureStore(LOCAL_FEATURE_STORE_PATH)
+        sync_feature_store(feature_store, clients.bigquery_client(PROJECT_ID))
+
+    supervisor = ShardedSupervisor(
+        WORKER_PROCESSES, build_processor, WORKER_LANES, LOG_LEVEL, LOG_SAMPLE_RATE
     )
-    print(f"Listening for messages on {SUBSCRIPTION_PATH}")
+    metrics_server = None
+    if METRICS_PORT > 0:
+        metrics_server = MetricsServer(supervisor.metrics.registry, METRICS_PORT, METRICS_HOST).start()
+        logger.info("Serving metrics on http://%s:%d/metrics", METRICS_HOST, metrics_server.port)
+    try:
+        supervisor.run(SUBSCRIPTION_PATH)
+    finally:
+        clients.close_subscriber()
+        if feature_store is not None:
+            feature_store.close()
+        if metrics_server is not None:
+            metrics_server.close()
+
+
+def main():
+    """Main function to run the processor"""
+    background_logging = configure_logging(LOG_LEVEL, LOG_SAMPLE_RATE)
+    authenticate()
+
+    if WORKER_PROCESSES > 1:
+        try:
+            run_sharded()
+        finally:
+            background_logging.stop()
+        return
+
+    processor = build_processor()
+
+    metrics_server = None
+    if METRICS_PORT > 0:
+        metrics_server = MetricsServer(processor.metrics.registry, METRICS_PORT, METRICS_HOST).start()
+        logger.info("Serving metrics on http://%s:%d/metrics", METRICS_HOST, metrics_server.port)
+
+    # Resolve endpoint and table schema before the first message arrives
+    processor.warm_up()
+
+    if processor.feature_store is not None:
+        sync_feature_store(processor.feature_store, processor.bq_client)
+
+    subscriber = clients.subscriber_client()
+    labels_pull_future = None
+    if processor.window_features is not None:
+        processor.load_window_history()
+        labels_pull_future = subscriber.subscribe(
+            LABELS_SUBSCRIPTION_PATH, callback=processor.process_label_message
+        )
+        logger.info("Listening for labels on %s", LABELS_SUBSCRIPTION_PATH)
 
     try:
-        # Keep the main thread alive
-        while True:
-            time.sleep(60)
-    except KeyboardInterrupt:
-        streaming_pull_future.cancel()
-        subscriber.close()
+        # Single flow-controlled subscription; blocks until interrupted
+        processor.start(SUBSCRIPTION_PATH)
+    finally:
+        if labels_pull_future is not None:
+            labels_pull_future.cancel()
+        clients.close_subscriber()
+        if processor.feature_store is not None:
+            processor.feature_store.close()
+        if processor.prediction_writer is not None:
+            processor.prediction_writer.close()
+            logger.info("Prediction writer: %s", processor.prediction_writer.stats())
+        if processor.shadow_scorer is not None:
+            processor.shadow_scorer.close()
+            logger.info("Shadow models: %s", processor.shadow_scorer.stats())
+        if metrics_server is not None:
+            metrics_server.close()
+        background_logging.stop()
 
 # Run the main function
 if __name__ == "__main__":
@@ -0,0 +1,290 @@
+# Embedded SQLite feature store with point-in-time lookups, usable as a feature backend
+import itertools
+import logging
+import sqlite3
+import threading
+import time
+
+from window_features import HISTORY_SECONDS, LABEL_DELAY_SECONDS, WINDOW_SECONDS, to_unix_seconds
+
+logger = logging.getLogger(__name__)
+
+CUSTOMER_COLUMNS = [
+    column
+    for window in WINDOW_SECONDS
+    for column in (f"customer_id_nb_tx_{window}_window", f"customer_id_avg_amount_{window}_window")
+]
+TERMINAL_COLUMNS = [
+    column
+    for window in WINDOW_SECONDS
+    for column in (f"terminal_id_nb_tx_{window}_window", f"terminal_id_risk_{window}_window")
+]
+
+# Store table -> (C2 view it mirrors, id column of the view, feature columns)
+ENTITIES = {
+    "customer_features": ("customer_spending_features", "customer_id", CUSTOMER_COLUMNS),
+    "terminal_features": ("terminal_risk_features", "terminal_id", TERMINAL_COLUMNS),
+}
+
+# Rows written this long before the newest synced row are read again by every sync
+SYNC_LAG_SECONDS = 300
+
+_memory_ids = itertools.count()
+
+
+class LocalFeatureStore:
+    """
+    Customer and terminal feature rows in a local SQLite file, keyed on
+    (entity_id, feature_ts) in WITHOUT ROWID tables, so "latest row with
+    feature_ts <= tx_ts" is a single B-tree seek, like the view query:
+
+        SELECT ... WHERE entity_id = ? AND feature_ts <= ?
+        ORDER BY feature_ts DESC LIMIT 1
+
+    Rows come from bulk_load / append, or from the C2 views with
+    sync_from_bigquery (rows since the newest one, less a short lag) and
+    resync_labels (the whole label delay, on a much rarer schedule). Each
+    thread gets its own connection; the file is opened in WAL mode and memory-mapped so readers never wait for the
+    appender. path=":memory:" keeps everything in memory (shared by all
+    threads of the process), which needs no file and no BigQuery
+    """
+
+    def __init__(self, path, mmap_size=1 << 30):
+        if path == ":memory:":
+            self._uri = f"file:local-feature-store-{next(_memory_ids)}?mode=memory&cache=shared"
+        else:
+            self._uri = f"file:{path}"
+        self.path = path
+        self.mmap_size = mmap_size
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._sync_thread = None
+        self._sync_stop = threading.Event()
+
+        # Also keeps a shared in-memory database alive
+        self._owner = self._connect()
+        with self._owner:
+            for table, (_, _, columns) in ENTITIES.items():
+                column_definitions = ",\n".join(f"    {column} REAL" for column in columns)
+                self._owner.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    entity_id TEXT NOT NULL,
+                    feature_ts INTEGER NOT NULL,
+                {column_definitions},
+                    PRIMARY KEY (entity_id, feature_ts)
+                ) WITHOUT ROWID
+                """)
+
+    def _connect(self):
+        connection = sqlite3.connect(self._uri, uri=True, timeout=30.0, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        return connection
+
+    @property
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = self._connect()
+        return connection
+
+    def close(self):
+        """Stop syncing and close this thread's connections"""
+        self.stop_sync()
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+        self._owner.close()
+
+    # Writes -------------------------------------------------------------------------------------------------------
+
+    def bulk_load(self, table, rows):
+        """
+        Insert many feature rows in one transaction (initial load)
+        Args:
+            table: "customer_features" or "terminal_features"
+            rows: iterable of mappings with the view's id column, feature_ts
+                and feature columns (bigquery.Row works)
+        Returns:
+            int: number of rows written
+        """
+        _, id_column, columns = ENTITIES[table]
+        placeholders = ", ".join(["?"] * (len(columns) + 2))
+        statement = f"INSERT OR REPLACE INTO {table} VALUES ({placeholders})"
+
+        def records():
+            for row in rows:
+                yield (
+                    str(row[id_column]),
+                    to_unix_seconds(row['feature_ts']),
+                    *(None if row[column] is None else float(row[column]) for column in columns)
+                )
+
+        with self._write_lock:
+            connection = self._connection
+            before = connection.total_changes
+            with connection:
+                connection.executemany(statement, records())
+            return connection.total_changes - before
+
+    def append(self, table, entity_id, feature_ts, features):
+        """Insert or replace one feature row (incremental update)"""
+        _, id_column, columns = ENTITIES[table]
+        row = dict(features)
+        row[id_column] = entity_id
+        row['feature_ts'] = feature_ts
+        self.bulk_load(table, [row])
+
+    def prune(self, older_than_seconds=HISTORY_SECONDS, now=None):
+        """Delete rows older than the views' history"""
+        cutoff = int((now if now is not None else time.time()) - older_than_seconds)
+        with self._write_lock:
+            connection = self._connection
+            with connection:
+                deleted = 0
+                for table in ENTITIES:
+                    deleted += connection.execute(f"DELETE FROM {table} WHERE feature_ts < ?", (cutoff,)).rowcount
+        return deleted
+
+    def max_feature_ts(self, table):
+        """Newest feature_ts in a table, or None if it is empty"""
+        return self._connection.execute(f"SELECT MAX(feature_ts) FROM {table}").fetchone()[0]
+
+    def sync_from_bigquery(self, bq_client, project_id, dataset_id, lag_seconds=SYNC_LAG_SECONDS):
+        """
+        Upsert the view rows from lag_seconds before the newest feature_ts
+        the store already holds; on an empty store this is the initial bulk
+        load of the last 15 days. The lag catches transactions that land in
+        tx.tx a little late; rows changed by labels are left to resync_labels
+        Args:
+            bq_client: BigQuery client
+            project_id, dataset_id: location of the C2 views
+            lag_seconds: how far behind the newest row to read again
+        Returns:
+            int: rows written (inserted or replaced)
+        """
+        return sum(
+            self._sync_table(bq_client, project_id, dataset_id, table, lag_seconds)
+            for table in ENTITIES
+        )
+
+    def resync_labels(self, bq_client, project_id, dataset_id, resync_seconds=LABEL_DELAY_SECONDS):
+        """
+        Upsert every view row of the last resync_seconds. Labels arrive up to
+        LABEL_DELAY_SECONDS after their transaction and change the counts and
+        risks of rows that were already synced; tx.txlabels has no arrival
+        time to read a delta from, so the whole delay is read again. This
+        costs about half of the views' history, so run it far less often
+        than sync_from_bigquery
+        Returns:
+            int: rows written (inserted or replaced)
+        """
+        return sum(
+            self._sync_table(bq_client, project_id, dataset_id, table, resync_seconds)
+            for table in ENTITIES
+        )
+
+    def _sync_table(self, bq_client, project_id, dataset_id, table, trailing_seconds):
+        from google.cloud import bigquery
+
+        view, id_column, columns = ENTITIES[table]
+        newest = self.max_feature_ts(table)
+        since = newest - trailing_seconds if newest is not None else 0
+        feature_columns = ",\n            ".join(columns)
+        query = f"""
+        SELECT
+            {id_column},
+            feature_ts,
+            {feature_columns}
+        FROM `{project_id}.{dataset_id}.{view}`
+        WHERE feature_ts >= TIMESTAMP_SECONDS(@since)
+        """
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter("since", "INT64", since)
+        ])
+        rows = bq_client.query(query, job_config=job_config).result(page_size=50000)
+        # stop_sync does not wait for the rest of a long read; the rows are upserts, so a cut is harmless
+        rows = itertools.takewhile(lambda _: not self._sync_stop.is_set(), rows)
+        loaded = self.bulk_load(table, rows)
+        logger.info("Synced %d rows from %s into %s", loaded, view, table)
+        return loaded
+
+    def start_sync(self, bq_client, project_id, dataset_id, interval_seconds=60.0, lag_seconds=SYNC_LAG_SECONDS,
+                   resync_interval_seconds=6 * 3600, resync_seconds=LABEL_DELAY_SECONDS):
+        """
+        Call sync_from_bigquery (and prune) every interval_seconds on a daemon
+        thread, and resync_labels instead once every resync_interval_seconds
+        (0 never re-reads the label delay)
+        """
+        def run():
+            last_resync = time.monotonic()
+            while not self._sync_stop.wait(interval_seconds):
+                try:
+                    if resync_interval_seconds and time.monotonic() - last_resync >= resync_interval_seconds:
+                        last_resync = time.monotonic()
+                        self.resync_labels(bq_client, project_id, dataset_id, resync_seconds)
+                    else:
+                        self.sync_from_bigquery(bq_client, project_id, dataset_id, lag_seconds)
+                    self.prune()
+                except Exception as e:
+                    logger.exception("Error syncing the local feature store: %s", e)
+
+        self._sync_stop.clear()
+        self._sync_thread = threading.Thread(target=run, name="feature-store-sync", daemon=True)
+        self._sync_thread.start()
+
+    def stop_sync(self):
+        if self._sync_thread is not None:
+            self._sync_stop.set()
+            self._sync_thread.join()
+            self._sync_thread = None
+
+    # Reads --------------------------------------------------------------------------------------------------------
+
+    def lookup(self, table, entity_id, tx_ts):
+        """
+        Latest feature row of an entity with feature_ts <= tx_ts
+        Returns:
+            (feature_ts, features) - feature_ts is None and every feature 0 if there is no row
+        """
+        _, _, columns = ENTITIES[table]
+        row = self._connection.execute(
+            f"SELECT feature_ts, {', '.join(columns)} FROM {table} "
+            f"WHERE entity_id = ? AND feature_ts <= ? ORDER BY feature_ts DESC LIMIT 1",
+            (str(entity_id), to_unix_seconds(tx_ts))
+        ).fetchone()
+        if row is None:
+            return None, {column: 0.0 for column in columns}
+        # NULL features are COALESCEd to 0 like the online query does
+        return row[0], {column: value or 0.0 for column, value in zip(columns, row[1:])}
+
+    def customer_features(self, customer_id, tx_ts):
+        return self.lookup("customer_features", customer_id, tx_ts)[1]
+
+    def terminal_features(self, terminal_id, tx_ts):
+        return self.lookup("terminal_features", terminal_id, tx_ts)[1]
+
+    def get_features(self, transaction_data):
+        """
+        Feature vector for a transaction, as FraudDetectionProcessor.get_features
+        Args:
+            transaction_data: dict containing transaction information
+        Returns:
+            dict of features ready to send to the model
+        """
+        features = {'tx_amount': float(transaction_data['TX_AMOUNT'])}
+        features.update(self.customer_features(transaction_data['CUSTOMER_ID'], transaction_data['TX_TS']))
+        features.update(self.terminal_features(transaction_data['TERMINAL_ID'], transaction_data['TX_TS']))
+        return features
+
+    def get_features_batch(self, transactions):
+        return [self.get_features(transaction_data) for transaction_data in transactions]
+
+    def stats(self):
+        connection = self._connection
+        return {
+            table: connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in ENTITIES
+        }
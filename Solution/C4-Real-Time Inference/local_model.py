@@ -0,0 +1,272 @@
+# In-process scoring of exported BQML models (logistic regression, boosted trees, k-means)
+import json
+
+import numpy as np
+
+
+def _sigmoid(margin):
+    return 1.0 / (1.0 + np.exp(-margin))
+
+
+class LocalModel:
+    """
+    Base class for local scorers. Subclasses implement predict_proba on a 2-D
+    array whose columns follow feature_names
+    """
+
+    model_type = None
+
+    def __init__(self, feature_names, model_version):
+        self.feature_names = list(feature_names)
+        self.model_version = model_version
+
+    def predict_proba(self, X):
+        raise NotImplementedError
+
+    def to_matrix(self, features_list):
+        """
+        Stack feature dicts into a float matrix in feature_names order.
+        Missing features become NaN
+        """
+        names = self.feature_names
+        # One pass per row in a fixed column order; None becomes NaN in the float conversion
+        return np.array([[features.get(name) for name in names] for features in features_list],
+                        dtype=float).reshape(len(features_list), len(names))
+
+    def score_features(self, features_list):
+        """
+        Score feature dicts as sent to the Vertex AI endpoint
+        Args:
+            features_list: list of feature dicts
+        Returns:
+            list of fraud probabilities
+        """
+        if not features_list:
+            return []
+        return self.predict_proba(self.to_matrix(features_list)).tolist()
+
+
+class LogisticRegressionModel(LocalModel):
+    """
+    Scores a BQML LOGISTIC_REG model from its ML.WEIGHTS output:
+
+        SELECT processed_input, weight
+        FROM ML.WEIGHTS(MODEL `tx.fraud_detection_logreg`)
+
+    The weights are the unstandardized log-odds of tx_fraud = 1; the
+    __INTERCEPT__ row is the bias. BQML replaces a NULL numerical input with
+    its training mean, from the mean column of ML.FEATURE_INFO
+    """
+
+    model_type = "logistic_reg"
+
+    def __init__(self, weights, intercept, means=None, model_version="local-logreg"):
+        """
+        Args:
+            weights: dict of feature name -> weight
+            intercept: bias
+            means: dict of feature name -> training mean used for NULL inputs;
+                without it rows with a missing feature are rejected
+            model_version: version reported with the predictions
+        """
+        super().__init__(weights.keys(), model_version)
+        self.weights = np.array(list(weights.values()), dtype=float)
+        self.intercept = float(intercept)
+        self.means = None
+        if means is not None:
+            self.means = np.array([means[name] for name in self.feature_names], dtype=float)
+
+    @classmethod
+    def from_artifact(cls, artifact):
+        weights = {}
+        intercept = 0.0
+        for row in artifact['weights']:
+            if row['processed_input'] == '__INTERCEPT__':
+                intercept = row['weight']
+            else:
+                weights[row['processed_input']] = row['weight']
+        means = None
+        if 'feature_info' in artifact:
+            means = {row['input']: row['mean'] for row in artifact['feature_info']}
+        return cls(weights, intercept, means, artifact.get('model_version', "local-logreg"))
+
+    def predict_proba(self, X):
+        X = np.asarray(X, dtype=float)
+        missing = np.isnan(X)
+        if missing.any():
+            if self.means is None:
+                raise ValueError("Missing feature values and no training means in the artifact; "
+                                 "re-export it with feature_info (see export_local_models.sql)")
+            X = np.where(missing, self.means, X)
+        return _sigmoid(X @ self.weights + self.intercept)
+
+
+class BoostedTreeModel(LocalModel):
+    """
+    Scores a BQML BOOSTED_TREE_CLASSIFIER model from an XGBoost JSON dump.
+    EXPORT MODEL writes model.bst and assets/model_metadata.json; the dump is
+    xgboost.Booster(model_file="model.bst").get_dump(dump_format="json").
+
+    All trees are flattened into node arrays and every row walks every tree
+    at once, one tree level per iteration
+    """
+
+    model_type = "boosted_tree_classifier"
+
+    def __init__(self, trees, feature_names, base_score=0.5, model_version="local-xgboost"):
+        super().__init__(feature_names, model_version)
+        self.base_margin = float(np.log(base_score / (1.0 - base_score)))
+
+        feature_index = {name: idx for idx, name in enumerate(self.feature_names)}
+        split, threshold, yes, no, missing, leaf, is_leaf, roots = [], [], [], [], [], [], [], []
+        self.max_depth = 0
+
+        for tree in trees:
+            if isinstance(tree, str):
+                tree = json.loads(tree)
+            offset = len(split)
+            nodes = {}
+            stack = [(tree, 0)]
+            while stack:
+                node, depth = stack.pop()
+                nodes[node['nodeid']] = node
+                self.max_depth = max(self.max_depth, depth)
+                stack.extend((child, depth + 1) for child in node.get('children', []))
+
+            # Node ids are not contiguous once a tree is pruned
+            position = {nodeid: offset + idx for idx, nodeid in enumerate(sorted(nodes))}
+            for nodeid in sorted(nodes):
+                node = nodes[nodeid]
+                if 'leaf' in node:
+                    split.append(0)
+                    threshold.append(0.0)
+                    yes.append(position[nodeid])
+                    no.append(position[nodeid])
+                    missing.append(position[nodeid])
+                    leaf.append(float(node['leaf']))
+                    is_leaf.append(True)
+                else:
+                    split.append(self._feature_position(node['split'], feature_index))
+                    threshold.append(float(node['split_condition']))
+                    yes.append(position[node['yes']])
+                    no.append(position[node['no']])
+                    missing.append(position[node.get('missing', node['yes'])])
+                    leaf.append(0.0)
+                    is_leaf.append(False)
+            roots.append(position[tree['nodeid']])
+
+        self.split = np.array(split, dtype=np.intp)
+        # XGBoost compares in single precision
+        self.threshold = np.array(threshold, dtype=np.float32)
+        self.yes = np.array(yes, dtype=np.intp)
+        self.no = np.array(no, dtype=np.intp)
+        self.missing = np.array(missing, dtype=np.intp)
+        self.leaf = np.array(leaf)
+        self.is_leaf = np.array(is_leaf, dtype=bool)
+        self.roots = np.array(roots, dtype=np.intp)
+
+    @classmethod
+    def from_artifact(cls, artifact):
+        return cls(
+            artifact['trees'],
+            artifact['feature_names'],
+            artifact.get('base_score', 0.5),
+            artifact.get('model_version', "local-xgboost"),
+        )
+
+    @staticmethod
+    def _feature_position(split, feature_index):
+        if split in feature_index:
+            return feature_index[split]
+        # Dumps without feature names use f0, f1, ...
+        if split.startswith('f') and split[1:].isdigit():
+            return int(split[1:])
+        raise ValueError(f"Unknown split feature {split}")
+
+    def predict_proba(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        n_rows = X.shape[0]
+        rows = np.arange(n_rows)[:, None]
+        node = np.broadcast_to(self.roots, (n_rows, len(self.roots))).copy()
+        for _ in range(self.max_depth):
+            values = X[rows, self.split[node]]
+            next_node = np.where(values < self.threshold[node], self.yes[node], self.no[node])
+            next_node = np.where(np.isnan(values), self.missing[node], next_node)
+            node = np.where(self.is_leaf[node], node, next_node)
+        return _sigmoid(self.leaf[node].sum(axis=1) + self.base_margin)
+
+
+class KMeansModel(LocalModel):
+    """
+    Anomaly scores from a BQML KMEANS model, from
+
+        SELECT centroid_id, feature, numerical_value
+        FROM ML.CENTROIDS(MODEL `tx.fraud_detection_kmeans`, STRUCT(TRUE AS standardize))
+
+    and the mean/stddev columns of ML.FEATURE_INFO. k-means has no fraud
+    probability: the score is d / (d + distance_threshold), where d is the
+    standardized distance to the nearest centroid, so a transaction at the
+    anomaly threshold scores 0.5 (the is_fraud cut-off of online_fraud_prediction)
+    """
+
+    model_type = "kmeans"
+
+    def __init__(self, centroids, means, stddevs, feature_names, distance_threshold,
+                 model_version="local-kmeans"):
+        super().__init__(feature_names, model_version)
+        self.centroids = np.asarray(centroids, dtype=float)
+        self.means = np.asarray(means, dtype=float)
+        # Constant features are not scaled by BQML
+        stddevs = np.asarray(stddevs, dtype=float)
+        self.stddevs = np.where(stddevs > 0, stddevs, 1.0)
+        self.distance_threshold = float(distance_threshold)
+
+    @classmethod
+    def from_artifact(cls, artifact):
+        feature_info = {row['input']: row for row in artifact['feature_info']}
+        feature_names = sorted({row['feature'] for row in artifact['centroids']})
+        centroid_ids = sorted({row['centroid_id'] for row in artifact['centroids']})
+        position = {name: idx for idx, name in enumerate(feature_names)}
+        centroids = np.zeros((len(centroid_ids), len(feature_names)))
+        for row in artifact['centroids']:
+            centroids[centroid_ids.index(row['centroid_id']), position[row['feature']]] = row['numerical_value']
+        return cls(
+            centroids,
+            [feature_info[name]['mean'] for name in feature_names],
+            [feature_info[name]['stddev'] for name in feature_names],
+            feature_names,
+            artifact['distance_threshold'],
+            artifact.get('model_version', "local-kmeans"),
+        )
+
+    def distances(self, X):
+        """Standardized distance of every row to its nearest centroid"""
+        Z = (np.where(np.isnan(X), self.means, X) - self.means) / self.stddevs
+        squared = ((Z[:, None, :] - self.centroids[None, :, :]) ** 2).sum(axis=2)
+        return np.sqrt(squared.min(axis=1))
+
+    def predict_proba(self, X):
+        d = self.distances(X)
+        return d / (d + self.distance_threshold)
+
+
+MODEL_TYPES = {
+    cls.model_type: cls for cls in (LogisticRegressionModel, BoostedTreeModel, KMeansModel)
+}
+
+
+def load_model(path):
+    """
+    Load a local scorer from a JSON artifact with a model_type of
+    logistic_reg, boosted_tree_classifier or kmeans
+    Args:
+        path: path to the JSON artifact
+    Returns:
+        LocalModel
+    """
+    with open(path) as f:
+        artifact = json.load(f)
+    model_type = artifact['model_type'].lower()
+    if model_type not in MODEL_TYPES:
+        raise ValueError(f"Unsupported model_type {artifact['model_type']}, expected one of {sorted(MODEL_TYPES)}")
+    return MODEL_TYPES[model_type].from_artifact(artifact)
@@ -0,0 +1,108 @@
+# Background, per-transaction sampled logging for the online inference loop
+import logging
+import logging.handlers
+import queue
+import sys
+import zlib
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(threadName)s %(name)s: %(message)s"
+
+
+def is_sampled(tx_id, sample_rate):
+    """
+    Deterministic per-transaction sampling: every log line of a sampled TX_ID
+    is kept, so a message can always be followed end to end
+    """
+    if sample_rate >= 1.0:
+        return True
+    if sample_rate <= 0.0:
+        return False
+    return zlib.crc32(str(tx_id).encode('utf-8')) % 10000 < sample_rate * 10000
+
+
+class TransactionSampler(logging.Filter):
+    """
+    Keeps records below WARNING only for sampled transactions (records logged
+    with extra={'tx_id': ...}). Warnings and errors always pass
+    """
+
+    def __init__(self, sample_rate):
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        tx_id = getattr(record, 'tx_id', None)
+        return tx_id is None or is_sampled(tx_id, self.sample_rate)
+
+
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves all formatting (message arguments, tracebacks)
+    to the listener thread. Below WARNING a full queue drops the record
+    instead of blocking the caller; warnings and errors wait for room
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The default prepare formats the record on the calling thread
+        return record
+
+    def enqueue(self, record):
+        if record.levelno >= logging.WARNING:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BackgroundLogging:
+    """Handle returned by configure_logging; stop() flushes the queue"""
+
+    def __init__(self, handler, listener):
+        self.handler = handler
+        self.listener = listener
+
+    @property
+    def dropped(self):
+        return self.handler.dropped
+
+    def stop(self):
+        self.listener.stop()
+        logging.getLogger().removeHandler(self.handler)
+
+
+def configure_logging(level="INFO", sample_rate=1.0, stream=None, max_queue_size=10000):
+    """
+    Route every log record through a queue to a stream handler on a
+    background thread
+    Args:
+        level: root log level
+        sample_rate: fraction of TX_IDs whose INFO/DEBUG lines are kept
+        stream: output stream (defaults to stdout)
+        max_queue_size: records buffered before INFO/DEBUG lines are dropped
+    Returns:
+        BackgroundLogging
+    """
+    stream_handler = logging.StreamHandler(stream if stream is not None else sys.stdout)
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    log_queue = queue.Queue(maxsize=max_queue_size)
+    handler = BackgroundQueueHandler(log_queue)
+    handler.addFilter(TransactionSampler(sample_rate))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    return BackgroundLogging(handler, listener)
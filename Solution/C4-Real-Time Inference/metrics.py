@@ -0,0 +1,378 @@
+# In-process metrics for the online inference loop, served in Prometheus text format
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from window_features import to_unix_seconds
+
+# Remote calls take milliseconds to seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Event-time lag also covers backlogs and replays
+LAG_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0, 86400.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Family:
+    """
+    Picklable snapshot of a metric family, so metrics of other processes can be
+    served alongside this one's. series maps label values to the value, or
+    for a histogram to (count per bucket, last one +Inf; sum)
+    """
+
+    def __init__(self, name, metric_type, documentation, label_names, series, buckets=()):
+        self.name = name
+        self.metric_type = metric_type
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.series = series
+        self.buckets = tuple(buckets)
+
+    def with_label(self, name, value):
+        """The same family with one more label, e.g. the worker it came from"""
+        series = {(value,) + labels: sample for labels, sample in self.series.items()}
+        return Family(self.name, self.metric_type, self.documentation, (name,) + self.label_names, series,
+                      self.buckets)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+
+    def samples(self):
+        if self.metric_type != "histogram":
+            return [f"{self.name}{_format_labels(self.label_names, labels)} {_format_value(value)}"
+                    for labels, value in sorted(self.series.items())]
+        lines = []
+        for labels, (counts, total) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = _format_labels(self.label_names, labels, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+
+def _format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    """A metric family; one series per combination of label values"""
+
+    metric_type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+
+    def render(self):
+        family = self.snapshot()
+        return family.header() + family.samples()
+
+    def snapshot(self):
+        return Family(self.name, self.metric_type, self.documentation, self.label_names, self._series())
+
+    def _series(self):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def __init__(self, name, documentation, label_names=()):
+        super().__init__(name, documentation, label_names)
+        self._values = {}
+
+    def inc(self, *label_values, amount=1.0):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def value(self, *label_values):
+        with self._lock:
+            return self._values.get(label_values, 0.0)
+
+    def _series(self):
+        with self._lock:
+            return dict(self._values)
+
+
+class Gauge(Metric):
+    """A value that goes up and down, or is computed by a function when scraped"""
+
+    metric_type = "gauge"
+
+    def __init__(self, name, documentation, function=None):
+        super().__init__(name, documentation)
+        self._value = 0.0
+        self._function = function
+
+    def inc(self, amount=1.0):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1.0):
+        with self._lock:
+            self._value -= amount
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+    def set_function(self, function):
+        self._function = function
+
+    def value(self):
+        if self._function is not None:
+            return self._function()
+        with self._lock:
+            return self._value
+
+    def _series(self):
+        return {(): self.value()}
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+        # Per series: [count per bucket (last one is +Inf), sum]
+        self._series_values = {}
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series_values.get(label_values)
+            if series is None:
+                series = self._series_values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        """Observe the duration of the with block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def snapshot(self):
+        return Family(self.name, self.metric_type, self.documentation, self.label_names, self._series(), self.buckets)
+
+    def _series(self):
+        with self._lock:
+            return {labels: (list(counts), total) for labels, (counts, total) in self._series_values.items()}
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """Also serve the Family snapshots returned by collector() on every scrape"""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def snapshot(self):
+        """Family snapshots of the registered metrics"""
+        with self._lock:
+            metrics = list(self._metrics)
+        return [metric.snapshot() for metric in metrics]
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        with self._lock:
+            collectors = list(self._collectors)
+        families = self.snapshot()
+        for collector in collectors:
+            families.extend(collector())
+        # Families of the same name (from other processes) share one HELP/TYPE header
+        by_name = {}
+        for family in families:
+            by_name.setdefault(family.name, []).append(family)
+        lines = []
+        for same_name in by_name.values():
+            lines.extend(same_name[0].header())
+            for family in same_name:
+                lines.extend(family.samples())
+        return "\n".join(lines) + "\n"
+
+
+class TrackedMessage:
+    """
+    Wraps a Pub/Sub message so its ack or nack is timed and counted, whichever
+    code path (serial, micro-batch, async pipeline or prediction writer)
+    settles it. Everything else is delegated to the wrapped message
+    """
+
+    def __init__(self, message, metrics):
+        self._message = message
+        self._metrics = metrics
+        self._received_at = time.perf_counter()
+        self._settled = False
+        metrics.in_flight.inc()
+
+    def __getattr__(self, name):
+        return getattr(self._message, name)
+
+    def ack(self):
+        self._settle(self._message.ack, "acked")
+
+    def nack(self):
+        self._settle(self._message.nack, "nacked")
+
+    def _settle(self, settle, outcome):
+        if self._settled:
+            # Pub/Sub ignores all but the first ack/nack; so do the metrics
+            settle()
+            return
+        self._settled = True
+        started = time.perf_counter()
+        settle()
+        finished = time.perf_counter()
+        metrics = self._metrics
+        metrics.stage_seconds.observe(finished - started, "ack")
+        metrics.message_seconds.observe(finished - self._received_at)
+        metrics.messages.inc(outcome)
+        metrics.in_flight.dec()
+
+
+class InferenceMetrics:
+    """
+    Metrics of the inference loop:
+
+    - fraud_inference_stage_seconds{stage}: decode, features, predict, persist and ack
+    - fraud_inference_message_seconds: message received to acked/nacked
+    - fraud_inference_messages_in_flight: received but not yet acked/nacked
+    - fraud_inference_messages_total{outcome} and fraud_inference_nack_ratio
+    - fraud_inference_event_time_lag_seconds: TX_TS to created_at of the prediction row
+    - fraud_inference_redeliveries_total{outcome}: redeliveries acked as done ("skipped")
+      or persisted with an earlier prediction ("reused")
+    - fraud_inference_hedged_calls_total{step,outcome}: duplicate feature/predict
+      calls "sent", duplicates that "won", steps that ran out of budget ("timeout"),
+      calls left running ("abandoned") and steps "shed" while too many were
+    - fraud_inference_abandoned_calls: abandoned calls still running (with a budget)
+    - fraud_inference_degraded_total{reason}: messages scored with fallback
+      "features" or a fallback "model" because their budget ran out
+
+    Behind a ShardedSupervisor, the supervisor serves the settlement metrics
+    and every other series of each worker with a worker label
+    """
+
+    STAGES = ("decode", "features", "predict", "persist", "ack")
+    # Only the process that receives a message settles it; a sharded worker
+    # leaves these to the supervisor
+    SETTLEMENT_FAMILIES = ("fraud_inference_message_seconds", "fraud_inference_messages_in_flight",
+                           "fraud_inference_messages_total", "fraud_inference_nack_ratio")
+
+    def __init__(self, registry=None):
+        self.registry = registry or MetricsRegistry()
+        self.stage_seconds = self.registry.register(Histogram(
+            "fraud_inference_stage_seconds", "Time spent in each stage of processing a message", ("stage",)))
+        self.message_seconds = self.registry.register(Histogram(
+            "fraud_inference_message_seconds", "Time from receiving a message to acking or nacking it"))
+        self.in_flight = self.registry.register(Gauge(
+            "fraud_inference_messages_in_flight", "Messages received but not yet acked or nacked"))
+        self.messages = self.registry.register(Counter(
+            "fraud_inference_messages_total", "Messages settled, by outcome", ("outcome",)))
+        self.nack_ratio = self.registry.register(Gauge(
+            "fraud_inference_nack_ratio", "Fraction of settled messages that were nacked", self._nack_ratio))
+        self.event_time_lag = self.registry.register(Histogram(
+            "fraud_inference_event_time_lag_seconds", "Delay from TX_TS to the prediction's created_at",
+            buckets=LAG_BUCKETS))
+        self.redeliveries = self.registry.register(Counter(
+            "fraud_inference_redeliveries_total", "Redelivered messages served from the redelivery index",
+            ("outcome",)))
+        self.hedges = self.registry.register(Counter(
+            "fraud_inference_hedged_calls_total", "Hedged remote calls, by step and outcome", ("step", "outcome")))
+        self.degraded = self.registry.register(Counter(
+            "fraud_inference_degraded_total", "Messages scored in degraded mode, by reason", ("reason",)))
+        self.shadow = self.registry.register(Counter(
+            "fraud_inference_shadow_predictions_total", "Transactions sent to shadow models, by model and outcome",
+            ("model", "outcome")))
+
+    def track(self, message):
+        """Start tracking a newly received message"""
+        return TrackedMessage(message, self)
+
+    def stage(self, name):
+        """Context manager timing one stage"""
+        return self.stage_seconds.time(name)
+
+    def observe_event_time_lag(self, tx_ts, created_at):
+        self.event_time_lag.observe(max(0.0, to_unix_seconds(created_at) - to_unix_seconds(tx_ts)))
+
+    def gauge(self, name, documentation, function):
+        """Register a gauge computed when scraped, e.g. a queue depth"""
+        return self.registry.register(Gauge(name, documentation, function))
+
+    def render(self):
+        return self.registry.render()
+
+    def _nack_ratio(self):
+        acked = self.messages.value("acked")
+        nacked = self.messages.value("nacked")
+        return nacked / (acked + nacked) if acked + nacked else 0.0
+
+
+class MetricsServer:
+    """
+    Serves a registry's metrics on http://host:port/metrics from a daemon
+    thread. The endpoint is unauthenticated, so it binds to loopback unless
+    given another host
+    """
+
+    def __init__(self, registry, port, host="127.0.0.1"):
+        render = registry.render
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes are too frequent to log
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,152 @@
+# Buffered background writer for online_fraud_prediction (and shadow prediction) rows
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class PredictionWriter:
+    """
+    Accepts prediction rows through a bounded queue and streams them to
+    BigQuery from a background thread, one insert_rows_json call per flush.
+
+    A flush happens once max_batch_rows rows are buffered or max_latency_ms
+    after the first buffered row, whichever comes first. Each row carries a
+    callback that is called with True once the insert holding the row
+    succeeded, or False if it failed, so the caller can ack or nack the
+    Pub/Sub message only after its row is durably written. submit blocks
+    while the queue is full, pushing back on the message callbacks.
+
+    Rows are inserted with row_id(row) as their insertId, TX_ID by default
+    """
+
+    def __init__(self, bq_client, table, max_batch_rows=500, max_latency_ms=500, max_queue_size=10000,
+                 row_id=None):
+        self.bq_client = bq_client
+        self.table = table
+        self.row_id = row_id or (lambda row: row['TX_ID'])
+        self.max_batch_rows = max_batch_rows
+        self.max_latency = max_latency_ms / 1000.0
+
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._closed = threading.Event()
+        # close() waits for submits that already passed the closed check, so
+        # no row is queued after the writer thread has drained the queue
+        self._submit_lock = threading.Condition()
+        self._closing = False
+        self._submitting = 0
+        self._stats_lock = threading.Lock()
+        self._rows_written = 0
+        self._rows_failed = 0
+        self._flushes = 0
+        self._flush_seconds_total = 0.0
+        self._flush_seconds_max = 0.0
+        self._last_flush_seconds = 0.0
+
+        self._thread = threading.Thread(target=self._run, name="prediction-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, row, callback=None):
+        """
+        Queue a row for the next flush
+        Args:
+            row: dict matching the online_fraud_prediction schema
+            callback: called with True/False once the row is written or rejected
+        """
+        with self._submit_lock:
+            if self._closing:
+                raise RuntimeError("PredictionWriter is closed")
+            self._submitting += 1
+        try:
+            self._queue.put((row, callback))
+        finally:
+            with self._submit_lock:
+                self._submitting -= 1
+                self._submit_lock.notify_all()
+
+    def close(self):
+        """Flush every queued row and stop the writer thread"""
+        with self._submit_lock:
+            self._closing = True
+            # A blocked submit gets in as the writer thread drains the queue
+            self._submit_lock.wait_for(lambda: self._submitting == 0)
+        self._closed.set()
+        self._thread.join()
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        """Queue depth, row counters and flush latency in milliseconds"""
+        with self._stats_lock:
+            return {
+                'queue_depth': self._queue.qsize(),
+                'rows_written': self._rows_written,
+                'rows_failed': self._rows_failed,
+                'flushes': self._flushes,
+                'last_flush_ms': self._last_flush_seconds * 1000,
+                'avg_flush_ms': self._flush_seconds_total * 1000 / self._flushes if self._flushes else 0.0,
+                'max_flush_ms': self._flush_seconds_max * 1000,
+            }
+
+    def _next_batch(self):
+        """Block for the first row, then collect more until the batch is full or due"""
+        while True:
+            try:
+                batch = [self._queue.get(timeout=0.1)]
+                break
+            except queue.Empty:
+                if self._closed.is_set():
+                    return []
+
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.max_batch_rows:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0 or self._closed.is_set():
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch):
+        rows = [row for row, _ in batch]
+        started = time.perf_counter()
+        try:
+            # TX_ID as insertId lets BigQuery drop rows re-sent after a redelivery
+            errors = self.bq_client.insert_rows_json(self.table, rows, row_ids=[self.row_id(row) for row in rows])
+            failed = {error['index'] for error in errors}
+            if errors:
+                logger.error("Encountered errors while inserting rows: %s", errors)
+        except Exception as e:
+            logger.exception("Error inserting into BigQuery: %s", e)
+            failed = set(range(len(batch)))
+        elapsed = time.perf_counter() - started
+
+        with self._stats_lock:
+            self._flushes += 1
+            self._rows_written += len(batch) - len(failed)
+            self._rows_failed += len(failed)
+            self._last_flush_seconds = elapsed
+            self._flush_seconds_total += elapsed
+            self._flush_seconds_max = max(self._flush_seconds_max, elapsed)
+
+        for idx, (_, callback) in enumerate(batch):
+            if callback is None:
+                continue
+            try:
+                callback(idx not in failed)
+            except Exception as e:
+                logger.exception("Error in prediction writer callback: %s", e)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+            self._flush(batch)
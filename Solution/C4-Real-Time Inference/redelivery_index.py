@@ -0,0 +1,110 @@
+# Bounded index of recently seen TX_IDs, so redelivered messages skip redundant work
+import threading
+import time
+from collections import deque
+
+# Marks a transaction whose prediction row has been written
+DONE = object()
+
+
+class RedeliveryIndex:
+    """
+    Remembers, per TX_ID, how far the processing of a transaction got:
+
+    - done: its prediction row was written, so a redelivery is only acked
+    - scored: a prediction was computed but its row was not written (the
+      insert failed or the message was nacked), so a redelivery reuses the
+      prediction instead of querying features and calling the model again
+
+    Entries live in time buckets of ttl_seconds / num_buckets; a whole bucket
+    is dropped once it is older than ttl_seconds, or earlier when the index
+    holds more than max_entries. This is an exact set rather than a Bloom
+    filter: a false positive would ack a transaction that was never scored.
+    Thread-safe
+    """
+
+    def __init__(self, max_entries=1000000, ttl_seconds=3600, num_buckets=12, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.num_buckets = num_buckets
+        self._bucket_seconds = ttl_seconds / num_buckets
+        self._clock = clock
+        # (bucket number, {TX_ID: DONE or prediction_data}), oldest first
+        self._buckets = deque()
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self.skipped = 0
+        self.reused = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def lookup(self, tx_id):
+        """
+        Returns:
+            DONE, the prediction_data dict recorded for tx_id, or None if unknown
+        """
+        with self._lock:
+            self._expire(self._clock())
+            for _, entries in reversed(self._buckets):
+                state = entries.get(tx_id)
+                if state is not None:
+                    if state is DONE:
+                        self.skipped += 1
+                    else:
+                        self.reused += 1
+                    return state
+            return None
+
+    def record_prediction(self, prediction_data):
+        """Remember a computed prediction until its row is written"""
+        self._put(prediction_data['TX_ID'], dict(prediction_data))
+
+    def mark_done(self, tx_id):
+        """Remember that the row of tx_id has been written"""
+        self._put(tx_id, DONE)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': self._size,
+                'buckets': len(self._buckets),
+                'skipped': self.skipped,
+                'reused': self.reused,
+                'expired': self.expired,
+                'evicted': self.evicted,
+            }
+
+    def _put(self, tx_id, state):
+        now = self._clock()
+        with self._lock:
+            self._expire(now)
+            bucket = int(now // self._bucket_seconds)
+            if not self._buckets or self._buckets[-1][0] != bucket:
+                self._buckets.append((bucket, {}))
+            newest = self._buckets[-1][1]
+            # The newest state wins; drop the older one so size stays exact
+            for _, entries in self._buckets:
+                if entries is not newest and entries.pop(tx_id, None) is not None:
+                    self._size -= 1
+            if tx_id not in newest:
+                self._size += 1
+            newest[tx_id] = state
+
+            while self._size > self.max_entries:
+                if len(self._buckets) > 1:
+                    _, entries = self._buckets.popleft()
+                    self._size -= len(entries)
+                    self.evicted += len(entries)
+                else:
+                    # One bucket over the limit: drop its oldest insertions
+                    newest.pop(next(iter(newest)))
+                    self._size -= 1
+                    self.evicted += 1
+
+    def _expire(self, now):
+        oldest_kept = int(now // self._bucket_seconds) - self.num_buckets
+        while self._buckets and self._buckets[0][0] <= oldest_kept:
+            _, entries = self._buckets.popleft()
+            self._size -= len(entries)
+            self.expired += len(entries)
@@ -0,0 +1,203 @@
+# Shadow models scored on the primary model's feature vectors, off the message path
+import logging
+import queue
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class EndpointModel:
+    """
+    Shadow model deployed on its own Vertex AI endpoint; predictions are
+    parsed like the primary endpoint's
+    """
+
+    def __init__(self, endpoint, parse_prediction_value):
+        """
+        Args:
+            endpoint: aiplatform.Endpoint, or a zero-argument callable returning
+                it (so the endpoint is only resolved on first use)
+            parse_prediction_value: FraudDetectionProcessor.parse_prediction_value
+        """
+        self._endpoint = endpoint
+        self._parse = parse_prediction_value
+
+    @property
+    def endpoint(self):
+        if callable(self._endpoint):
+            self._endpoint = self._endpoint()
+        return self._endpoint
+
+    def predict(self, features_list):
+        response = self.endpoint.predict(instances=features_list)
+        return [self._parse(value) for value in response.predictions], response.deployed_model_id
+
+
+class LocalShadowModel:
+    """Shadow model scored in-process (local_model.LocalModel)"""
+
+    def __init__(self, model):
+        self.model = model
+
+    def predict(self, features_list):
+        return self.model.score_features(features_list), self.model.model_version
+
+
+class ShadowScorer:
+    """
+    Scores every transaction the primary model scored with a set of shadow
+    models, reusing the primary's feature vectors, and queues one side-table
+    row per transaction and model on a PredictionWriter.
+
+    Each shadow model has its own bounded queue and threads, so the shadows
+    run concurrently with each other and with the message path; a thread
+    takes whatever has queued up (up to max_batch transactions) into one
+    predict call. Nothing on the message path waits for them: a transaction
+    that finds a shadow's queue full is dropped for that shadow (and
+    counted), and a failing shadow is only logged. Rows carry no callback, so
+    writing them never holds up an ack
+    """
+
+    def __init__(self, models, writer, workers_per_model=2, max_batch=100, max_queue_size=10000, counter=None):
+        """
+        Args:
+            models: dict of shadow name -> model with predict(features_list)
+                returning (list of fraud probabilities, model_version)
+            writer: PredictionWriter of the side table, keyed by TX_ID and model name
+            workers_per_model: threads calling each shadow model
+            max_batch: transactions per shadow predict call
+            max_queue_size: transactions waiting per shadow before new ones are dropped
+            counter: Counter labelled (model, outcome) counting "scored",
+                "failed" and "dropped" transactions
+        """
+        self.models = dict(models)
+        self.writer = writer
+        self.max_batch = max_batch
+        self._counter = counter
+        self._queues = {name: queue.Queue(maxsize=max_queue_size) for name in self.models}
+        self._lock = threading.Lock()
+        self.scored = 0
+        self.failed = 0
+        self.dropped = 0
+        self.calls = 0
+
+        self._threads = {name: [] for name in self.models}
+        for name, threads in self._threads.items():
+            for idx in range(workers_per_model):
+                thread = threading.Thread(target=self._run, args=(name,), name=f"shadow-{name}-{idx}", daemon=True)
+                thread.start()
+                threads.append(thread)
+
+    @staticmethod
+    def row_id(row):
+        """Insert ID of a side-table row: one row per transaction and model"""
+        return f"{row['TX_ID']}:{row['model_name']}"
+
+    def submit(self, transactions, features_list, probabilities, model_version):
+        """
+        Queue a scored batch for every shadow model; never blocks
+        Args:
+            transactions: decoded transactions (TransactionRecord)
+            features_list: their feature dicts, as sent to the primary model;
+                must not be modified afterwards
+            probabilities, model_version: the primary model's result, stored
+                next to each shadow prediction for comparison
+        """
+        items = [(transaction, features, probability, model_version)
+                 for transaction, features, probability in zip(transactions, features_list, probabilities)]
+        for name, shadow_queue in self._queues.items():
+            dropped = 0
+            for item in items:
+                try:
+                    shadow_queue.put_nowait(item)
+                except queue.Full:
+                    dropped += 1
+            if dropped:
+                with self._lock:
+                    self.dropped += dropped
+                self._count(name, "dropped", dropped)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'models': list(self.models),
+                'queued': sum(shadow_queue.qsize() for shadow_queue in self._queues.values()),
+                'calls': self.calls,
+                'scored': self.scored,
+                'failed': self.failed,
+                'dropped': self.dropped,
+            }
+
+    def close(self):
+        """Score what is still queued, stop the threads and flush their rows"""
+        for name, threads in self._threads.items():
+            for _ in threads:
+                self._queues[name].put(None)
+        for threads in self._threads.values():
+            for thread in threads:
+                thread.join()
+        self.writer.close()
+
+    def _next_batch(self, shadow_queue):
+        """Block for one transaction, then take what else is queued, up to max_batch"""
+        item = shadow_queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        while len(batch) < self.max_batch:
+            try:
+                item = shadow_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # Put the stop marker back for after this batch
+                shadow_queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self, name):
+        model = self.models[name]
+        shadow_queue = self._queues[name]
+        while True:
+            batch = self._next_batch(shadow_queue)
+            if batch is None:
+                return
+            self._score(name, model, batch)
+
+    def _score(self, name, model, batch):
+        with self._lock:
+            self.calls += 1
+        try:
+            probabilities, model_version = model.predict([features for _, features, _, _ in batch])
+            if len(probabilities) != len(batch):
+                raise ValueError(f"Expected {len(batch)} predictions, got {len(probabilities)}")
+        except Exception as e:
+            logger.warning("Shadow model %s failed on %d transactions: %s", name, len(batch), e)
+            with self._lock:
+                self.failed += len(batch)
+            self._count(name, "failed", len(batch))
+            return
+
+        created_at = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S UTC')
+        for (transaction, _, primary_probability, primary_model_version), probability in zip(batch, probabilities):
+            probability = float(probability)
+            self.writer.submit({
+                'TX_ID': transaction.tx_id,
+                'prediction_timestamp': transaction.tx_ts,
+                'model_name': name,
+                'model_version': model_version,
+                'fraud_probability': probability,
+                'is_fraud': bool(probability > 0.5),
+                'primary_model_version': primary_model_version,
+                'primary_fraud_probability': float(primary_probability),
+                'created_at': created_at,
+            })
+        with self._lock:
+            self.scored += len(batch)
+        self._count(name, "scored", len(batch))
+
+    def _count(self, name, outcome, amount):
+        if self._counter is not None:
+            self._counter.inc(name, outcome, amount=amount)
@@ -0,0 +1,384 @@
+# Multi-process mode: a supervisor shards Pub/Sub messages over worker processes by customer
+import itertools
+import json
+import logging
+import multiprocessing
+import multiprocessing.connection
+import queue
+import threading
+import time
+import zlib
+
+from google.cloud import pubsub_v1
+
+import clients
+from log_setup import configure_logging
+from metrics import InferenceMetrics
+
+logger = logging.getLogger(__name__)
+
+# Result key of a worker's metrics snapshot; message keys are ints and None means ready
+METRICS_SNAPSHOT = "metrics"
+
+
+def shard_for(customer_id, num_workers, lanes):
+    """
+    Worker process and lane within it for a customer. Every transaction of a
+    customer goes to the same lane, so they are scored in arrival order
+    Returns:
+        (worker index, lane index)
+    """
+    digest = zlib.crc32(str(customer_id).encode('utf-8'))
+    return digest % num_workers, (digest // num_workers) % lanes
+
+
+class ResultPipe:
+    """
+    Sending end of a worker's own pipe to the supervisor, shared by the lane
+    threads. A multiprocessing.Queue shared by every worker would not do: a
+    worker killed while its feeder thread holds the queue's lock blocks the
+    results of all the others for good
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+        self._lock = threading.Lock()
+
+    def put(self, item):
+        with self._lock:
+            self._connection.send(item)
+
+
+class WorkerMessage:
+    """
+    Stand-in for a Pub/Sub message inside a worker process; ack/nack are sent
+    back to the supervisor, which settles the real message
+    """
+
+    def __init__(self, key, data, results):
+        self.key = key
+        self.data = data
+        self._results = results
+
+    def ack(self):
+        self._results.put((self.key, True))
+
+    def nack(self):
+        self._results.put((self.key, False))
+
+
+def _run_lane(processor, lane_queue):
+    while True:
+        message = lane_queue.get()
+        if message is None:
+            return
+        processor.process_message(message)
+
+
+def _metrics_snapshot(processor):
+    return [
+        family for family in processor.metrics.registry.snapshot()
+        if family.name not in processor.metrics.SETTLEMENT_FAMILIES
+    ]
+
+
+def _send_metrics(worker_index, processor, results, interval, stop):
+    while not stop.wait(interval):
+        results.put((METRICS_SNAPSHOT, (worker_index, _metrics_snapshot(processor))))
+
+
+def worker_main(worker_index, lanes, input_queue, result_connection, processor_factory, log_level, log_sample_rate,
+                log_file=None, metrics_interval=5.0):
+    """
+    Entry point of a worker process: builds its own processor (and so its own
+    clients), then scores messages on one thread per lane and sends a snapshot
+    of its metrics to the supervisor every metrics_interval seconds
+    """
+    results = ResultPipe(result_connection)
+    log_stream = open(log_file, "a") if log_file else None
+    background_logging = configure_logging(log_level, log_sample_rate, log_stream)
+    processor = processor_factory()
+    processor.warm_up()
+    if processor.hedger is not None:
+        processor.hedger.size_for(lanes)
+
+    lane_queues = [queue.Queue() for _ in range(lanes)]
+    threads = [
+        threading.Thread(target=_run_lane, args=(processor, lane_queue), name=f"lane-{lane}", daemon=True)
+        for lane, lane_queue in enumerate(lane_queues)
+    ]
+    for thread in threads:
+        thread.start()
+    metrics_stop = threading.Event()
+    metrics_thread = threading.Thread(
+        target=_send_metrics, args=(worker_index, processor, results, metrics_interval, metrics_stop),
+        name="metrics-snapshot", daemon=True
+    )
+    metrics_thread.start()
+    # A None key tells the supervisor this worker is ready
+    results.put((None, worker_index))
+    logger.info("Worker %d ready with %d lanes", worker_index, lanes)
+
+    while True:
+        item = input_queue.get()
+        if item is None:
+            break
+        key, lane, data = item
+        lane_queues[lane].put(WorkerMessage(key, data, results))
+
+    for lane_queue in lane_queues:
+        lane_queue.put(None)
+    for thread in threads:
+        thread.join()
+    if processor.prediction_writer is not None:
+        processor.prediction_writer.close()
+    if processor.shadow_scorer is not None:
+        processor.shadow_scorer.close()
+    metrics_stop.set()
+    metrics_thread.join()
+    # Including the rows the writers flushed on close
+    results.put((METRICS_SNAPSHOT, (worker_index, _metrics_snapshot(processor))))
+    logger.info("Worker %d stopped", worker_index)
+    background_logging.stop()
+    if log_stream is not None:
+        log_stream.close()
+    result_connection.close()
+
+
+class ShardedSupervisor:
+    """
+    Receives Pub/Sub messages in this process and shards them over worker
+    processes by crc32(CUSTOMER_ID). Workers have their own clients, caches
+    and GIL; the supervisor only parses CUSTOMER_ID, forwards the payload and
+    acks or nacks the real message once the worker reports back.
+
+    The supervisor's metrics settle the messages; the workers' stage, writer,
+    degraded, redelivery and shadow metrics arrive as periodic snapshots and
+    are served from the supervisor's registry with a worker label.
+
+    A worker that dies is restarted, and the messages it held are nacked so
+    Pub/Sub redelivers them
+    """
+
+    def __init__(self, num_workers, processor_factory, lanes=8, log_level="INFO", log_sample_rate=1.0,
+                 metrics=None, monitor_interval=1.0, log_file=None, metrics_interval=5.0):
+        """
+        Args:
+            num_workers: worker processes
+            processor_factory: picklable callable returning a FraudDetectionProcessor;
+                called once in each worker
+            lanes: messages each worker scores concurrently
+            log_level, log_sample_rate: logging setup of the workers
+            log_file: file the workers log to instead of stdout
+            metrics: InferenceMetrics for ack/nack, in-flight and latency of the supervisor
+            monitor_interval: seconds between worker liveness checks
+            metrics_interval: seconds between metrics snapshots of each worker
+        """
+        self.num_workers = num_workers
+        self.processor_factory = processor_factory
+        self.lanes = lanes
+        self.log_level = log_level
+        self.log_sample_rate = log_sample_rate
+        self.log_file = log_file
+        self.metrics = metrics or InferenceMetrics()
+        self.monitor_interval = monitor_interval
+        self.metrics_interval = metrics_interval
+        # Latest metrics snapshot of each worker; kept across a restart until the new worker sends one
+        self._worker_metrics = {}
+        self._worker_metrics_lock = threading.Lock()
+        self.metrics.registry.add_collector(self._worker_families)
+
+        # gRPC and client threads do not survive fork
+        self._context = multiprocessing.get_context("spawn")
+        # Receiving end of each worker's result pipe; None once the worker has closed it
+        self._results = [None] * num_workers
+        self._input_queues = [None] * num_workers
+        self._processes = [None] * num_workers
+        self._ready = [threading.Event() for _ in range(num_workers)]
+
+        self._keys = itertools.count()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._closing = threading.Event()
+        self._result_thread = threading.Thread(target=self._collect_results, name="shard-results", daemon=True)
+
+    @property
+    def max_outstanding(self):
+        """Flow control limit: two messages per lane keeps every lane busy"""
+        return 2 * self.num_workers * self.lanes
+
+    def start(self, timeout=300.0):
+        """Start the workers and wait until each has warmed up"""
+        for worker_index in range(self.num_workers):
+            self._start_worker(worker_index)
+        self._result_thread.start()
+        deadline = time.monotonic() + timeout
+        for worker_index, ready in enumerate(self._ready):
+            if not ready.wait(max(0.0, deadline - time.monotonic())):
+                raise TimeoutError(f"Worker {worker_index} did not become ready within {timeout} seconds")
+        logger.info("%d worker processes ready", self.num_workers)
+
+    def dispatch(self, message):
+        """Pub/Sub callback: route a message to its worker"""
+        message = self.metrics.track(message)
+        try:
+            customer_id = json.loads(message.data.decode('utf-8'))['CUSTOMER_ID']
+        except Exception as e:
+            logger.error("Error decoding message: %s; message data: %s", e, message.data)
+            message.nack()
+            return
+
+        worker_index, lane = shard_for(customer_id, self.num_workers, self.lanes)
+        key = next(self._keys)
+        with self._pending_lock:
+            self._pending[key] = (message, worker_index)
+            input_queue = self._input_queues[worker_index]
+        input_queue.put((key, lane, message.data))
+
+    def run(self, subscription_path, subscriber=None):
+        """
+        Start the workers and process the subscription until interrupted
+        Args:
+            subscription_path: Full path to the Pub/Sub subscription
+            subscriber: Subscriber client to use instead of the shared one
+        """
+        if subscriber is None:
+            subscriber = clients.subscriber_client()
+        self.start()
+        streaming_pull_future = None
+        try:
+            logger.info("Listening for messages on %s with %d worker processes", subscription_path, self.num_workers)
+            streaming_pull_future = subscriber.subscribe(
+                subscription_path,
+                callback=self.dispatch,
+                flow_control=pubsub_v1.types.FlowControl(max_messages=self.max_outstanding)
+            )
+            streaming_pull_future.result()
+        except KeyboardInterrupt:
+            streaming_pull_future.cancel()
+        except Exception as e:
+            logger.exception("Error in subscriber: %s", e)
+            if streaming_pull_future is not None:
+                streaming_pull_future.cancel()
+            raise
+        finally:
+            self.close()
+
+    def close(self, timeout=60.0):
+        """Let the workers finish their queued messages, then stop them"""
+        # Workers exiting from here on are not restarted
+        self._stopping.set()
+        for input_queue in self._input_queues:
+            input_queue.put(None)
+        deadline = time.monotonic() + timeout
+        for process in self._processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.error("Worker pid %d did not stop in time; terminating it", process.pid)
+                process.terminate()
+        self._closing.set()
+        self._result_thread.join()
+
+        # Whatever is still unsettled will be redelivered
+        with self._pending_lock:
+            leftover = list(self._pending.values())
+            self._pending.clear()
+        for message, _ in leftover:
+            message.nack()
+
+    def _start_worker(self, worker_index):
+        input_queue = self._context.Queue()
+        result_reader, result_writer = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=worker_main,
+            args=(worker_index, self.lanes, input_queue, result_writer, self.processor_factory,
+                  self.log_level, self.log_sample_rate, self.log_file, self.metrics_interval),
+            name=f"fraud-worker-{worker_index}",
+            daemon=True
+        )
+        process.start()
+        # Only the worker holds the sending end, so its exit shows up as EOF here
+        result_writer.close()
+        self._results[worker_index] = result_reader
+        with self._pending_lock:
+            self._input_queues[worker_index] = input_queue
+        self._processes[worker_index] = process
+
+    def _collect_results(self):
+        next_check = time.monotonic() + self.monitor_interval
+        while True:
+            readers = [reader for reader in self._results if reader is not None]
+            if readers:
+                ready = multiprocessing.connection.wait(readers, timeout=0.1)
+            else:
+                ready = []
+                time.sleep(0.1)
+            if not ready and self._closing.is_set():
+                for reader in readers:
+                    reader.close()
+                return
+            for reader in ready:
+                self._receive(reader)
+
+            if not self._stopping.is_set() and time.monotonic() >= next_check:
+                self._restart_dead_workers()
+                next_check = time.monotonic() + self.monitor_interval
+
+    def _receive(self, reader):
+        """
+        Handle one result from a worker's pipe
+        Returns:
+            bool: False if the pipe has ended (its worker exited) and was closed
+        """
+        try:
+            key, value = reader.recv()
+        except (EOFError, OSError):
+            reader.close()
+            self._results = [None if other is reader else other for other in self._results]
+            return False
+        if key is None:
+            # Ready signal; value is the worker index
+            self._ready[value].set()
+            return True
+        if key == METRICS_SNAPSHOT:
+            worker_index, families = value
+            with self._worker_metrics_lock:
+                self._worker_metrics[worker_index] = families
+            return True
+        with self._pending_lock:
+            entry = self._pending.pop(key, None)
+        # None: already nacked after its worker died
+        if entry is not None:
+            if value:
+                entry[0].ack()
+            else:
+                entry[0].nack()
+        return True
+
+    def _worker_families(self):
+        with self._worker_metrics_lock:
+            snapshots = sorted(self._worker_metrics.items())
+        return [
+            family.with_label("worker", str(worker_index))
+            for worker_index, families in snapshots
+            for family in families
+        ]
+
+    def _restart_dead_workers(self):
+        for worker_index, process in enumerate(self._processes):
+            if process.is_alive():
+                continue
+            logger.error("Worker %d exited with code %s; restarting it", worker_index, process.exitcode)
+            # Results it sent before exiting still settle their messages
+            reader = self._results[worker_index]
+            if reader is not None:
+                while reader.poll() and self._receive(reader):
+                    pass
+                reader.close()
+            with self._pending_lock:
+                lost = [key for key, (_, owner) in self._pending.items() if owner == worker_index]
+                messages = [self._pending.pop(key)[0] for key in lost]
+            for message in messages:
+                message.nack()
+            self._start_worker(worker_index)
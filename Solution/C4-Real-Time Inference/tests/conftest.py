@@ -0,0 +1,28 @@
+# The modules under test live next to this directory, not in a package
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+
+
+@pytest.fixture
+def fake_bq_client():
+    """benchmark.py's fake BigQuery client, without latency or failures"""
+    from benchmark import FakeBigQueryClient, FakeService
+    return FakeBigQueryClient(FakeService("bq_queries"), FakeService("bq_inserts"))
+
+
+@pytest.fixture
+def failing_bq_client():
+    """benchmark.py's fake BigQuery client whose streaming inserts always fail"""
+    from benchmark import FakeBigQueryClient, FakeService
+    return FakeBigQueryClient(FakeService("bq_queries"), FakeService("bq_inserts", error_rate=1.0))
+
+
+@pytest.fixture
+def fake_processor():
+    """Factory of benchmark.py's FraudDetectionProcessor wired to the fakes, given benchmark options"""
+    from benchmark import build_fake_processor, parse_args
+    return lambda **options: build_fake_processor(dict(vars(parse_args([])), **options))
@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+
+from adaptive_concurrency import AdaptiveConcurrencyController
+
+
+class FakeWriter:
+    def __init__(self, queue_depth=0):
+        self.queue_depth = queue_depth
+
+
+async def complete_window(controller, seconds=0.01, failures=0):
+    """Run one window (limit messages) through the controller"""
+    count = controller.limit
+    for _ in range(count):
+        await controller.acquire()
+    for index in range(count):
+        await controller.release(seconds, ok=index >= failures)
+
+
+def run_windows(controller, *windows):
+    async def scenario():
+        limits = []
+        for window in windows:
+            await complete_window(controller, **window)
+            limits.append(controller.limit)
+        return limits
+    return asyncio.run(scenario())
+
+
+def test_a_healthy_window_adds_one():
+    controller = AdaptiveConcurrencyController(initial_limit=4, target_latency_ms=100)
+    assert run_windows(controller, {}, {}, {}) == [5, 6, 7]
+    assert controller.stats()['increases'] == 3
+
+
+@pytest.mark.parametrize("window", [
+    {'seconds': 0.5},
+    {'failures': 2},
+])
+def test_slow_or_failing_windows_cut_the_limit_by_30_percent(window):
+    controller = AdaptiveConcurrencyController(initial_limit=10, target_latency_ms=100, max_error_rate=0.05)
+    assert run_windows(controller, window) == [7]
+    assert controller.stats()['decreases'] == 1
+
+
+def test_a_slow_endpoint_cuts_the_limit():
+    controller = AdaptiveConcurrencyController(initial_limit=10, target_latency_ms=100, endpoint_latency_ms=50)
+    controller.observe_endpoint(0.2)
+    assert run_windows(controller, {}) == [7]
+
+
+def test_a_writer_backlog_pauses_intake_and_cuts_the_limit():
+    writer = FakeWriter()
+    controller = AdaptiveConcurrencyController(initial_limit=10, target_latency_ms=100, prediction_writer=writer,
+                                               writer_high_watermark=100)
+
+    async def scenario():
+        for _ in range(controller.limit):
+            await controller.acquire()
+        writer.queue_depth = 101
+        for _ in range(controller.limit):
+            await controller.release(0.01, ok=True)
+        assert controller.limit == 7
+
+        # No message starts until the writer is back under the watermark
+        waiting = asyncio.ensure_future(controller.acquire())
+        await asyncio.sleep(0.2)
+        assert not waiting.done()
+        writer.queue_depth = 0
+        await asyncio.wait_for(waiting, 1)
+        assert controller.in_flight == 1
+
+    asyncio.run(scenario())
+
+
+def test_the_limit_stays_within_its_bounds():
+    controller = AdaptiveConcurrencyController(initial_limit=3, min_limit=2, max_limit=5, target_latency_ms=100)
+    assert run_windows(controller, {}, {}, {}, {}) == [4, 5, 5, 5]
+    assert run_windows(controller, *[{'seconds': 1.0}] * 4) == [3, 2, 2, 2]
+    assert AdaptiveConcurrencyController(initial_limit=100, max_limit=5).limit == 5
+    assert AdaptiveConcurrencyController(initial_limit=0, min_limit=2).limit == 2
+
+
+def test_acquire_waits_for_a_slot_under_the_limit():
+    controller = AdaptiveConcurrencyController(initial_limit=2, target_latency_ms=100)
+
+    async def scenario():
+        await controller.acquire()
+        await controller.acquire()
+        waiting = asyncio.ensure_future(controller.acquire())
+        await asyncio.sleep(0.1)
+        assert not waiting.done()
+        await controller.release(0.01, ok=True)
+        await asyncio.wait_for(waiting, 1)
+        assert controller.in_flight == 2
+
+    asyncio.run(scenario())
@@ -0,0 +1,76 @@
+import json
+import threading
+
+from async_pipeline import AsyncFraudPipeline
+from test_micro_batch import NO_LATENCY, messages, settled
+
+SMALL_LATENCY = dict(bq_latency_ms=5, bq_jitter_ms=0, predict_latency_ms=5, predict_jitter_ms=0,
+                     insert_latency_ms=1, insert_jitter_ms=0)
+
+
+class CountingPipeline(AsyncFraudPipeline):
+    """Records the most messages it ever had in process_message at once"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.in_flight = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    async def process_message(self, message):
+        with self._lock:
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        try:
+            return await super().process_message(message)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+def run(pipeline, batch):
+    pipeline.start_loop()
+    futures = [pipeline.submit(message) for message in batch]
+    for future in futures:
+        future.result(timeout=30)
+    pipeline.close()
+
+
+def test_in_flight_messages_never_exceed_the_limit(fake_processor):
+    processor = fake_processor(**SMALL_LATENCY)
+    pipeline = CountingPipeline(processor, max_in_flight=4)
+    batch = messages(40)
+    run(pipeline, batch)
+    assert settled(batch) == [["ack"]] * 40
+    assert pipeline.peak == 4
+
+
+def test_a_failed_message_is_nacked_and_the_others_acked(fake_processor, monkeypatch):
+    processor = fake_processor(**NO_LATENCY)
+    batch = messages(6)
+    batch[0].data = b"not json"
+    failing_tx_id = json.loads(batch[3].data)['TX_ID']
+    get_terminal_features = processor.get_terminal_features
+
+    def terminal_features(transaction_data):
+        if transaction_data['TX_ID'] == failing_tx_id:
+            raise RuntimeError("terminal lookup failed")
+        return get_terminal_features(transaction_data)
+
+    monkeypatch.setattr(processor, "get_terminal_features", terminal_features)
+    run(AsyncFraudPipeline(processor, max_in_flight=3), batch)
+    assert settled(batch) == [["nack"], ["ack"], ["ack"], ["nack"], ["ack"], ["ack"]]
+    assert processor.bq_client.rows_inserted == 4
+
+
+def test_close_drains_the_messages_in_flight(fake_processor):
+    processor = fake_processor(**SMALL_LATENCY)
+    pipeline = AsyncFraudPipeline(processor, max_in_flight=8)
+    pipeline.start_loop()
+    batch = messages(20)
+    for message in batch:
+        pipeline.submit(message)
+    # Nothing has finished yet: the first feature lookups take 5 ms
+    pipeline.close()
+    assert settled(batch) == [["ack"]] * 20
+    assert processor.bq_client.rows_inserted == 20
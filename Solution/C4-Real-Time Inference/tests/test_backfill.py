@@ -0,0 +1,49 @@
+import pandas as pd
+import pytest
+
+from backfill import BackfillScorer, BigQuerySink
+
+
+class FakeLoadJob:
+    def result(self):
+        return None
+
+
+class FakeBigQueryClient:
+    def __init__(self):
+        self.loads = []
+
+    def load_table_from_dataframe(self, rows, table, job_config=None):
+        self.loads.append(rows)
+        return FakeLoadJob()
+
+
+class FakeTable:
+    schema = []
+
+    def __str__(self):
+        return "project.tx.online_fraud_prediction"
+
+
+def predict_data_rows(with_tx_id):
+    scored = pd.DataFrame({'TX_TS': pd.to_datetime(["2024-05-01 10:00:00", "2024-05-01 10:00:01"], utc=True)})
+    if with_tx_id:
+        scored['TX_ID'] = ["1", "2"]
+    return BackfillScorer.prediction_rows(scored, pd.Series([0.2, 0.9]).to_numpy(), "v1")
+
+
+def test_bigquery_sink_appends_rows_with_tx_id():
+    client = FakeBigQueryClient()
+    sink = BigQuerySink(client, FakeTable())
+    sink.write(predict_data_rows(with_tx_id=True))
+    sink.close()
+    assert len(client.loads) == 1
+    assert list(client.loads[0]['TX_ID']) == ["1", "2"]
+
+
+def test_bigquery_sink_rejects_predict_data_rows():
+    client = FakeBigQueryClient()
+    sink = BigQuerySink(client, FakeTable())
+    with pytest.raises(ValueError, match="TX_ID"):
+        sink.write(predict_data_rows(with_tx_id=False))
+    assert client.loads == []
@@ -0,0 +1,27 @@
+import os
+import subprocess
+import sys
+
+import google.auth
+from google.auth.credentials import AnonymousCredentials
+
+import clients
+
+
+def test_bigquery_client_uses_a_pooled_authorized_session(monkeypatch):
+    monkeypatch.setattr(google.auth, "default", lambda scopes=None: (AnonymousCredentials(), "default-project"))
+    monkeypatch.setattr(clients, "_bigquery_clients", {})
+    client = clients.bigquery_client()
+    assert client.project == "default-project"
+    adapter = client._http.get_adapter("https://bigquery.googleapis.com")
+    assert adapter._pool_maxsize == clients.BIGQUERY_HTTP_POOL_SIZE
+    assert client._http.credentials is client._credentials
+    assert clients.bigquery_client() is client
+
+
+def test_processor_module_imports_no_google_cloud_clients():
+    code = ("import sys, fraud_online_inference; "
+            "print(sorted(m for m in sys.modules if m.startswith(('google.cloud.', 'sharded'))))")
+    result = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.dirname(__file__)),
+                            capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == "[]"
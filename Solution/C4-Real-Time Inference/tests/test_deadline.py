@@ -0,0 +1,95 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from deadline import DeadlineExceeded, Hedger
+
+
+def blocking(release, value):
+    release.wait(5)
+    return value
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_hedge_wins_when_primary_is_slow():
+    hedger = Hedger(max_in_flight=1, max_abandoned=4)
+    release = threading.Event()
+    calls = []
+
+    def call():
+        calls.append(None)
+        if len(calls) == 1:
+            return blocking(release, "primary")
+        return "hedge"
+
+    try:
+        assert hedger.call("features", call, (), hedge_after=0.01, timeout=1.0) == "hedge"
+        stats = hedger.stats()
+        assert (stats['sent'], stats['won'], stats['abandoned'], stats['outstanding']) == (1, 1, 1, 1)
+        release.set()
+        wait_for(lambda: hedger.stats()['outstanding'] == 0)
+    finally:
+        release.set()
+        hedger.close()
+
+
+def test_timeout_abandons_both_calls():
+    hedger = Hedger(max_in_flight=1, max_abandoned=4)
+    release = threading.Event()
+    try:
+        with pytest.raises(DeadlineExceeded):
+            hedger.call("predict", blocking, (release, 1), hedge_after=0.01, timeout=0.05)
+        assert hedger.stats()['timeouts'] == 1
+        assert hedger.stats()['outstanding'] == 2
+    finally:
+        release.set()
+        hedger.close()
+
+
+def test_saturated_hedger_sheds_instead_of_queueing():
+    hedger = Hedger(max_in_flight=1, max_abandoned=2)
+    release = threading.Event()
+    try:
+        with pytest.raises(DeadlineExceeded):
+            hedger.call("features", blocking, (release, 1), hedge_after=0.01, timeout=0.05)
+        calls = []
+        with pytest.raises(DeadlineExceeded):
+            hedger.call("features", lambda: calls.append(None), (), hedge_after=0.01, timeout=1.0)
+        assert calls == []
+        assert hedger.stats()['shed'] == 1
+        # Without a timeout the step still runs, just without a duplicate
+        assert hedger.call("predict", lambda: "ok", (), hedge_after=0.0, timeout=None) == "ok"
+        assert hedger.stats()['sent'] == 1
+    finally:
+        release.set()
+        hedger.close()
+
+
+def test_call_async_hedges_a_coroutine():
+    hedger = Hedger(max_in_flight=1, max_abandoned=4)
+    attempts = []
+
+    async def lookup():
+        attempts.append(None)
+        if len(attempts) == 1:
+            await asyncio.sleep(1)
+            return "primary"
+        return "hedge"
+
+    async def scenario():
+        result = await hedger.call_async("features", lookup, hedge_after=0.01, timeout=0.5)
+        assert hedger.stats()['outstanding'] == 1
+        # Let the abandoned primary finish
+        await asyncio.sleep(1.1)
+        return result
+
+    assert asyncio.run(scenario()) == "hedge"
+    assert hedger.stats()['outstanding'] == 0
@@ -0,0 +1,40 @@
+import os
+import subprocess
+import sys
+
+import pandas as pd
+import pytest
+
+from export_files import expand_paths, read_chunks
+
+
+def test_expand_paths_and_read_chunks(tmp_path):
+    frame = pd.DataFrame({'TX_ID': ["1", "2", "3"], 'TX_AMOUNT': [1.0, 2.0, 3.0]})
+    frame.to_parquet(tmp_path / "b.parquet")
+    frame.to_csv(tmp_path / "a.csv", index=False)
+    (tmp_path / "notes.txt").write_text("ignored")
+
+    paths = expand_paths([str(tmp_path)])
+    assert [path.rsplit("/", 1)[-1] for path in paths] == ["a.csv", "b.parquet"]
+    chunks = list(read_chunks(paths, chunk_rows=2))
+    assert [len(chunk) for chunk in chunks] == [2, 1, 2, 1]
+    assert pd.concat(chunks)['TX_ID'].tolist() == ["1", "2", "3"] * 2
+
+    with pytest.raises(FileNotFoundError):
+        expand_paths([str(tmp_path / "*.json")])
+
+
+def test_training_set_builder_does_not_load_the_processor(tmp_path):
+    # Its worker processes import it too; the Google Cloud clients must stay out
+    empty = str(tmp_path / "empty.csv")
+    pd.DataFrame({'TX_ID': []}).to_csv(empty, index=False)
+    code = ("import sys, training_set_builder\n"
+            "try:\n"
+            f"    training_set_builder.main([{empty!r}, '--customer-features', {empty!r},"
+            f" '--terminal-features', {empty!r}])\n"
+            "except SystemExit:\n"
+            "    pass\n"
+            "print(sorted(set(sys.modules) & {'backfill', 'fraud_online_inference'}))")
+    result = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.dirname(__file__)),
+                            capture_output=True, text=True, check=True)
+    assert result.stdout.strip().splitlines()[-1] == "[]"
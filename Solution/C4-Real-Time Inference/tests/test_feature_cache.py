@@ -0,0 +1,60 @@
+from feature_cache import FeatureCache, TTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_ttl_cache_expires_and_evicts_least_recently_used():
+    clock = FakeClock()
+    cache = TTLCache(max_entries=2, max_age_seconds=10, clock=clock)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    # "b" is now the least recently used
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+    clock.now = 11
+    assert cache.get("a") is None
+    # An expired entry stays available to a lookup that accepts older values
+    assert cache.get("a", max_age_seconds=60) == 1
+    assert cache.get("c", is_usable=lambda value: value != 3, max_age_seconds=60) is None
+    stats = cache.stats()
+    assert (stats['size'], stats['evictions'], stats['expirations']) == (2, 1, 1)
+    assert stats['hits'] == 4 and stats['misses'] == 3
+
+
+def test_feature_cache_never_serves_rows_newer_than_the_transaction():
+    cache = FeatureCache(max_entries=10, max_staleness_seconds=60)
+    cache.put_customer("C1", "2024-05-01 10:00:00 UTC", {'customer_id_nb_tx_1day_window': 3.0})
+    assert cache.get_customer("C1", "2024-05-01 10:00:00 UTC") == {'customer_id_nb_tx_1day_window': 3.0}
+    # A late or replayed message from before the cached row
+    assert cache.get_customer("C1", "2024-05-01 09:59:59 UTC") is None
+
+    # No view row (feature_ts None) is valid for any transaction
+    cache.put_terminal("T1", None, {'terminal_id_risk_1day_window': 0.0})
+    assert cache.get_terminal("T1", "2020-01-01 00:00:00 UTC") == {'terminal_id_risk_1day_window': 0.0}
+    assert cache.get_customer("C2", "2024-05-01 10:00:00 UTC") is None
+
+
+def test_processor_queries_only_the_uncached_half(fake_processor):
+    processor = fake_processor(cache_entries=100)
+    transaction = {'TX_ID': "1", 'TX_TS': "2024-05-01 10:00:00 UTC", 'CUSTOMER_ID': "C1",
+                   'TERMINAL_ID': "T1", 'TX_AMOUNT': 12.5}
+    bq_queries = processor.bq_client.query_service
+
+    first = processor.get_features(transaction)
+    assert bq_queries.calls == 1
+    assert processor.get_features(dict(transaction, TX_ID="2", TX_AMOUNT=3.0)) == dict(first, tx_amount=3.0)
+    assert bq_queries.calls == 1
+
+    # Same customer at a new terminal: one query for the terminal half
+    processor.get_features(dict(transaction, TX_ID="3", TERMINAL_ID="T2"))
+    assert bq_queries.calls == 2
+    assert processor.feature_cache.stats()['terminals']['size'] == 2
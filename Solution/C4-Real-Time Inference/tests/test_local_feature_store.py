@@ -0,0 +1,108 @@
+import time
+
+from local_feature_store import CUSTOMER_COLUMNS, SYNC_LAG_SECONDS, TERMINAL_COLUMNS, LocalFeatureStore
+from window_features import LABEL_DELAY_SECONDS
+
+DAY = 86400
+NOW = 1_717_000_000
+
+
+def customer_row(customer_id, feature_ts, nb_tx):
+    row = {column: float(nb_tx) for column in CUSTOMER_COLUMNS}
+    row.update(customer_id=customer_id, feature_ts=feature_ts)
+    return row
+
+
+def terminal_row(terminal_id, feature_ts, risk):
+    row = {column: risk for column in TERMINAL_COLUMNS}
+    row.update(terminal_id=terminal_id, feature_ts=feature_ts)
+    return row
+
+
+class FakeQueryJob:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def result(self, page_size=None):
+        return self.rows
+
+
+class FakeViews:
+    """BigQuery client answering the sync query from in-memory view rows"""
+
+    def __init__(self):
+        self.views = {"customer_spending_features": [], "terminal_risk_features": []}
+        self.since = []
+
+    def query(self, query, job_config=None):
+        since = job_config.query_parameters[0].value
+        self.since.append(since)
+        view = next(name for name in self.views if name in query)
+        return FakeQueryJob([row for row in self.views[view] if row['feature_ts'] >= since])
+
+
+def test_lookup_returns_the_latest_row_at_or_before_the_transaction():
+    store = LocalFeatureStore(":memory:")
+    try:
+        store.bulk_load("customer_features", [customer_row("C1", NOW - 100, 1), customer_row("C1", NOW, 2)])
+        assert store.lookup("customer_features", "C1", NOW - 1) == \
+            (NOW - 100, {column: 1.0 for column in CUSTOMER_COLUMNS})
+        assert store.customer_features("C1", NOW)[CUSTOMER_COLUMNS[0]] == 2.0
+        assert store.lookup("customer_features", "C1", NOW - 200) == \
+            (None, {column: 0.0 for column in CUSTOMER_COLUMNS})
+    finally:
+        store.close()
+
+
+def test_sync_reads_new_rows_and_resync_re_reads_the_label_delay():
+    store = LocalFeatureStore(":memory:")
+    views = FakeViews()
+    views.views["terminal_risk_features"] = [terminal_row("T1", NOW - 3 * DAY, 0.0), terminal_row("T1", NOW, 0.0)]
+    try:
+        assert store.sync_from_bigquery(views, "project", "tx") == 2
+        assert views.since == [0, 0]
+
+        # A routine sync only reads a short lag behind the newest row
+        views.views["terminal_risk_features"][0] = terminal_row("T1", NOW - 3 * DAY, 0.5)
+        views.views["terminal_risk_features"].append(terminal_row("T1", NOW - 60, 0.0))
+        assert store.sync_from_bigquery(views, "project", "tx") == 2
+        assert views.since[-1] == NOW - SYNC_LAG_SECONDS
+        assert store.terminal_features("T1", NOW - 60)[TERMINAL_COLUMNS[1]] == 0.0
+        assert store.terminal_features("T1", NOW - DAY)[TERMINAL_COLUMNS[1]] == 0.0
+
+        # The label re-read picks up the late label on a row that was already synced
+        store.resync_labels(views, "project", "tx")
+        assert views.since[-1] == NOW - LABEL_DELAY_SECONDS
+        assert store.terminal_features("T1", NOW - DAY)[TERMINAL_COLUMNS[1]] == 0.5
+        assert store.stats() == {"customer_features": 0, "terminal_features": 3}
+    finally:
+        store.close()
+
+
+def test_sync_thread_re_reads_labels_on_its_own_schedule():
+    store = LocalFeatureStore(":memory:")
+    views = FakeViews()
+    # Recent enough to survive the prune after each sync
+    now = int(time.time())
+    views.views["customer_spending_features"] = [customer_row("C1", now, 1)]
+    try:
+        store.sync_from_bigquery(views, "project", "tx")
+        store.start_sync(views, "project", "tx", interval_seconds=0.01, resync_interval_seconds=0.2)
+        time.sleep(0.5)
+        store.stop_sync()
+        # Customer and terminal views alternate; the terminal table stays empty
+        customer_since = views.since[2::2]
+        assert customer_since.count(now - LABEL_DELAY_SECONDS) >= 1
+        assert customer_since.count(now - SYNC_LAG_SECONDS) > customer_since.count(now - LABEL_DELAY_SECONDS)
+    finally:
+        store.close()
+
+
+def test_prune_drops_rows_older_than_the_history():
+    store = LocalFeatureStore(":memory:")
+    try:
+        store.bulk_load("customer_features", [customer_row("C1", NOW - 16 * DAY, 1), customer_row("C1", NOW, 2)])
+        assert store.prune(now=NOW) == 1
+        assert store.stats()["customer_features"] == 1
+    finally:
+        store.close()
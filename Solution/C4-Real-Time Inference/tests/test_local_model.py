@@ -0,0 +1,82 @@
+import json
+
+import numpy as np
+import pytest
+
+from local_model import BoostedTreeModel, KMeansModel, LogisticRegressionModel, load_model
+
+LOGREG_ARTIFACT = {
+    'model_type': "LOGISTIC_REG",
+    'model_version': "logreg-v1",
+    'weights': [
+        {'processed_input': 'tx_amount', 'weight': 0.01},
+        {'processed_input': 'terminal_id_risk_1day_window', 'weight': 3.0},
+        {'processed_input': '__INTERCEPT__', 'weight': -2.0},
+    ],
+    'feature_info': [
+        {'input': 'tx_amount', 'mean': 50.0},
+        {'input': 'terminal_id_risk_1day_window', 'mean': 0.1},
+    ],
+}
+
+# Two stumps on tx_amount; a missing value goes the "no" way in the first
+TREES = [
+    {'nodeid': 0, 'split': 'tx_amount', 'split_condition': 100.0, 'yes': 1, 'no': 2, 'missing': 2,
+     'children': [{'nodeid': 1, 'leaf': -1.0}, {'nodeid': 2, 'leaf': 1.0}]},
+    {'nodeid': 0, 'split': 'f1', 'split_condition': 0.5, 'yes': 1, 'no': 2,
+     'children': [{'nodeid': 1, 'leaf': -0.5}, {'nodeid': 2, 'leaf': 0.5}]},
+]
+
+
+def sigmoid(margin):
+    return 1.0 / (1.0 + np.exp(-margin))
+
+
+def test_logistic_regression_imputes_training_means(tmp_path):
+    path = tmp_path / "logreg.json"
+    path.write_text(json.dumps(LOGREG_ARTIFACT))
+    model = load_model(str(path))
+    assert isinstance(model, LogisticRegressionModel)
+    assert model.model_version == "logreg-v1"
+
+    probabilities = model.score_features([
+        {'tx_amount': 200.0, 'terminal_id_risk_1day_window': 0.5},
+        {'tx_amount': 200.0, 'terminal_id_risk_1day_window': None},
+        {'tx_amount': 200.0},
+    ])
+    assert probabilities[0] == pytest.approx(sigmoid(2.0 + 1.5 - 2.0))
+    # NULL and absent inputs both take the training mean, as in BQML
+    assert probabilities[1] == pytest.approx(sigmoid(2.0 + 0.3 - 2.0))
+    assert probabilities[2] == pytest.approx(probabilities[1])
+
+
+def test_logistic_regression_without_means_rejects_missing_values():
+    artifact = dict(LOGREG_ARTIFACT)
+    del artifact['feature_info']
+    model = LogisticRegressionModel.from_artifact(artifact)
+    assert model.score_features([{'tx_amount': 0.0, 'terminal_id_risk_1day_window': 0.0}]) == \
+        [pytest.approx(sigmoid(-2.0))]
+    with pytest.raises(ValueError, match="feature_info"):
+        model.score_features([{'tx_amount': 0.0}])
+
+
+def test_boosted_trees_follow_splits_and_missing_branches():
+    model = BoostedTreeModel(TREES, ['tx_amount', 'terminal_id_risk_1day_window'], base_score=0.5)
+    X = np.array([[50.0, 0.0], [150.0, 1.0], [np.nan, 0.0]])
+    np.testing.assert_allclose(model.predict_proba(X), sigmoid(np.array([-1.5, 1.5, 0.5])))
+    assert model.score_features([]) == []
+
+
+def test_kmeans_scores_half_at_the_threshold():
+    model = KMeansModel(centroids=[[0.0, 0.0]], means=[10.0, 0.0], stddevs=[2.0, 0.0],
+                        feature_names=['tx_amount', 'terminal_id_risk_1day_window'], distance_threshold=3.0)
+    X = np.array([[10.0, 0.0], [16.0, 0.0], [np.nan, 4.0]])
+    np.testing.assert_allclose(model.distances(X), [0.0, 3.0, 4.0])
+    np.testing.assert_allclose(model.predict_proba(X), [0.0, 0.5, 4.0 / 7.0])
+
+
+def test_load_model_rejects_unknown_types(tmp_path):
+    path = tmp_path / "model.json"
+    path.write_text(json.dumps({'model_type': "dnn_classifier"}))
+    with pytest.raises(ValueError, match="Unsupported model_type"):
+        load_model(str(path))
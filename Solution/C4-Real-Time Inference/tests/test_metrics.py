@@ -0,0 +1,31 @@
+import urllib.request
+
+from metrics import InferenceMetrics, MetricsServer
+
+
+def test_metrics_server_binds_to_loopback_by_default():
+    metrics = InferenceMetrics()
+    metrics.degraded.inc("features")
+    server = MetricsServer(metrics.registry, 0).start()
+    try:
+        assert server._server.server_address[0] == "127.0.0.1"
+        with urllib.request.urlopen(f"http://127.0.0.1:{server.port}/metrics") as response:
+            body = response.read().decode("utf-8")
+        assert 'fraud_inference_degraded_total{reason="features"} 1' in body
+    finally:
+        server.close()
+
+
+def test_snapshots_from_other_processes_share_the_family_header():
+    supervisor = InferenceMetrics()
+    supervisor.stage_seconds.observe(0.002, "ack")
+    worker = InferenceMetrics()
+    worker.stage_seconds.observe(0.02, "features")
+    supervisor.registry.add_collector(
+        lambda: [family.with_label("worker", "0") for family in worker.registry.snapshot()])
+
+    body = supervisor.render()
+    assert body.count("# TYPE fraud_inference_stage_seconds histogram") == 1
+    assert 'fraud_inference_stage_seconds_count{stage="ack"} 1' in body
+    assert 'fraud_inference_stage_seconds_bucket{worker="0",stage="features",le="0.025"} 1' in body
+    assert 'fraud_inference_stage_seconds_count{worker="0",stage="features"} 1' in body
@@ -0,0 +1,166 @@
+import json
+import threading
+import time
+
+from benchmark import generate_transactions
+from fraud_online_inference import MessageBatcher
+
+NO_LATENCY = dict(bq_latency_ms=0, bq_jitter_ms=0, predict_latency_ms=0, predict_jitter_ms=0,
+                  insert_latency_ms=0, insert_jitter_ms=0)
+
+
+class StubMessage:
+    def __init__(self, transaction, delivery_attempt=1):
+        self.data = json.dumps(transaction).encode("utf-8")
+        self.delivery_attempt = delivery_attempt
+        self.settled = []
+
+    def ack(self):
+        self.settled.append("ack")
+
+    def nack(self):
+        self.settled.append("nack")
+
+
+def messages(count, seed=0):
+    return [StubMessage(transaction) for transaction in generate_transactions(count, seed=seed)]
+
+
+def settled(batch):
+    return [message.settled for message in batch]
+
+
+def count_predicted_instances(processor):
+    """Record how many instances each predict request sent"""
+    requests = []
+    predict = processor.endpoint.predict
+
+    def recording_predict(instances):
+        requests.append(len(instances))
+        return predict(instances)
+
+    processor.endpoint.predict = recording_predict
+    return requests
+
+
+def test_a_message_that_does_not_decode_is_nacked_alone(fake_processor):
+    processor = fake_processor(**NO_LATENCY)
+    batch = messages(3)
+    batch[1].data = b"not json"
+    processor.process_batch(batch)
+    assert settled(batch) == [["ack"], ["nack"], ["ack"]]
+    assert processor.bq_client.rows_inserted == 2
+
+
+def test_a_failed_feature_query_nacks_every_pending_message(fake_processor, monkeypatch):
+    processor = fake_processor(**NO_LATENCY)
+
+    def fail(transactions):
+        raise RuntimeError("feature query failed")
+
+    monkeypatch.setattr(processor, "get_features_batch", fail)
+    batch = messages(4)
+    processor.process_batch(batch)
+    assert settled(batch) == [["nack"]] * 4
+    assert processor.bq_client.rows_inserted == 0
+
+
+def test_a_failed_prediction_nacks_every_pending_message(fake_processor):
+    processor = fake_processor(predict_error_rate=1.0, **NO_LATENCY)
+    batch = messages(4)
+    processor.process_batch(batch)
+    assert settled(batch) == [["nack"]] * 4
+    assert processor.bq_client.rows_inserted == 0
+
+
+def test_only_rows_rejected_by_the_insert_are_nacked(fake_processor, monkeypatch):
+    processor = fake_processor(**NO_LATENCY)
+    inserted = []
+
+    def insert_rows_json(table, rows, row_ids=None):
+        inserted.append(row_ids)
+        return [{'index': 1, 'errors': [{'reason': "invalid"}]}, {'index': 3, 'errors': [{'reason': "invalid"}]}]
+
+    monkeypatch.setattr(processor.bq_client, "insert_rows_json", insert_rows_json)
+    batch = messages(5)
+    processor.process_batch(batch)
+    assert settled(batch) == [["ack"], ["nack"], ["ack"], ["nack"], ["ack"]]
+    # One streaming insert for the whole batch
+    assert len(inserted) == 1 and len(inserted[0]) == 5
+
+
+def test_redeliveries_in_a_batch_are_not_scored_again(fake_processor, monkeypatch):
+    processor = fake_processor(redelivery_index=100, **NO_LATENCY)
+    requests = count_predicted_instances(processor)
+    first = messages(3)
+
+    # The row of the second transaction is rejected: its prediction is kept, the message nacked
+    def reject_second_row(table, rows, row_ids=None):
+        return [{'index': 1, 'errors': [{'reason': "backendError"}]}]
+
+    monkeypatch.setattr(processor.bq_client, "insert_rows_json", reject_second_row)
+    processor.process_batch(first)
+    assert settled(first) == [["ack"], ["nack"], ["ack"]]
+    monkeypatch.undo()
+
+    # Redeliveries of a finished and a half-finished transaction, with a new one
+    redelivered = [StubMessage(json.loads(message.data), delivery_attempt=2) for message in first[:2]]
+    batch = redelivered + messages(1, seed=1)
+    processor.process_batch(batch)
+
+    assert settled(batch) == [["ack"], ["ack"], ["ack"]]
+    # Only the new transaction went to the model
+    assert requests == [3, 1]
+    assert processor.metrics.redeliveries.value("skipped") == 1
+    assert processor.metrics.redeliveries.value("reused") == 1
+
+
+class RecordingHandler:
+    def __init__(self, fail=False):
+        self.batches = []
+        self.fail = fail
+        self.called = threading.Event()
+
+    def __call__(self, batch):
+        self.batches.append((time.monotonic(), list(batch)))
+        self.called.set()
+        if self.fail:
+            raise RuntimeError("handler failed")
+
+
+def test_batcher_flushes_a_full_batch_without_waiting():
+    handler = RecordingHandler()
+    batcher = MessageBatcher(handler, max_messages=3, max_latency_ms=10000)
+    try:
+        batch = messages(3)
+        for message in batch:
+            batcher.add(message)
+        assert handler.called.wait(2)
+        assert handler.batches[0][1] == batch
+    finally:
+        batcher.close()
+
+
+def test_batcher_flushes_a_partial_batch_after_the_latency():
+    handler = RecordingHandler()
+    batcher = MessageBatcher(handler, max_messages=50, max_latency_ms=100)
+    try:
+        added_at = time.monotonic()
+        batch = messages(2)
+        for message in batch:
+            batcher.add(message)
+        assert handler.called.wait(2)
+        flushed_at, flushed = handler.batches[0]
+        assert flushed == batch
+        assert flushed_at - added_at >= 0.09
+    finally:
+        batcher.close()
+
+
+def test_batcher_nacks_a_batch_whose_handler_raises():
+    batcher = MessageBatcher(RecordingHandler(fail=True), max_messages=2, max_latency_ms=10000)
+    batch = messages(2)
+    for message in batch:
+        batcher.add(message)
+    batcher.close()
+    assert settled(batch) == [["nack"], ["nack"]]
@@ -0,0 +1,105 @@
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from offline_features import (CUSTOMER_COLUMNS, TERMINAL_COLUMNS, check_parity, customer_spending_features,
+                              synthetic_transactions, terminal_risk_features, transaction_features)
+from window_features import HISTORY_SECONDS, LABEL_DELAY_SECONDS, StreamingWindowFeatures
+
+START = datetime(2024, 5, 1, tzinfo=timezone.utc)
+DAY = 86400
+
+
+def frame(rows):
+    """rows of (seconds after START, customer, terminal, amount, label or None)"""
+    transactions = pd.DataFrame([
+        {'TX_ID': f"tx{idx}", 'TX_TS': START + timedelta(seconds=seconds), 'CUSTOMER_ID': customer,
+         'TERMINAL_ID': terminal, 'TX_AMOUNT': amount, 'TX_FRAUD': label}
+        for idx, (seconds, customer, terminal, amount, label) in enumerate(rows)
+    ])
+    transactions['TX_FRAUD'] = transactions['TX_FRAUD'].astype('Int64')
+    return transactions
+
+
+def test_same_second_peers_see_each_other():
+    transactions = frame([(0, "c", "t", 10.0, 0), (0, "c", "t", 30.0, None)])
+    customer = customer_spending_features(transactions)
+    # RANGE ... CURRENT ROW includes peers with the same seconds, in both directions
+    assert customer["customer_id_nb_tx_15min_window"].tolist() == [1, 1]
+    assert customer["customer_id_avg_amount_15min_window"].tolist() == [20.0, 20.0]
+
+
+def test_window_bound_is_inclusive():
+    transactions = frame([(0, "c", "t", 10.0, 0), (900, "c", "t", 10.0, 0), (901 + 900, "c", "t", 10.0, 0)])
+    customer = customer_spending_features(transactions)
+    assert customer["customer_id_nb_tx_15min_window"].tolist() == [1, 2, 1]
+
+
+def test_labels_in_the_delay_period_are_excluded_from_the_risk():
+    transactions = frame([
+        (0, "c", "t", 10.0, 1),
+        (8 * DAY, "c", "t", 10.0, 0),
+        (8 * DAY + 60, "c", "t", 10.0, 1),
+    ])
+    terminal = terminal_risk_features(transactions)
+    last = terminal.iloc[-1]
+    # Only the fraud 8 days back is older than the delay; it falls in the 7-day window, not the 1-day one
+    assert last["terminal_id_nb_tx_1day_window"] == 0
+    assert last["terminal_id_nb_tx_7day_window"] == 1
+    assert last["terminal_id_risk_7day_window"] == pytest.approx(1 / 1.0001)
+
+
+def test_risk_is_null_without_labels_in_the_delay_period():
+    transactions = frame([(0, "c", "t", 10.0, 1), (8 * DAY, "c", "t", 10.0, None)])
+    terminal = terminal_risk_features(transactions)
+    last = terminal.iloc[-1]
+    for column in TERMINAL_COLUMNS:
+        if "risk" in column:
+            assert np.isnan(last[column])
+    # COUNT(TX_FRAUD) stays a number
+    assert last["terminal_id_nb_tx_7day_window"] == 1
+    # NULL features reach the model as 0
+    assert transaction_features(transactions).iloc[-1]["terminal_id_risk_7day_window"] == 0.0
+
+
+def test_history_bound_applies_per_row():
+    # The fraud is 20 days back: inside delay + 14 days, outside the 15-day history
+    transactions = frame([(0, "c", "t", 10.0, 1), (20 * DAY - 60, "c", "t", 10.0, 0), (20 * DAY, "c", "t", 10.0, 0)])
+    bounded = terminal_risk_features(transactions).iloc[-1]
+    unbounded = terminal_risk_features(transactions, history_seconds=None).iloc[-1]
+    assert bounded["terminal_id_nb_tx_14day_window"] == 0
+    assert unbounded["terminal_id_nb_tx_14day_window"] == 1
+    assert HISTORY_SECONDS < LABEL_DELAY_SECONDS + 14 * DAY
+
+
+@pytest.mark.parametrize("history_seconds", [HISTORY_SECONDS, None])
+def test_parity_with_the_sql_semantics(history_seconds):
+    transactions = synthetic_transactions(count=3000, customers=40, terminals=60, days=30, seed=1)
+    assert check_parity(transactions, max_entities=15, history_seconds=history_seconds) == []
+
+
+def test_parity_with_the_streaming_engine():
+    transactions = synthetic_transactions(count=4000, customers=40, terminals=60, days=30, seed=2)
+    offline = transaction_features(transactions)
+
+    # Replay in time order, observing every same-second peer before looking any of them up
+    streaming = StreamingWindowFeatures()
+    order = transactions.sort_values('TX_TS', kind='stable')
+    rows = {}
+    for _, group in order.groupby('TX_TS', sort=True):
+        records = group.to_dict('records')
+        for record in records:
+            label = record['TX_FRAUD']
+            streaming.observe(record, None if pd.isna(label) else int(label))
+        for index, record in zip(group.index, records):
+            features = {}
+            features.update(streaming.customer_features(record['CUSTOMER_ID'], record['TX_TS']))
+            features.update(streaming.terminal_features(record['TERMINAL_ID'], record['TX_TS']))
+            rows[index] = features
+    online = pd.DataFrame.from_dict(rows, orient='index').sort_index()
+
+    for column in CUSTOMER_COLUMNS + TERMINAL_COLUMNS:
+        np.testing.assert_allclose(online[column].to_numpy(), offline[column].to_numpy(), rtol=1e-9, atol=1e-6,
+                                   err_msg=column)
@@ -0,0 +1,94 @@
+import threading
+import time
+
+import pytest
+
+from benchmark import FakeTable
+from prediction_writer import PredictionWriter
+
+
+def row(tx_id):
+    return {'TX_ID': str(tx_id), 'fraud_probability': 0.1}
+
+
+class RecordingCallbacks:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.results = {}
+
+    def callback(self, tx_id):
+        def record(ok):
+            with self._lock:
+                self.results[tx_id] = ok
+        return record
+
+
+def test_rows_are_flushed_in_batches_with_callbacks(fake_bq_client):
+    writer = PredictionWriter(fake_bq_client, FakeTable(), max_batch_rows=10, max_latency_ms=50)
+    callbacks = RecordingCallbacks()
+    for tx_id in range(25):
+        writer.submit(row(tx_id), callbacks.callback(tx_id))
+    writer.close()
+
+    assert fake_bq_client.rows_inserted == 25
+    assert callbacks.results == {tx_id: True for tx_id in range(25)}
+    stats = writer.stats()
+    assert stats['rows_written'] == 25 and stats['rows_failed'] == 0
+    assert stats['flushes'] >= 3
+
+
+def test_failed_inserts_call_back_false(failing_bq_client):
+    writer = PredictionWriter(failing_bq_client, FakeTable(), max_batch_rows=5, max_latency_ms=10)
+    callbacks = RecordingCallbacks()
+    for tx_id in range(7):
+        writer.submit(row(tx_id), callbacks.callback(tx_id))
+    writer.close()
+    assert callbacks.results == {tx_id: False for tx_id in range(7)}
+    assert writer.stats()['rows_failed'] == 7
+
+
+def test_insert_ids_come_from_row_id():
+    seen = []
+
+    class Client:
+        def insert_rows_json(self, table, rows, row_ids=None):
+            seen.extend(row_ids)
+            return [{'index': 1, 'errors': ["invalid"]}]
+
+    writer = PredictionWriter(Client(), FakeTable(), max_batch_rows=2, max_latency_ms=1000,
+                              row_id=lambda r: f"{r['TX_ID']}:shadow")
+    callbacks = RecordingCallbacks()
+    writer.submit(row(1), callbacks.callback(1))
+    writer.submit(row(2), callbacks.callback(2))
+    writer.close()
+    assert seen == ["1:shadow", "2:shadow"]
+    assert callbacks.results == {1: True, 2: False}
+
+
+def test_submit_after_close_raises(fake_bq_client):
+    writer = PredictionWriter(fake_bq_client, FakeTable())
+    writer.close()
+    with pytest.raises(RuntimeError):
+        writer.submit(row(1))
+
+
+def test_row_submitted_while_closing_is_still_written(fake_bq_client):
+    writer = PredictionWriter(fake_bq_client, FakeTable(), max_latency_ms=1)
+    callbacks = RecordingCallbacks()
+    put = writer._queue.put
+
+    def late_put(item):
+        # Past the closed check, reach the queue only once close is under way
+        # (or, without the fix, once the writer thread has already stopped)
+        while not (getattr(writer, "_closing", False) or not writer._thread.is_alive()):
+            time.sleep(0.001)
+        put(item)
+
+    writer._queue.put = late_put
+    submitter = threading.Thread(target=writer.submit, args=(row(1), callbacks.callback(1)))
+    submitter.start()
+    time.sleep(0.05)
+    writer.close()
+    submitter.join()
+    assert callbacks.results == {1: True}
+    assert fake_bq_client.rows_inserted == 1
@@ -0,0 +1,80 @@
+import json
+
+from redelivery_index import DONE, RedeliveryIndex
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class StubMessage:
+    def __init__(self, transaction):
+        self.data = json.dumps(transaction).encode("utf-8")
+        self.delivery_attempt = 1
+        self.settled = []
+
+    def ack(self):
+        self.settled.append("ack")
+
+    def nack(self):
+        self.settled.append("nack")
+
+
+def test_newest_state_wins_and_entries_expire_by_bucket():
+    clock = FakeClock()
+    index = RedeliveryIndex(max_entries=100, ttl_seconds=60, num_buckets=6, clock=clock)
+    index.record_prediction({'TX_ID': "1", 'fraud_probability': 0.2})
+    assert index.lookup("1") == {'TX_ID': "1", 'fraud_probability': 0.2}
+
+    clock.now = 15
+    index.mark_done("1")
+    assert index.lookup("1") is DONE
+    assert index.stats()['size'] == 1
+
+    clock.now = 15 + 61
+    assert index.lookup("1") is None
+    stats = index.stats()
+    assert (stats['size'], stats['expired'], stats['skipped'], stats['reused']) == (0, 1, 1, 1)
+
+
+def test_oldest_bucket_is_evicted_over_max_entries():
+    clock = FakeClock()
+    index = RedeliveryIndex(max_entries=3, ttl_seconds=60, num_buckets=6, clock=clock)
+    index.mark_done("1")
+    index.mark_done("2")
+    clock.now = 10
+    index.mark_done("3")
+    index.mark_done("4")
+    assert index.lookup("1") is None and index.lookup("2") is None
+    assert index.lookup("4") is DONE
+    assert index.stats()['evicted'] == 2
+
+
+def test_processor_reuses_then_skips_redelivered_transactions(fake_processor):
+    processor = fake_processor(redelivery_index=1000, insert_error_rate=1.0)
+    client = processor.bq_client
+    transaction = {'TX_ID': "tx-1", 'TX_TS': "2024-05-01 10:00:00 UTC", 'CUSTOMER_ID': "C1",
+                   'TERMINAL_ID': "T1", 'TX_AMOUNT': 12.5}
+
+    first = StubMessage(transaction)
+    processor.process_message(first)
+    assert first.settled == ["nack"]
+    queries = client.query_service.calls
+
+    # The insert works now: the earlier prediction is persisted without scoring again
+    client.insert_service.error_rate = 0.0
+    second = StubMessage(transaction)
+    processor.process_message(second)
+    assert second.settled == ["ack"]
+    assert client.query_service.calls == queries
+    assert client.rows_inserted == 1
+
+    third = StubMessage(transaction)
+    processor.process_message(third)
+    assert third.settled == ["ack"]
+    assert client.rows_inserted == 1
+    assert processor.redelivery_index.stats()['skipped'] == 1
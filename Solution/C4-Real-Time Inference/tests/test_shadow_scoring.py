@@ -0,0 +1,153 @@
+import json
+import threading
+import time
+
+from benchmark import FakeTable, generate_transactions
+from metrics import Counter
+from prediction_writer import PredictionWriter
+from shadow_scoring import ShadowScorer
+from test_micro_batch import NO_LATENCY, messages, settled
+from transaction_record import TransactionRecord
+
+
+class RecordingModel:
+    """Shadow model that scores 0.9, optionally only once `release` is set"""
+
+    def __init__(self, release=None):
+        self.release = release
+        self.batches = []
+
+    def predict(self, features_list):
+        if self.release is not None:
+            self.release.wait(5)
+        self.batches.append(len(features_list))
+        return [0.9] * len(features_list), "shadow-v1"
+
+
+class FailingModel:
+    def predict(self, features_list):
+        raise RuntimeError("shadow endpoint unavailable")
+
+
+class RecordingWriter:
+    def __init__(self):
+        self.rows = []
+        self.closed = False
+
+    def submit(self, row, callback=None):
+        self.rows.append(row)
+
+    def close(self):
+        self.closed = True
+
+
+def scored_batch(count):
+    transactions = [TransactionRecord.from_json(json.dumps(payload)) for payload in generate_transactions(count)]
+    features = [{'tx_amount': transaction['TX_AMOUNT']} for transaction in transactions]
+    return transactions, features, [0.1] * count, "primary-v1"
+
+
+def shadow_counter():
+    return Counter("shadow_total", "Shadow predictions", ("model", "outcome"))
+
+
+def test_a_full_queue_drops_the_transaction_and_counts_it():
+    release = threading.Event()
+    counter = shadow_counter()
+    scorer = ShadowScorer({"slow": RecordingModel(release)}, RecordingWriter(), workers_per_model=1,
+                          max_batch=1, max_queue_size=2, counter=counter)
+    try:
+        # The worker takes the first transaction and blocks on it; two more fill the queue
+        scorer.submit(*scored_batch(1))
+        while scorer.stats()['queued']:
+            time.sleep(0.01)
+        scorer.submit(*scored_batch(4))
+        assert scorer.stats()['dropped'] == 2
+        assert counter.value("slow", "dropped") == 2
+    finally:
+        release.set()
+        scorer.close()
+    assert scorer.stats()['scored'] == 3
+
+
+def test_a_batch_that_reaches_the_stop_marker_puts_it_back():
+    # No threads: the test takes the batches itself
+    scorer = ShadowScorer({"shadow": RecordingModel()}, RecordingWriter(), workers_per_model=0, max_batch=10)
+    shadow_queue = scorer._queues["shadow"]
+    scorer.submit(*scored_batch(3))
+    shadow_queue.put(None)
+    assert len(scorer._next_batch(shadow_queue)) == 3
+    # The marker is still there for the thread's next call
+    assert shadow_queue.get_nowait() is None and shadow_queue.empty()
+
+
+def test_close_scores_everything_queued_before_stopping():
+    release = threading.Event()
+    model = RecordingModel(release)
+    writer = RecordingWriter()
+    scorer = ShadowScorer({"shadow": model}, writer, workers_per_model=3, max_batch=50)
+    scorer.submit(*scored_batch(40))
+    # The stop markers queue up behind the transactions
+    closing = threading.Thread(target=scorer.close)
+    closing.start()
+    release.set()
+    closing.join(5)
+    assert not closing.is_alive()
+    assert sum(model.batches) == 40 and len(writer.rows) == 40
+    assert writer.closed
+
+
+def test_shadow_rows_are_keyed_by_transaction_and_model(fake_bq_client):
+    inserted = []
+    insert_rows_json = fake_bq_client.insert_rows_json
+
+    def recording_insert(table, rows, row_ids=None):
+        inserted.extend(row_ids)
+        return insert_rows_json(table, rows, row_ids)
+
+    fake_bq_client.insert_rows_json = recording_insert
+    writer = PredictionWriter(fake_bq_client, FakeTable(), 10, 10, row_id=ShadowScorer.row_id)
+    scorer = ShadowScorer({"a": RecordingModel(), "b": RecordingModel()}, writer)
+    transactions, features, probabilities, version = scored_batch(3)
+    scorer.submit(transactions, features, probabilities, version)
+    scorer.close()
+
+    assert ShadowScorer.row_id({'TX_ID': "t1", 'model_name': "a"}) == "t1:a"
+    assert sorted(inserted) == sorted(f"{transaction.tx_id}:{name}"
+                                      for transaction in transactions for name in ("a", "b"))
+
+
+def test_a_failing_shadow_is_counted_and_never_reaches_the_message(fake_processor):
+    processor = fake_processor(**NO_LATENCY)
+    writer = RecordingWriter()
+    processor.shadow_scorer = ShadowScorer({"broken": FailingModel()}, writer, counter=processor.metrics.shadow)
+    batch = messages(5)
+    for message in batch:
+        processor.process_message(message)
+    processor.process_batch(messages(5, seed=1))
+    processor.shadow_scorer.close()
+
+    assert settled(batch) == [["ack"]] * 5
+    assert processor.shadow_scorer.stats()['failed'] == 10
+    assert processor.metrics.shadow.value("broken", "failed") == 10
+    assert writer.rows == []
+
+
+def test_degraded_predictions_are_not_shadowed(fake_processor, monkeypatch):
+    processor = fake_processor(**NO_LATENCY)
+    model = RecordingModel()
+    processor.shadow_scorer = ShadowScorer({"shadow": model}, RecordingWriter())
+
+    def fallback_features_within(transaction_data, deadline):
+        return processor.fallback_features(transaction_data), True
+
+    monkeypatch.setattr(processor, "get_features_within", fallback_features_within)
+    degraded = messages(3)
+    for message in degraded:
+        processor.process_message(message)
+    monkeypatch.undo()
+    processor.process_message(messages(1, seed=1)[0])
+    processor.shadow_scorer.close()
+
+    assert settled(degraded) == [["ack"]] * 3
+    assert sum(model.batches) == 1
@@ -0,0 +1,116 @@
+import json
+import os
+import queue
+import time
+
+from metrics import InferenceMetrics
+from sharded import ShardedSupervisor, shard_for
+
+
+class ScriptedProcessor:
+    """
+    Stands in for FraudDetectionProcessor in the worker processes: acks after
+    the payload's "sleep", counts the message in its metrics, and exits the
+    process on a "die" payload
+    """
+
+    hedger = prediction_writer = shadow_scorer = None
+
+    def __init__(self):
+        self.metrics = InferenceMetrics()
+
+    def warm_up(self):
+        pass
+
+    def process_message(self, message):
+        payload = json.loads(message.data)
+        if payload.get('die'):
+            os._exit(1)
+        time.sleep(payload.get('sleep', 0.0))
+        self.metrics.degraded.inc("features")
+        message.ack()
+
+
+class RecordedMessage:
+    def __init__(self, payload, settled):
+        self.payload = payload
+        self.data = json.dumps(payload).encode("utf-8")
+        self._settled = settled
+
+    def ack(self):
+        self._settled.put((self.payload, True))
+
+    def nack(self):
+        self._settled.put((self.payload, False))
+
+
+def settle_all(supervisor, payloads, timeout=30.0):
+    settled = queue.Queue()
+    for payload in payloads:
+        supervisor.dispatch(RecordedMessage(payload, settled))
+    return [settled.get(timeout=timeout) for _ in payloads]
+
+
+def test_shard_for_is_stable_and_in_range():
+    shards = {customer_id: shard_for(customer_id, 3, 4) for customer_id in range(1000)}
+    assert all(shard_for(customer_id, 3, 4) == shard for customer_id, shard in shards.items())
+    assert set(shards.values()) == {(worker, lane) for worker in range(3) for lane in range(4)}
+
+
+def test_each_customer_is_settled_in_arrival_order():
+    supervisor = ShardedSupervisor(2, ScriptedProcessor, lanes=2, monitor_interval=0.1)
+    supervisor.start(timeout=60)
+    try:
+        # Alternating sleeps would reorder a customer's messages if they ran concurrently
+        payloads = [
+            {'CUSTOMER_ID': str(customer), 'seq': seq, 'sleep': 0.02 if seq % 2 == 0 else 0.0}
+            for seq in range(6) for customer in range(8)
+        ]
+        results = settle_all(supervisor, payloads)
+    finally:
+        supervisor.close()
+
+    assert all(acked for _, acked in results)
+    for customer in range(8):
+        sequence = [payload['seq'] for payload, _ in results if payload['CUSTOMER_ID'] == str(customer)]
+        assert sequence == list(range(6))
+
+
+def test_dead_worker_is_restarted_and_its_messages_nacked():
+    supervisor = ShardedSupervisor(1, ScriptedProcessor, lanes=1, monitor_interval=0.1)
+    supervisor.start(timeout=60)
+    first_pid = supervisor._processes[0].pid
+    try:
+        # Queued behind the message that kills the worker
+        results = settle_all(supervisor, [{'CUSTOMER_ID': "1", 'die': True}, {'CUSTOMER_ID': "1", 'seq': 1}])
+        assert [acked for _, acked in results] == [False, False]
+
+        deadline = time.monotonic() + 10
+        while supervisor._processes[0].pid == first_pid:
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+        assert settle_all(supervisor, [{'CUSTOMER_ID': "1", 'seq': 2}]) == [({'CUSTOMER_ID': "1", 'seq': 2}, True)]
+    finally:
+        supervisor.close()
+
+
+def test_supervisor_serves_worker_metrics_with_a_worker_label():
+    supervisor = ShardedSupervisor(2, ScriptedProcessor, lanes=1, metrics_interval=0.05)
+    supervisor.start(timeout=60)
+    try:
+        payloads = [{'CUSTOMER_ID': str(customer)} for customer in range(20)]
+        settle_all(supervisor, payloads)
+    finally:
+        supervisor.close()
+
+    body = supervisor.metrics.render()
+    workers = {shard_for(str(customer), 2, 1)[0] for customer in range(20)}
+    for worker in workers:
+        assert f'fraud_inference_degraded_total{{worker="{worker}",reason="features"}}' in body
+    counts = [float(line.rsplit(" ", 1)[1]) for line in body.splitlines()
+              if line.startswith("fraud_inference_degraded_total{")]
+    assert sum(counts) == 20
+    # One header per family, and the workers' settlement metrics are left to the supervisor
+    assert body.count("# TYPE fraud_inference_degraded_total") == 1
+    assert 'fraud_inference_messages_total{outcome="acked"} 20.0' in body
+    assert 'fraud_inference_messages_total{worker=' not in body
@@ -0,0 +1,94 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from offline_features import (CUSTOMER_COLUMNS, TERMINAL_COLUMNS, customer_spending_features,
+                              synthetic_transactions, terminal_risk_features)
+from training_set_builder import OUTPUT_COLUMNS, build_training_set, check_join, point_in_time_join
+
+
+def feature_rows(id_column, columns, rows):
+    """Feature frame from (entity_id, feature_ts, value) tuples; every column gets the value"""
+    frame = pd.DataFrame(rows, columns=[id_column, 'feature_ts', 'value'])
+    frame['feature_ts'] = pd.to_datetime(frame['feature_ts'], utc=True)
+    for column in columns:
+        frame[column] = frame['value'].astype(float)
+    return frame.drop(columns='value')
+
+
+def transactions_frame(rows):
+    frame = pd.DataFrame(rows, columns=['TX_TS', 'CUSTOMER_ID', 'TERMINAL_ID', 'TX_AMOUNT', 'TX_FRAUD'])
+    frame['TX_TS'] = pd.to_datetime(frame['TX_TS'], utc=True)
+    frame['TX_FRAUD'] = frame['TX_FRAUD'].astype('Int64')
+    return frame
+
+
+def test_check_join_matches_the_row_by_row_lookup():
+    assert check_join(synthetic_transactions(count=3000, days=20)) == []
+
+
+def test_as_of_join_uses_the_latest_row_at_or_before_the_transaction():
+    transactions = transactions_frame([
+        ("2024-01-10 12:00:00", "C1", "T1", 10.0, 0),
+        ("2024-01-10 12:00:05", "C1", "T1", 20.0, 1),
+        ("2024-01-30 12:00:00", "C1", "T1", 30.0, None),
+    ])
+    customer = feature_rows('customer_id', CUSTOMER_COLUMNS, [
+        ("C1", "2024-01-10 11:00:00", 1.0),
+        ("C1", "2024-01-10 12:00:00", 2.0),
+        # Written just after the second transaction: must not leak into it
+        ("C1", "2024-01-10 12:00:06", 3.0),
+    ])
+    terminal = feature_rows('terminal_id', TERMINAL_COLUMNS, [("T1", "2024-01-01 00:00:00", 0.5)])
+
+    joined = point_in_time_join(transactions, customer, terminal, labelled_only=False)
+    assert list(joined.columns) == OUTPUT_COLUMNS
+    assert joined[CUSTOMER_COLUMNS[0]].tolist()[:2] == [2.0, 2.0]
+    # The only rows are more than 15 days older than the last transaction: NULL, as in the LEFT JOINs
+    assert np.isnan(joined[CUSTOMER_COLUMNS[0]].iloc[2])
+    assert np.isnan(joined[TERMINAL_COLUMNS[0]].iloc[2])
+    assert joined[TERMINAL_COLUMNS[0]].tolist()[:2] == [0.5, 0.5]
+
+    labelled = point_in_time_join(transactions, customer, terminal)
+    assert labelled['tx_fraud'].tolist() == [0, 1]
+
+
+@pytest.fixture
+def exports(tmp_path):
+    transactions = synthetic_transactions(count=2000, days=6)
+    paths = {}
+    for name, frame in (("tx", transactions), ("customer", customer_spending_features(transactions)),
+                        ("terminal", terminal_risk_features(transactions))):
+        paths[name] = str(tmp_path / f"{name}.parquet")
+        frame.to_parquet(paths[name], index=False)
+    return transactions, paths, str(tmp_path / "train_data")
+
+
+def test_build_writes_day_partitions_and_only_rebuilds_changed_days(exports):
+    transactions, paths, output_dir = exports
+    arguments = ([paths["tx"]], [paths["customer"]], [paths["terminal"]], output_dir)
+    days = transactions['TX_TS'].dt.floor('D')
+    day_count = days.nunique()
+
+    summary = build_training_set(*arguments, workers=0)
+    assert summary['built'] == day_count and summary['skipped'] == 0
+    assert summary['rows'] == int(transactions['TX_FRAUD'].notna().sum())
+    partitions = sorted(name for name in os.listdir(output_dir) if name.startswith("date="))
+    assert partitions[0] == "date=2024-01-01" and len(partitions) == day_count
+
+    assert build_training_set(*arguments, workers=0)['built'] == 0
+
+    # A late label only rebuilds the day of its transaction
+    unlabelled = transactions.index[transactions['TX_FRAUD'].isna()][0]
+    transactions.loc[unlabelled, 'TX_FRAUD'] = 1
+    transactions.to_parquet(paths["tx"], index=False)
+    summary = build_training_set(*arguments, workers=0)
+    assert (summary['built'], summary['skipped']) == (1, day_count - 1)
+
+    # --start/--end pick the days
+    first_day = days.min().strftime("%Y-%m-%d")
+    second_day = (days.min() + pd.Timedelta(days=1)).strftime("%Y-%m-%d")
+    rebuilt = build_training_set(*arguments, start=first_day, end=second_day, workers=0, force=True)
+    assert (rebuilt['built'], rebuilt['skipped']) == (1, 0)
@@ -0,0 +1,126 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from window_features import HISTORY_SECONDS, StreamingWindowFeatures, to_unix_seconds
+
+START = datetime(2024, 5, 1, tzinfo=timezone.utc)
+
+
+def transaction(tx_id, seconds, customer_id="c1", terminal_id="t1", amount=10.0):
+    return {
+        'TX_ID': tx_id,
+        'TX_TS': START + timedelta(seconds=seconds),
+        'CUSTOMER_ID': customer_id,
+        'TERMINAL_ID': terminal_id,
+        'TX_AMOUNT': amount,
+    }
+
+
+def test_to_unix_seconds_formats():
+    expected = int(START.timestamp())
+    assert to_unix_seconds(START) == expected
+    assert to_unix_seconds(START.replace(tzinfo=None)) == expected
+    assert to_unix_seconds("2024-05-01 00:00:00 UTC") == expected
+    assert to_unix_seconds("2024-05-01T00:00:00.750Z") == expected
+    assert to_unix_seconds(expected + 0.9) == expected
+
+
+def test_customer_windows_count_labelled_and_average_every_transaction():
+    features = StreamingWindowFeatures()
+    features.observe(transaction("a", 0, amount=10.0), tx_fraud=0)
+    features.observe(transaction("b", 600, amount=20.0))
+    features.observe(transaction("c", 2000, amount=60.0), tx_fraud=1)
+
+    result = features.customer_features("c1", START + timedelta(seconds=2000))
+    # 15 and 30 min: only c (b is 1400 s old, a 2000 s)
+    assert result["customer_id_nb_tx_15min_window"] == 1
+    assert result["customer_id_avg_amount_15min_window"] == 60.0
+    assert result["customer_id_nb_tx_30min_window"] == 1
+    assert result["customer_id_avg_amount_30min_window"] == 40.0
+    # 60 min: all three, b is unlabelled so not counted
+    assert result["customer_id_nb_tx_60min_window"] == 2
+    assert result["customer_id_avg_amount_60min_window"] == pytest.approx(30.0)
+
+
+def test_window_bound_is_inclusive():
+    features = StreamingWindowFeatures()
+    features.observe(transaction("a", 0), tx_fraud=0)
+    features.observe(transaction("b", 900), tx_fraud=0)
+    result = features.customer_features("c1", START + timedelta(seconds=900))
+    # RANGE BETWEEN 900 PRECEDING AND CURRENT ROW includes a row exactly 900 s back
+    assert result["customer_id_nb_tx_15min_window"] == 2
+
+
+def test_terminal_risk_uses_only_labels_older_than_the_delay():
+    features = StreamingWindowFeatures()
+    features.observe(transaction("old", 0), tx_fraud=1)
+    features.observe(transaction("recent", 9 * 86400 - 3600), tx_fraud=0)
+    features.observe(transaction("now", 9 * 86400))
+
+    result = features.terminal_features("t1", START + timedelta(seconds=9 * 86400))
+    assert result["terminal_id_nb_tx_1day_window"] == 0
+    assert result["terminal_id_nb_tx_7day_window"] == 1
+    assert result["terminal_id_risk_7day_window"] == pytest.approx(1 / 1.0001)
+    assert result["terminal_id_risk_1day_window"] == 0.0
+
+
+def test_terminal_risk_is_zero_without_labels_in_the_delay_period():
+    features = StreamingWindowFeatures()
+    # Labelled fraud 8 days back, but the last 7 days hold no labelled transaction
+    features.observe(transaction("old", 0), tx_fraud=1)
+    features.observe(transaction("unlabelled", 6 * 86400))
+    features.observe(transaction("now", 8 * 86400))
+
+    result = features.terminal_features("t1", START + timedelta(seconds=8 * 86400))
+    # The view's SUM(TX_FRAUD) over the delay period is NULL, so every risk is NULL (0 online)
+    for window in ("15min", "30min", "60min", "1day", "7day", "14day"):
+        assert result[f"terminal_id_risk_{window}_window"] == 0.0
+    # COUNT(TX_FRAUD) is never NULL: the old labelled transaction still counts
+    assert result["terminal_id_nb_tx_7day_window"] == 1
+
+    # Once a transaction in the delay period is labelled, the risk is back
+    features.observe_label("unlabelled", 0)
+    result = features.terminal_features("t1", START + timedelta(seconds=8 * 86400))
+    assert result["terminal_id_risk_7day_window"] == pytest.approx(1 / 1.0001)
+
+
+def test_labels_arriving_before_their_transaction_are_attached():
+    features = StreamingWindowFeatures()
+    features.observe_label("a", 1)
+    features.observe(transaction("a", 0))
+    features.observe(transaction("b", 8 * 86400), tx_fraud=0)
+    result = features.terminal_features("t1", START + timedelta(seconds=8 * 86400))
+    assert result["terminal_id_risk_1day_window"] == pytest.approx(1 / 1.0001)
+
+
+def test_history_horizon_drops_old_transactions():
+    features = StreamingWindowFeatures()
+    features.observe(transaction("old", 0), tx_fraud=0)
+    features.observe(transaction("new", HISTORY_SECONDS + 1), tx_fraud=0)
+    result = features.customer_features("c1", START + timedelta(seconds=HISTORY_SECONDS + 1))
+    assert result["customer_id_nb_tx_14day_window"] == 1
+
+
+def test_observe_is_idempotent_per_transaction():
+    features = StreamingWindowFeatures()
+    assert features.observe(transaction("a", 0))
+    assert not features.observe(transaction("a", 0))
+    assert features.stats()['transactions'] == 1
+
+
+def test_out_of_order_arrivals_stay_sorted():
+    features = StreamingWindowFeatures()
+    features.observe(transaction("b", 600), tx_fraud=0)
+    features.observe(transaction("a", 0), tx_fraud=0)
+    # As of 300 s only a exists
+    result = features.customer_features("c1", START + timedelta(seconds=300))
+    assert result["customer_id_nb_tx_15min_window"] == 1
+
+
+def test_get_features_includes_the_transaction_itself():
+    features = StreamingWindowFeatures()
+    result = features.get_features(transaction("a", 0, amount=42.0))
+    assert result["tx_amount"] == 42.0
+    assert result["customer_id_avg_amount_15min_window"] == 42.0
+    assert result["customer_id_nb_tx_15min_window"] == 0
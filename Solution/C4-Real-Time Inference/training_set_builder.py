@@ -0,0 +1,403 @@
+# Point-in-time training set (tx.train_data / tx.predict_data) built per day partition
+#
+#   python offline_features.py tx_with_labels.parquet --output-dir features/
+#   python training_set_builder.py tx_with_labels.parquet \
+#       --customer-features features/customer_spending_features.parquet \
+#       --terminal-features features/terminal_risk_features.parquet \
+#       --output-dir train_data/ --start 2024-05-01 --end 2024-05-11
+#   python training_set_builder.py --check
+#
+# Inputs are Parquet files (or directories of them) with timestamp columns:
+# - transactions: TX_TS, CUSTOMER_ID, TERMINAL_ID, TX_AMOUNT, TX_FRAUD (tx.tx LEFT JOIN tx.txlabels)
+# - feature tables: the customer_spending_features and terminal_risk_features
+#   views, exported from BigQuery or written by offline_features.py
+#
+# Every transaction gets the latest feature row of its customer and of its
+# terminal with feature_ts <= TX_TS (at most HISTORY_SECONDS older), instead of
+# the exact timestamp equality of BigQueryML_Deploy.sql, which drops rows whose
+# features were written at a slightly different time and duplicates rows with
+# same-second peers. Each UTC day is joined by its own worker process and written
+# to output_dir/date=YYYY-MM-DD/part-0.parquet; _manifest.json records a
+# fingerprint of every partition's inputs, so a rebuild only redoes the days
+# whose transactions, labels or feature rows changed.
+import argparse
+import hashlib
+import json
+import logging
+import math
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from export_files import expand_paths
+from offline_features import CUSTOMER_COLUMNS, TERMINAL_COLUMNS
+from window_features import HISTORY_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Columns of tx.train_data, in its order
+OUTPUT_COLUMNS = (['timestamp', 'tx_amount', 'tx_fraud', 'customer_id'] + CUSTOMER_COLUMNS
+                  + ['terminal_id'] + TERMINAL_COLUMNS)
+TRANSACTION_COLUMNS = ['TX_TS', 'CUSTOMER_ID', 'TERMINAL_ID', 'TX_AMOUNT', 'TX_FRAUD']
+DAY_SECONDS = 86400
+# Bump when the join or the output changes, so every partition is rebuilt
+BUILD_VERSION = 1
+MANIFEST_NAME = "_manifest.json"
+# Rows read at a time when fingerprinting the inputs
+CHUNK_ROWS = 100000
+
+
+def _utc(values):
+    return pd.to_datetime(values, utc=True).astype('datetime64[ns, UTC]')
+
+
+def point_in_time_join(transactions, customer_features, terminal_features, tolerance_seconds=HISTORY_SECONDS,
+                       labelled_only=True):
+    """
+    As-of join of transactions to their customer and terminal features
+    Args:
+        transactions: DataFrame of TX_TS, CUSTOMER_ID, TERMINAL_ID, TX_AMOUNT, TX_FRAUD
+        customer_features: DataFrame of feature_ts, customer_id and the customer_id_* columns
+        terminal_features: DataFrame of feature_ts, terminal_id and the terminal_id_* columns
+        tolerance_seconds: oldest feature row used, relative to TX_TS; older rows
+            leave the features NULL (NaN), like the LEFT JOINs of tx.train_data
+        labelled_only: keep only transactions with a TX_FRAUD label (tx.train_data)
+    Returns:
+        DataFrame with OUTPUT_COLUMNS, in TX_TS order
+    """
+    tx = pd.DataFrame({
+        'timestamp': _utc(transactions['TX_TS']),
+        'tx_amount': transactions['TX_AMOUNT'].astype(float),
+        'tx_fraud': pd.to_numeric(transactions['TX_FRAUD'], errors='coerce').astype('Int64')
+        if 'TX_FRAUD' in transactions.columns else pd.array([pd.NA] * len(transactions), dtype='Int64'),
+        'customer_id': transactions['CUSTOMER_ID'].astype(str),
+        'terminal_id': transactions['TERMINAL_ID'].astype(str),
+    })
+    if labelled_only:
+        tx = tx[tx['tx_fraud'].notna()]
+    tx = tx.sort_values('timestamp', kind='stable').reset_index(drop=True)
+    tolerance = pd.Timedelta(seconds=tolerance_seconds)
+
+    for features, id_column, columns in ((customer_features, 'customer_id', CUSTOMER_COLUMNS),
+                                         (terminal_features, 'terminal_id', TERMINAL_COLUMNS)):
+        right = pd.DataFrame({'feature_ts': _utc(features['feature_ts']),
+                              id_column: features[id_column].astype(str)})
+        for column in columns:
+            right[column] = features[column].to_numpy()
+        # Same-second peers share their feature values, so whichever merge_asof keeps is fine
+        right = right.sort_values('feature_ts', kind='stable')
+        tx = pd.merge_asof(tx, right, left_on='timestamp', right_on='feature_ts', by=id_column,
+                           direction='backward', allow_exact_matches=True, tolerance=tolerance)
+        tx = tx.drop(columns='feature_ts')
+    return tx[OUTPUT_COLUMNS]
+
+
+def _bound(dataset, column, value):
+    # Compare in the column's own timestamp type (tz-aware or not)
+    column_type = dataset.schema.field(column).type
+    if getattr(column_type, 'tz', None) is None:
+        value = value.tz_convert('UTC').tz_localize(None)
+    return pa.scalar(value.to_pydatetime(), type=column_type)
+
+
+def _read_range(paths, column, start, end, columns=None):
+    """Rows of the Parquet files with start <= column < end, filtered while reading"""
+    dataset = ds.dataset(paths, format='parquet')
+    condition = (ds.field(column) >= _bound(dataset, column, start)) & (ds.field(column) < _bound(dataset, column, end))
+    return dataset.to_table(columns=columns, filter=condition).to_pandas()
+
+
+def _write_atomic(frame, path):
+    tmp_path = os.path.join(os.path.dirname(path), "." + os.path.basename(path) + ".tmp")
+    frame.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def build_day(day, transaction_paths, customer_paths, terminal_paths, output_dir, labelled_only=True):
+    """
+    Join and write one day partition; runs in a worker process
+    Args:
+        day: UTC day, as days since the UNIX epoch
+    Returns:
+        (day, rows written)
+    """
+    start = pd.Timestamp(day * DAY_SECONDS, unit='s', tz='UTC')
+    end = start + pd.Timedelta(days=1)
+    lookback = start - pd.Timedelta(seconds=HISTORY_SECONDS)
+
+    transactions = _read_range(transaction_paths, 'TX_TS', start, end)
+    customer = _read_range(customer_paths, 'feature_ts', lookback, end, ['feature_ts', 'customer_id'] + CUSTOMER_COLUMNS)
+    terminal = _read_range(terminal_paths, 'feature_ts', lookback, end, ['feature_ts', 'terminal_id'] + TERMINAL_COLUMNS)
+    rows = point_in_time_join(transactions, customer, terminal, labelled_only=labelled_only)
+
+    partition = os.path.join(output_dir, f"date={day_label(day)}")
+    os.makedirs(partition, exist_ok=True)
+    _write_atomic(rows, os.path.join(partition, "part-0.parquet"))
+    return day, len(rows)
+
+
+def day_label(day):
+    return pd.Timestamp(day * DAY_SECONDS, unit='s').strftime("%Y-%m-%d")
+
+
+def day_number(label):
+    return int(pd.Timestamp(label, tz='UTC').timestamp() // DAY_SECONDS)
+
+
+def daily_hashes(paths, ts_column, columns=None, chunk_rows=CHUNK_ROWS):
+    """
+    Order-independent content hash of the rows of each UTC day, streamed
+    over the Parquet files one record batch at a time
+    Args:
+        paths: Parquet files
+        ts_column: timestamp column that assigns rows to days
+        columns: columns hashed (None hashes every column)
+    Returns:
+        dict of day (days since the UNIX epoch) -> (row count, uint64 hash)
+    """
+    totals = {}
+    for path in paths:
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows, columns=columns):
+            frame = batch.to_pandas()
+            seconds = (_utc(frame[ts_column]) - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1)
+            days = (seconds.to_numpy(dtype=np.int64) // DAY_SECONDS)
+            hashes = pd.util.hash_pandas_object(frame, index=False).to_numpy(dtype=np.uint64)
+            order = np.argsort(days, kind='stable')
+            days, hashes = days[order], hashes[order]
+            unique, starts, counts = np.unique(days, return_index=True, return_counts=True)
+            # uint64 sums wrap around, which keeps the hash independent of row order
+            sums = np.add.reduceat(hashes, starts) if len(hashes) else []
+            for day, count, total in zip(unique.tolist(), counts.tolist(), sums):
+                previous_count, previous_total = totals.get(day, (0, 0))
+                totals[day] = (previous_count + count, (previous_total + int(total)) % 2 ** 64)
+    return totals
+
+
+def partition_fingerprints(transaction_hashes, customer_hashes, terminal_hashes, days, labelled_only=True):
+    """
+    Fingerprint of everything a day partition is built from: its transactions
+    and labels, and the feature rows of the HISTORY_SECONDS before it
+    Returns:
+        dict of day -> hex digest
+    """
+    lookback_days = math.ceil(HISTORY_SECONDS / DAY_SECONDS)
+    fingerprints = {}
+    for day in days:
+        digest = hashlib.sha256(f"v{BUILD_VERSION}|{labelled_only}|{HISTORY_SECONDS}|".encode())
+        digest.update(repr(transaction_hashes.get(day)).encode())
+        for feature_day in range(day - lookback_days, day + 1):
+            digest.update(repr((customer_hashes.get(feature_day), terminal_hashes.get(feature_day))).encode())
+        fingerprints[day] = digest.hexdigest()
+    return fingerprints
+
+
+def load_manifest(output_dir):
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {'partitions': {}}
+    with open(path) as file:
+        return json.load(file)
+
+
+def save_manifest(output_dir, manifest):
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def build_training_set(transaction_paths, customer_paths, terminal_paths, output_dir, start=None, end=None,
+                       labelled_only=True, workers=None, force=False):
+    """
+    Build (or bring up to date) the day partitions of a training set
+    Args:
+        transaction_paths, customer_paths, terminal_paths: Parquet files of the inputs
+        output_dir: root of the date=YYYY-MM-DD partitions and of _manifest.json
+        start, end: first day and day after the last one ("YYYY-MM-DD", None for unbounded)
+        labelled_only: keep only labelled transactions (tx.train_data); False
+            also keeps unlabelled ones (tx.predict_data)
+        workers: worker processes (None uses every CPU, 0 builds in this process)
+        force: rebuild every partition, even unchanged ones
+    Returns:
+        dict with the partitions built, skipped and removed, and the rows written
+    """
+    started = time.perf_counter()
+    os.makedirs(output_dir, exist_ok=True)
+    transaction_hashes = daily_hashes(transaction_paths, 'TX_TS', TRANSACTION_COLUMNS)
+    customer_hashes = daily_hashes(customer_paths, 'feature_ts', ['feature_ts', 'customer_id'] + CUSTOMER_COLUMNS)
+    terminal_hashes = daily_hashes(terminal_paths, 'feature_ts', ['feature_ts', 'terminal_id'] + TERMINAL_COLUMNS)
+
+    first = day_number(start) if start else None
+    last = day_number(end) if end else None
+    days = sorted(day for day in transaction_hashes
+                  if (first is None or day >= first) and (last is None or day < last))
+    fingerprints = partition_fingerprints(transaction_hashes, customer_hashes, terminal_hashes, days, labelled_only)
+
+    manifest = load_manifest(output_dir)
+    partitions = manifest['partitions']
+    # Days in the range whose transactions are gone
+    removed = [label for label in partitions
+               if (first is None or day_number(label) >= first) and (last is None or day_number(label) < last)
+               and day_number(label) not in fingerprints]
+    for label in removed:
+        shutil.rmtree(os.path.join(output_dir, f"date={label}"), ignore_errors=True)
+        del partitions[label]
+    if removed:
+        save_manifest(output_dir, manifest)
+
+    stale = [day for day in days
+             if force or partitions.get(day_label(day), {}).get('fingerprint') != fingerprints[day]
+             or not os.path.exists(os.path.join(output_dir, f"date={day_label(day)}", "part-0.parquet"))]
+    logger.info("%d day partitions in range, %d to build, %d unchanged, %d removed",
+                len(days), len(stale), len(days) - len(stale), len(removed))
+
+    rows = 0
+
+    def record(day, count):
+        nonlocal rows
+        rows += count
+        partitions[day_label(day)] = {'fingerprint': fingerprints[day], 'rows': count}
+        # Saved after every partition, so an interrupted build resumes where it stopped
+        save_manifest(output_dir, manifest)
+        logger.info("Wrote %d rows to date=%s", count, day_label(day))
+
+    arguments = (transaction_paths, customer_paths, terminal_paths, output_dir, labelled_only)
+    if workers == 0:
+        for day in stale:
+            record(*build_day(day, *arguments))
+    elif stale:
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+            futures = [executor.submit(build_day, day, *arguments) for day in stale]
+            for future in as_completed(futures):
+                record(*future.result())
+
+    summary = {
+        'built': len(stale),
+        'skipped': len(days) - len(stale),
+        'removed': len(removed),
+        'rows': rows,
+        'seconds': round(time.perf_counter() - started, 2),
+    }
+    logger.info("Training set in %s: %s", output_dir, summary)
+    return summary
+
+
+def reference_join(transactions, customer_features, terminal_features, tolerance_seconds=HISTORY_SECONDS):
+    """
+    Row-by-row as-of lookup, to check point_in_time_join against (quadratic)
+    """
+    rows = []
+    tolerance = pd.Timedelta(seconds=tolerance_seconds)
+    tables = ((customer_features.assign(feature_ts=_utc(customer_features['feature_ts'])), 'customer_id',
+               'CUSTOMER_ID', CUSTOMER_COLUMNS),
+              (terminal_features.assign(feature_ts=_utc(terminal_features['feature_ts'])), 'terminal_id',
+               'TERMINAL_ID', TERMINAL_COLUMNS))
+    for tx in transactions.itertuples(index=False):
+        ts = pd.Timestamp(tx.TX_TS).tz_convert('UTC')
+        row = {'timestamp': ts, 'tx_amount': float(tx.TX_AMOUNT), 'tx_fraud': tx.TX_FRAUD,
+               'customer_id': str(tx.CUSTOMER_ID), 'terminal_id': str(tx.TERMINAL_ID)}
+        for features, id_column, tx_column, columns in tables:
+            candidates = features[(features[id_column] == str(getattr(tx, tx_column)))
+                                  & (features['feature_ts'] <= ts) & (features['feature_ts'] >= ts - tolerance)]
+            latest = candidates[candidates['feature_ts'] == candidates['feature_ts'].max()]
+            for column in columns:
+                row[column] = latest[column].iloc[-1] if len(latest) else np.nan
+        rows.append(row)
+    return pd.DataFrame(rows, columns=OUTPUT_COLUMNS)
+
+
+def check_join(transactions=None, sample=300, seed=0):
+    """
+    Compare point_in_time_join with reference_join on a random sample of
+    transactions, against features computed by offline_features.py; where a
+    feature row has exactly the transaction's TX_TS, that is the row the
+    equality join of tx.train_data picks as well
+    Returns:
+        list of mismatch descriptions; empty when both agree
+    """
+    from offline_features import customer_spending_features, synthetic_transactions, terminal_risk_features
+
+    if transactions is None:
+        transactions = synthetic_transactions()
+    customer = customer_spending_features(transactions)
+    terminal = terminal_risk_features(transactions)
+    # Features written a little after each transaction (as a streaming job
+    # would) must not leak into it: shift some rows past their TX_TS
+    rng = np.random.default_rng(seed)
+    shifted = rng.random(len(customer)) < 0.2
+    customer.loc[shifted, 'feature_ts'] = customer.loc[shifted, 'feature_ts'] + pd.Timedelta(seconds=5)
+
+    subset = transactions.iloc[rng.choice(len(transactions), size=min(sample, len(transactions)), replace=False)]
+    actual = point_in_time_join(subset, customer, terminal, labelled_only=False)
+    expected = reference_join(subset, customer, terminal).sort_values('timestamp', kind='stable')
+    actual = actual.sort_values(['timestamp', 'customer_id', 'terminal_id', 'tx_amount']).reset_index(drop=True)
+    expected = expected.sort_values(['timestamp', 'customer_id', 'terminal_id', 'tx_amount']).reset_index(drop=True)
+
+    mismatches = []
+    for column in OUTPUT_COLUMNS[4:]:
+        if column == 'terminal_id':
+            continue
+        left = actual[column].to_numpy(dtype=float)
+        right = expected[column].to_numpy(dtype=float)
+        bad = ~np.isclose(left, right, rtol=1e-9, atol=1e-6, equal_nan=True)
+        if bad.any():
+            mismatches.append(f"{column}: {int(bad.sum())} of {len(bad)} rows differ")
+    return mismatches
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Build a point-in-time training set partitioned by day")
+    parser.add_argument("transactions", nargs="*", help="Parquet files or directories of transactions with labels")
+    parser.add_argument("--customer-features", nargs="+", help="Parquet of the customer_spending_features view")
+    parser.add_argument("--terminal-features", nargs="+", help="Parquet of the terminal_risk_features view")
+    parser.add_argument("--output-dir", default="train_data", help="root of the date=YYYY-MM-DD partitions")
+    parser.add_argument("--start", default=None, help="first day to build (YYYY-MM-DD)")
+    parser.add_argument("--end", default=None, help="day after the last one to build (YYYY-MM-DD)")
+    parser.add_argument("--include-unlabelled", action="store_true",
+                        help="keep transactions without a label, as tx.predict_data does")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (0 builds in this process)")
+    parser.add_argument("--force", action="store_true", help="rebuild unchanged partitions too")
+    parser.add_argument("--check", action="store_true", help="check the as-of join on synthetic data")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    if args.check:
+        mismatches = check_join()
+        for mismatch in mismatches:
+            logger.error(mismatch)
+        if mismatches:
+            raise SystemExit(f"{len(mismatches)} mismatches with the row-by-row as-of lookup")
+        logger.info("As-of join matches the row-by-row lookup")
+        if not args.transactions:
+            return
+
+    if not (args.transactions and args.customer_features and args.terminal_features):
+        raise SystemExit("transactions, --customer-features and --terminal-features are required")
+
+    paths = {}
+    for name, inputs in (("transactions", args.transactions), ("customer features", args.customer_features),
+                         ("terminal features", args.terminal_features)):
+        paths[name] = [path for path in expand_paths(inputs) if path.endswith(".parquet")]
+        if not paths[name]:
+            raise SystemExit(f"No Parquet files for the {name}")
+    build_training_set(paths["transactions"], paths["customer features"], paths["terminal features"],
+                       args.output_dir, args.start, args.end, labelled_only=not args.include_unlabelled,
+                       workers=args.workers, force=args.force)
+
+
+if __name__ == "__main__":
+    main()
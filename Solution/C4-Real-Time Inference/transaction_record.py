@@ -0,0 +1,69 @@
+# Compact, parse-once representation of an ff-tx message
+import json
+
+
+class TransactionRecord:
+    """
+    One ff-tx transaction, decoded once per message with its fields already
+    typed (ids as str, TX_AMOUNT as float). __slots__ keeps it much smaller
+    than the dict json.loads returns and avoids re-converting fields on every
+    use. record['TX_ID'] style access is supported, so a record can be passed
+    wherever a transaction dict is expected (window features, feature store,
+    feature cache, query parameters)
+    """
+
+    __slots__ = ('tx_id', 'tx_ts', 'customer_id', 'terminal_id', 'tx_amount')
+
+    # Message field -> attribute
+    FIELDS = {
+        'TX_ID': 'tx_id',
+        'TX_TS': 'tx_ts',
+        'CUSTOMER_ID': 'customer_id',
+        'TERMINAL_ID': 'terminal_id',
+        'TX_AMOUNT': 'tx_amount',
+    }
+
+    def __init__(self, tx_id, tx_ts, customer_id, terminal_id, tx_amount):
+        self.tx_id = tx_id
+        self.tx_ts = tx_ts
+        self.customer_id = customer_id
+        self.terminal_id = terminal_id
+        self.tx_amount = tx_amount
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        Decode a Pub/Sub message payload
+        Args:
+            data: JSON bytes (or str) of an ff-tx message
+        Returns:
+            TransactionRecord
+        """
+        payload = json.loads(data)
+        return cls(
+            payload['TX_ID'],
+            payload['TX_TS'],
+            str(payload['CUSTOMER_ID']),
+            str(payload['TERMINAL_ID']),
+            float(payload['TX_AMOUNT']),
+        )
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, self.FIELDS[key])
+        except KeyError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key):
+        return key in self.FIELDS
+
+    def get(self, key, default=None):
+        attribute = self.FIELDS.get(key)
+        return default if attribute is None else getattr(self, attribute)
+
+    def to_dict(self):
+        """The transaction as the message dict"""
+        return {key: getattr(self, attribute) for key, attribute in self.FIELDS.items()}
+
+    def __repr__(self):
+        return f"TransactionRecord({self.to_dict()!r})"
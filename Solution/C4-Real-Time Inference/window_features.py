@@ -0,0 +1,314 @@
+# In-process sliding-window features for the online fraud processor
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+
+# Window lengths in seconds, smallest first (same RANGE bounds as the C2 views)
+WINDOW_SECONDS = OrderedDict([
+    ("15min", 900),
+    ("30min", 1800),
+    ("60min", 3600),
+    ("1day", 86400),
+    ("7day", 604800),
+    ("14day", 1209600),
+])
+
+# Fraud labels are only trusted once they are 7 days old (terminal risk delay)
+LABEL_DELAY_SECONDS = 604800
+
+# The views only look at the last 15 days of tx.tx
+HISTORY_SECONDS = 15 * 86400
+
+# Record layout shared by the customer and terminal buffers
+_TS, _AMOUNT, _LABEL = 0, 1, 2
+
+
+def to_unix_seconds(value):
+    """
+    Convert a TX_TS value to whole UNIX seconds, like UNIX_SECONDS(TX_TS)
+    Args:
+        value: datetime, number of seconds, or timestamp string as sent on ff-tx
+    Returns:
+        int: seconds since the epoch
+    """
+    if isinstance(value, (int, float)):
+        return int(value // 1)
+    if isinstance(value, str):
+        text = value.strip()
+        if text.endswith(" UTC"):
+            text = text[:-4]
+        elif text.endswith("Z"):
+            text = text[:-1]
+        value = datetime.fromisoformat(text.replace("T", " "))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp() // 1)
+
+
+class StreamingWindowFeatures:
+    """
+    Keeps the recent transactions of every customer and terminal in bounded
+    ring buffers and serves the customer_spending_features and
+    terminal_risk_features columns from memory.
+
+    Semantics follow the C2 views:
+    - windows are RANGE BETWEEN n PRECEDING AND CURRENT ROW over UNIX seconds,
+      anchored at the entity's latest transaction at or before the lookup time
+    - nb_tx counts are COUNT(TX_FRAUD), i.e. only labelled transactions
+    - avg_amount is AVG(TX_AMOUNT) over every transaction in the window
+    - terminal risk only uses labels older than LABEL_DELAY_SECONDS, and is 0
+      (NULL in the view) when the delay period holds no labelled transaction
+    - nothing older than HISTORY_SECONDS before the newest event is used
+    """
+
+    def __init__(self, max_events_per_entity=4096, max_entities=1000000,
+                 max_tracked_transactions=2000000):
+        self.max_events_per_entity = max_events_per_entity
+        self.max_entities = max_entities
+        self.max_tracked_transactions = max_tracked_transactions
+
+        self._customers = OrderedDict()
+        self._terminals = OrderedDict()
+        # TX_ID -> record, so labels arriving later can be attached
+        self._transactions = OrderedDict()
+        # Labels that arrived before their transaction
+        self._pending_labels = OrderedDict()
+        self._now = None
+        self._lock = threading.Lock()
+
+    def observe(self, transaction_data, tx_fraud=None):
+        """
+        Add a transaction to the customer and terminal windows
+        Args:
+            transaction_data: dict with TX_ID, TX_TS, CUSTOMER_ID, TERMINAL_ID, TX_AMOUNT
+            tx_fraud: fraud label if already known (0/1), else None
+        Returns:
+            bool: False if the transaction had already been observed
+        """
+        tx_id = transaction_data['TX_ID']
+        ts = to_unix_seconds(transaction_data['TX_TS'])
+
+        with self._lock:
+            if tx_id in self._transactions:
+                return False
+
+            if tx_fraud is None:
+                tx_fraud = self._pending_labels.pop(tx_id, None)
+            record = [ts, float(transaction_data['TX_AMOUNT']), tx_fraud]
+
+            self._remember(self._transactions, tx_id, record, self.max_tracked_transactions)
+            if self._now is None or ts > self._now:
+                self._now = ts
+
+            self._append(self._customers, transaction_data['CUSTOMER_ID'], record)
+            self._append(self._terminals, transaction_data['TERMINAL_ID'], record)
+            return True
+
+    def observe_label(self, tx_id, tx_fraud):
+        """
+        Attach a fraud label (from tx.txlabels / ff-txlabels) to a transaction
+        Args:
+            tx_id: transaction id
+            tx_fraud: 0 or 1
+        """
+        with self._lock:
+            record = self._transactions.get(tx_id)
+            if record is None:
+                self._remember(self._pending_labels, tx_id, tx_fraud, self.max_tracked_transactions)
+            else:
+                record[_LABEL] = tx_fraud
+
+    def load_history(self, rows):
+        """
+        Bulk-load historical transactions, e.g. the last 15 days of tx.tx
+        joined to tx.txlabels
+        Args:
+            rows: iterable of mappings with TX_ID, TX_TS, CUSTOMER_ID,
+                TERMINAL_ID, TX_AMOUNT and TX_FRAUD (may be None)
+        Returns:
+            int: number of transactions loaded
+        """
+        loaded = 0
+        for row in rows:
+            if self.observe(row, row['TX_FRAUD']):
+                loaded += 1
+        return loaded
+
+    def customer_features(self, customer_id, tx_ts):
+        """
+        Customer spending features as of tx_ts
+        Args:
+            customer_id: customer id
+            tx_ts: lookup time (anything accepted by to_unix_seconds)
+        Returns:
+            dict of customer_id_* feature columns
+        """
+        ts = to_unix_seconds(tx_ts)
+        nb_tx = [0] * len(WINDOW_SECONDS)
+        amount_sum = [0.0] * len(WINDOW_SECONDS)
+        amount_count = [0] * len(WINDOW_SECONDS)
+
+        with self._lock:
+            records = self._customers.get(customer_id)
+            anchor = self._anchor(records, ts)
+            if anchor is not None:
+                for record in reversed(records):
+                    age = anchor - record[_TS]
+                    if age < 0:
+                        continue
+                    if age > self._max_window or record[_TS] < self._horizon:
+                        break
+                    idx = self._window_index(age)
+                    amount_sum[idx] += record[_AMOUNT]
+                    amount_count[idx] += 1
+                    if record[_LABEL] is not None:
+                        nb_tx[idx] += 1
+
+        features = {}
+        total_nb_tx, total_sum, total_count = 0, 0.0, 0
+        for idx, window in enumerate(WINDOW_SECONDS):
+            total_nb_tx += nb_tx[idx]
+            total_sum += amount_sum[idx]
+            total_count += amount_count[idx]
+            features[f"customer_id_nb_tx_{window}_window"] = float(total_nb_tx)
+            features[f"customer_id_avg_amount_{window}_window"] = total_sum / total_count if total_count else 0.0
+        return features
+
+    def terminal_features(self, terminal_id, tx_ts):
+        """
+        Terminal risk features as of tx_ts
+        Args:
+            terminal_id: terminal id
+            tx_ts: lookup time (anything accepted by to_unix_seconds)
+        Returns:
+            dict of terminal_id_* feature columns
+        """
+        ts = to_unix_seconds(tx_ts)
+        nb_tx = [0] * len(WINDOW_SECONDS)
+        nb_fraud = [0] * len(WINDOW_SECONDS)
+        nb_tx_delay = 0
+
+        with self._lock:
+            records = self._terminals.get(terminal_id)
+            anchor = self._anchor(records, ts)
+            if anchor is not None:
+                for record in reversed(records):
+                    age = anchor - record[_TS]
+                    # Rows in the delay period are subtracted out by the view
+                    if age <= LABEL_DELAY_SECONDS:
+                        if age >= 0 and record[_LABEL] is not None:
+                            nb_tx_delay += 1
+                        continue
+                    if age > self._max_window + LABEL_DELAY_SECONDS or record[_TS] < self._horizon:
+                        break
+                    if record[_LABEL] is None:
+                        continue
+                    idx = self._window_index(age - LABEL_DELAY_SECONDS)
+                    nb_tx[idx] += 1
+                    nb_fraud[idx] += record[_LABEL]
+
+        features = {}
+        total_nb_tx, total_nb_fraud = 0, 0
+        for idx, window in enumerate(WINDOW_SECONDS):
+            total_nb_tx += nb_tx[idx]
+            total_nb_fraud += nb_fraud[idx]
+            features[f"terminal_id_nb_tx_{window}_window"] = float(total_nb_tx)
+            # SUM(TX_FRAUD) over a delay period without labels is NULL, and so is
+            # every risk of the view; the online query COALESCEs that to 0
+            features[f"terminal_id_risk_{window}_window"] = (
+                total_nb_fraud / (total_nb_tx + 0.0001) if nb_tx_delay else 0.0)
+        return features
+
+    def get_features(self, transaction_data):
+        """
+        Observe the transaction, then return its full feature vector. The
+        transaction itself falls inside its own windows, as it does in the
+        training data
+        Args:
+            transaction_data: dict containing transaction information
+        Returns:
+            dict of features ready to send to the model
+        """
+        self.observe(transaction_data)
+        features = {'tx_amount': float(transaction_data['TX_AMOUNT'])}
+        features.update(self.customer_features(transaction_data['CUSTOMER_ID'], transaction_data['TX_TS']))
+        features.update(self.terminal_features(transaction_data['TERMINAL_ID'], transaction_data['TX_TS']))
+        return features
+
+    def get_features_batch(self, transactions):
+        """
+        Feature vectors for several transactions, in input order
+        Args:
+            transactions: list of dicts containing transaction information
+        Returns:
+            list of feature dicts
+        """
+        return [self.get_features(transaction_data) for transaction_data in transactions]
+
+    def stats(self):
+        """Sizes of the in-memory state"""
+        with self._lock:
+            return {
+                'customers': len(self._customers),
+                'terminals': len(self._terminals),
+                'transactions': len(self._transactions),
+                'pending_labels': len(self._pending_labels),
+            }
+
+    @property
+    def _max_window(self):
+        return WINDOW_SECONDS["14day"]
+
+    @property
+    def _horizon(self):
+        return self._now - HISTORY_SECONDS
+
+    @staticmethod
+    def _window_index(age):
+        for idx, seconds in enumerate(WINDOW_SECONDS.values()):
+            if age <= seconds:
+                return idx
+        raise ValueError(f"Age {age}s is outside every window")
+
+    def _anchor(self, records, ts):
+        """Timestamp of the latest record at or before ts, within the history horizon"""
+        if not records:
+            return None
+        for record in reversed(records):
+            if record[_TS] <= ts:
+                return record[_TS] if record[_TS] >= self._horizon else None
+        return None
+
+    def _append(self, entities, entity_id, record):
+        records = entities.get(entity_id)
+        if records is None:
+            records = deque(maxlen=self.max_events_per_entity)
+            self._remember(entities, entity_id, records, self.max_entities)
+        else:
+            entities.move_to_end(entity_id)
+
+        # Drop events that fell out of the history horizon
+        horizon = self._horizon
+        while records and records[0][_TS] < horizon:
+            records.popleft()
+
+        if not records or records[-1][_TS] <= record[_TS]:
+            records.append(record)
+            return
+
+        # Out-of-order arrival: keep the buffer sorted by timestamp
+        if len(records) == records.maxlen:
+            if record[_TS] < records[0][_TS]:
+                return
+            records.popleft()
+        position = len(records)
+        while position > 0 and records[position - 1][_TS] > record[_TS]:
+            position -= 1
+        records.insert(position, record)
+
+    @staticmethod
+    def _remember(mapping, key, value, max_size):
+        mapping[key] = value
+        mapping.move_to_end(key)
+        while len(mapping) > max_size:
+            mapping.popitem(last=False)
@@ -1,7 +1,88 @@
+import hashlib
+import json
+import os
 import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from typing import Union
 import pandas as pd
 
+# Tasks (table copies, blob copies) allowed to run at the same time
+MAX_CONCURRENT_TASKS = 8
+
+class TaskGraph:
+    """
+    Runs named tasks in a thread pool as soon as the tasks they depend on have
+    finished, with at most max_workers running at once. The first failure stops
+    the run: queued tasks are cancelled, running ones are waited for, and the
+    exception is re-raised
+    """
+
+    def __init__(self, max_workers=MAX_CONCURRENT_TASKS):
+        self.max_workers = max_workers
+        self.tasks = {}
+        self.timings = {}
+
+    def add(self, name, func, *args, depends_on=(), **kwargs):
+        """
+        Args:
+            name: unique task name, used in depends_on of other tasks
+            func, args, kwargs: the call to run
+            depends_on: names of tasks that must finish first
+        Returns:
+            name
+        """
+        if name in self.tasks:
+            raise ValueError(f"Duplicate task {name}")
+        self.tasks[name] = (func, args, kwargs, tuple(depends_on))
+        return name
+
+    def run(self):
+        """
+        Run every task
+        Returns:
+            dict of task name -> seconds it took
+        """
+        for name, (_, _, _, depends_on) in self.tasks.items():
+            unknown = [dependency for dependency in depends_on if dependency not in self.tasks]
+            if unknown:
+                raise ValueError(f"Task {name} depends on unknown tasks {unknown}")
+
+        done = set()
+        running = {}
+        pending = dict(self.tasks)
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                ready = [name for name, task in pending.items() if all(dep in done for dep in task[3])]
+                if not ready and not running:
+                    raise ValueError(f"Dependency cycle between tasks {sorted(pending)}")
+                for name in ready:
+                    func, args, kwargs, _ = pending.pop(name)
+                    running[executor.submit(self._timed, name, func, *args, **kwargs)] = name
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    error = future.exception()
+                    if error is not None:
+                        print(f"Task {name} failed: {error}")
+                        for other in running:
+                            other.cancel()
+                        raise error
+                    done.add(name)
+
+        print(f"All {len(done)} tasks done in {time.monotonic() - start:.1f}s")
+        return self.timings
+
+    def _timed(self, name, func, *args, **kwargs):
+        task_start = time.monotonic()
+        result = func(*args, **kwargs)
+        self.timings[name] = time.monotonic() - task_start
+        print(f"Task {name} done in {self.timings[name]:.1f}s")
+        return result
+
 def get_project_id():
     import urllib.request
     url = "http://metadata.google.internal/computeMetadata/v1/project/project-id"
@@ -22,30 +103,172 @@ def get_project_id():
 
     return project_id
 
-def run_bq_query(sql: str) -> Union[str, pd.DataFrame]:
+class BigQueryExecutor:
     """
-    Input: SQL query, as a string, to execute in BigQuery
-    Returns the query results as a pandas DataFrame, or error, if any
+    Runs queries on one shared BigQuery client.
+    - dry_run: validate every query with a dry run first (one extra round trip)
+    - cache_dir: keep the results of read queries as Arrow IPC files named by
+      the SHA-256 of the project and SQL, and serve repeated queries from them
+      without going back to BigQuery (or needing credentials). DDL and DML are
+      never cached. Needs project, since the cache key cannot wait for a client
+    - cache_ttl_seconds: ignore cached results older than this (None keeps them)
     """
-    
-    from google.cloud import bigquery
-    
-    bq_client = bigquery.Client()
-    
-    # Try dry run before executing query to catch any errors
-    job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
-    bq_client.query(sql, job_config=job_config)
 
-    # If dry run succeeds without errors, proceed to run query
-    job_config = bigquery.QueryJobConfig()
-    client_result = bq_client.query(sql, job_config=job_config)
+    def __init__(self, project=None, dry_run=False, cache_dir=None, cache_ttl_seconds=None):
+        self.project = project
+        self.dry_run = dry_run
+        self.cache_dir = cache_dir
+        self.cache_ttl_seconds = cache_ttl_seconds
+        self._client = None
+        self._read_client = None
+        self._client_lock = threading.Lock()
+        if cache_dir:
+            if not project:
+                raise ValueError("BigQueryExecutor needs a project to cache query results")
+            os.makedirs(cache_dir, exist_ok=True)
 
-    job_id = client_result.job_id
+    @property
+    def client(self):
+        with self._client_lock:
+            if self._client is None:
+                from google.cloud import bigquery
+                self._client = bigquery.Client(project=self.project)
+            return self._client
 
-    # Wait for query/job to finish running. then get & return data frame
-    df = client_result.result().to_arrow().to_pandas()
-    
-    return df
+    @property
+    def read_client(self):
+        """BigQuery Storage Read API client, used to stream large results"""
+        with self._client_lock:
+            if self._read_client is None:
+                from google.cloud import bigquery_storage
+                self._read_client = bigquery_storage.BigQueryReadClient()
+            return self._read_client
+
+    def cache_path(self, sql):
+        # self.project, not self.client.project: a cache hit must not create a client
+        key = hashlib.sha256(f"{self.project}\n{sql.strip()}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.arrow")
+
+    def run(self, sql: str, dry_run=None, use_cache=True, job_config=None) -> pd.DataFrame:
+        """
+        Input: SQL query, as a string, to execute in BigQuery, and optionally a
+        QueryJobConfig (e.g. with a destination table)
+        Returns the query results as a pandas DataFrame (empty for DDL, DML and
+        queries written to a destination table), or raises the query's error
+        """
+        import pyarrow as pa
+        from google.cloud import bigquery
+
+        writes_table = job_config is not None and job_config.destination is not None
+        # The cache key is the SQL alone, so parameterized queries are not cached
+        cache_path = self.cache_path(sql) if self.cache_dir and use_cache and job_config is None else None
+        if cache_path is not None:
+            table = self._read_cache(cache_path)
+            if table is not None:
+                return table.to_pandas()
+
+        if self.dry_run if dry_run is None else dry_run:
+            # Catch errors before running the query
+            self.client.query(sql, job_config=bigquery.QueryJobConfig(dry_run=True, use_query_cache=False))
+
+        query_job = self.client.query(sql, job_config=job_config)
+        rows = query_job.result()
+        if query_job.statement_type != "SELECT" or writes_table:
+            # DDL/DML or a table write: nothing worth downloading
+            return pd.DataFrame()
+
+        table = rows.to_arrow()
+        if cache_path is not None:
+            # Write then rename, so readers never see a partial file
+            temp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with pa.OSFile(temp_path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+            os.replace(temp_path, cache_path)
+        return table.to_pandas()
+
+    def iter_batches(self, sql=None, table=None, job_config=None, max_queue_size=1):
+        """
+        Yield the rows of a query (sql) or a whole table (table, e.g.
+        "project.tx.train_data") as pyarrow RecordBatches streamed from the
+        BigQuery Storage Read API. Only max_queue_size batches are buffered
+        ahead of the consumer, so memory stays bounded however large the result
+        """
+        if (sql is None) == (table is None):
+            raise ValueError("Pass exactly one of sql and table")
+        if sql is not None:
+            rows = self.client.query(sql, job_config=job_config).result()
+        else:
+            rows = self.client.list_rows(table)
+        yield from rows.to_arrow_iterable(bqstorage_client=self.read_client, max_queue_size=max_queue_size)
+
+    def export_parquet(self, path, sql=None, table=None, job_config=None, compression="snappy"):
+        """
+        Write a query result or table to a local Parquet file one record batch
+        at a time (see iter_batches)
+        Returns the number of rows written
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        rows = 0
+        writer = None
+        temp_path = f"{path}.tmp"
+        try:
+            for batch in self.iter_batches(sql, table, job_config):
+                if writer is None:
+                    writer = pq.ParquetWriter(temp_path, batch.schema, compression=compression)
+                writer.write_batch(batch)
+                rows += batch.num_rows
+            if writer is None:
+                # No batches at all: still leave a (schema-less) file behind
+                pq.write_table(pa.table({}), temp_path)
+        except BaseException:
+            if writer is not None:
+                writer.close()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        if writer is not None:
+            writer.close()
+        os.replace(temp_path, path)
+        print(f"Exported {rows} rows to {path}")
+        return rows
+
+    def _read_cache(self, cache_path):
+        import pyarrow as pa
+
+        try:
+            if self.cache_ttl_seconds is not None and time.time() - os.path.getmtime(cache_path) > self.cache_ttl_seconds:
+                return None
+            with pa.memory_map(cache_path, "r") as source:
+                return pa.ipc.open_file(source).read_all()
+        except FileNotFoundError:
+            return None
+
+_default_executor = None
+_default_executor_lock = threading.Lock()
+
+def default_executor():
+    """
+    Executor shared by run_bq_query, on the $GOOGLE_CLOUD_PROJECT project (the
+    client's default project if unset); results are cached in
+    $BQ_QUERY_CACHE_DIR if that is set, which needs $GOOGLE_CLOUD_PROJECT
+    """
+    global _default_executor
+    with _default_executor_lock:
+        if _default_executor is None:
+            _default_executor = BigQueryExecutor(
+                project=os.environ.get("GOOGLE_CLOUD_PROJECT") or None,
+                cache_dir=os.environ.get("BQ_QUERY_CACHE_DIR") or None
+            )
+        return _default_executor
+
+def run_bq_query(sql: str, dry_run: bool = False) -> Union[str, pd.DataFrame]:
+    """
+    Input: SQL query, as a string, to execute in BigQuery
+    Returns the query results as a pandas DataFrame, or error, if any
+    """
+    return default_executor().run(sql, dry_run=dry_run)
 
 def copy_blob(
     bucket_name, blob_name, destination_bucket_name, destination_blob_name
@@ -73,64 +296,68 @@ def copy_blob(
     print(f"File copied from gs://{source_bucket.name}/{source_blob.name} \n\t\t to gs://{destination_bucket.name}/{blob_copy.name}")
 
 
-def get_batch_data_gcs(BUCKET_NAME):
+DATAGEN_BLOBS = [
+    "datagen/hacked_customers_history.txt",
+    "datagen/hacked_terminals_history.txt",
+    "datagen/demographics/customer_profiles.csv",
+    "datagen/demographics/terminal_profiles.csv",
+    "datagen/demographics/customer_with_terminal_profiles.csv",
+]
+
+def get_batch_data_gcs(BUCKET_NAME, graph=None):
     '''
-    Copy necessary files for datagen streaming
+    Copy necessary files for datagen streaming. The copies are added to graph
+    (a TaskGraph) if given, otherwise they run here concurrently
     '''
-    copy_blob(
-        bucket_name="cymbal-fraudfinder",
-        blob_name="datagen/hacked_customers_history.txt",
-        destination_bucket_name=BUCKET_NAME,
-        destination_blob_name="datagen/hacked_customers_history.txt"
-    )
-
-    copy_blob(
-        bucket_name="cymbal-fraudfinder",
-        blob_name="datagen/hacked_terminals_history.txt",
-        destination_bucket_name=BUCKET_NAME,
-        destination_blob_name="datagen/hacked_terminals_history.txt"
-    )
-    copy_blob(
-        bucket_name="cymbal-fraudfinder",
-        blob_name="datagen/demographics/customer_profiles.csv",
-        destination_bucket_name=BUCKET_NAME,
-        destination_blob_name="datagen/demographics/customer_profiles.csv"
-    )
+    run_now = graph is None
+    if run_now:
+        graph = TaskGraph()
 
-    copy_blob(
-        bucket_name="cymbal-fraudfinder",
-        blob_name="datagen/demographics/terminal_profiles.csv",
-        destination_bucket_name=BUCKET_NAME,
-        destination_blob_name="datagen/demographics/terminal_profiles.csv"
-    )
-
-    copy_blob(
-        bucket_name="cymbal-fraudfinder",
-        blob_name="datagen/demographics/customer_with_terminal_profiles.csv",
-        destination_bucket_name=BUCKET_NAME,
-        destination_blob_name="datagen/demographics/customer_with_terminal_profiles.csv"
-    )
+    for blob_name in DATAGEN_BLOBS:
+        graph.add(
+            f"gs://{BUCKET_NAME}/{blob_name}",
+            copy_blob,
+            bucket_name="cymbal-fraudfinder",
+            blob_name=blob_name,
+            destination_bucket_name=BUCKET_NAME,
+            destination_blob_name=blob_name
+        )
 
+    if run_now:
+        graph.run()
     return "Done get_batch_data_gcs"
 
-def get_batch_data_bq(PROJECT):
-    '''
-    Creates the following tables in your project by copying from public tables:
+# Where copy_tx_incremental records the last copied TX_TS date, per project
+CHECKPOINT_PATH = os.path.join(os.path.expanduser("~"), ".cache", "fraudfinder", "copy_checkpoint.json")
 
-    {YOUR PROJECT}
-    |-`tx` (dataset)
-    |-`tx` (table: transactions without labels)
-    |-`txlabels` (table: transactions with fraud labels (1 or 0))
-    |-demographics
-    |-`customers` (table: profiles of customers)
-    |-`terminals` (table: profiles of terminals)
-    |-`customersterminals` (table: profiles of customers and terminals within their radius)
-    '''
+def read_checkpoint(path, PROJECT):
+    """Last fully copied partition date (YYYY-MM-DD) of PROJECT, or None"""
+    try:
+        with open(path) as f:
+            return json.load(f).get(PROJECT)
+    except FileNotFoundError:
+        return None
 
-    run_bq_query(f"CREATE SCHEMA IF NOT EXISTS `{PROJECT}`.tx OPTIONS(location='us-central1');")
-    run_bq_query(f"CREATE SCHEMA IF NOT EXISTS `{PROJECT}`.demographics OPTIONS(location='us-central1');")
+def write_checkpoint(path, PROJECT, day):
+    try:
+        with open(path) as f:
+            checkpoints = json.load(f)
+    except FileNotFoundError:
+        checkpoints = {}
+    checkpoints[PROJECT] = day
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # Write then rename, so an interrupted run never leaves a broken checkpoint
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(checkpoints, f, indent=2)
+    os.replace(temp_path, path)
 
-    run_bq_query(f"""
+# Source of tx.tx and tx.txlabels
+SOURCE_TABLE = "cymbal-fraudfinder.txbackup.all"
+
+def tx_copy_sql(PROJECT):
+    """Full copy of tx.tx, partitioned on DATE(TX_TS)"""
+    return f"""
     CREATE OR REPLACE TABLE `{PROJECT}`.tx.tx 
     PARTITION BY
     DATE(TX_TS)
@@ -144,10 +371,11 @@ def get_batch_data_bq(PROJECT):
         FROM
         `cymbal-fraudfinder`.txbackup.all
     );
-    """)
-    print(f"BigQuery table created: `{PROJECT}`.tx.tx")
+    """
 
-    run_bq_query(f"""
+def txlabels_copy_sql(PROJECT):
+    """Full copy of tx.txlabels"""
+    return f"""
     CREATE OR REPLACE TABLE `{PROJECT}`.tx.txlabels
     AS (
         SELECT
@@ -156,46 +384,188 @@ def get_batch_data_bq(PROJECT):
         FROM
         `cymbal-fraudfinder`.txbackup.all
     );
-    """)
-    print(f"BigQuery table created: `{PROJECT}`.tx.txlabels")
-    
-    run_bq_query(f"""
-    CREATE OR REPLACE TABLE `{PROJECT}`.demographics.customers
+    """
+
+def partitioned_on_tx_date(table):
+    """True if a bigquery.Table is partitioned by day on TX_TS, so DATE(TX_TS) = @day prunes it"""
+    partitioning = table.time_partitioning
+    return partitioning is not None and partitioning.field == "TX_TS" and partitioning.type_ == "DAY"
+
+def copy_tx_incremental(PROJECT, checkpoint_path=CHECKPOINT_PATH, executor=None):
+    '''
+    Copy tx.tx and tx.txlabels one DATE(TX_TS) partition at a time, starting at
+    the partition recorded in the checkpoint (all of them on the first run).
+    Each tx.tx partition is overwritten through its partition decorator
+    (tx.tx$YYYYMMDD, WRITE_TRUNCATE) and its labels are MERGEd into
+    tx.txlabels, so re-copying a partition is harmless. The checkpoint moves
+    forward after every partition: an interrupted run resumes where it stopped,
+    and the last partition is copied again in case it was still filling up.
+
+    Per-day queries are only cheap if the source is partitioned on
+    DATE(TX_TS); otherwise each of them would scan the whole source, so both
+    tables are copied in full instead (one scan each)
+    '''
+    from google.cloud import bigquery
+
+    executor = executor or default_executor()
+
+    if not partitioned_on_tx_date(executor.client.get_table(SOURCE_TABLE)):
+        print(f"{SOURCE_TABLE} is not partitioned on DATE(TX_TS); copying `{PROJECT}`.tx.tx in full")
+        executor.run(tx_copy_sql(PROJECT))
+        executor.run(txlabels_copy_sql(PROJECT))
+        return
+
+    # Empty tables with the source schema; tx.tx keeps its DATE(TX_TS) partitioning
+    executor.run(f"""
+    CREATE TABLE IF NOT EXISTS `{PROJECT}`.tx.tx
+    PARTITION BY
+    DATE(TX_TS)
     AS (
         SELECT
-        *
+        TX_ID,
+        TX_TS,
+        CUSTOMER_ID,
+        TERMINAL_ID,
+        TX_AMOUNT
         FROM
-        `cymbal-fraudfinder`.demographics.customers
+        `cymbal-fraudfinder`.txbackup.all
+        WHERE FALSE
     );
     """)
-    print(f"BigQuery table created: `{PROJECT}`.demographics.customers")
-    
-    run_bq_query(f"""
-    CREATE OR REPLACE TABLE `{PROJECT}`.demographics.terminals
+    executor.run(f"""
+    CREATE TABLE IF NOT EXISTS `{PROJECT}`.tx.txlabels
     AS (
         SELECT
-        *
+        TX_ID,
+        TX_FRAUD
         FROM
-        `cymbal-fraudfinder`.demographics.terminals
+        `cymbal-fraudfinder`.txbackup.all
+        WHERE FALSE
     );
     """)
-    print(f"BigQuery table created: `{PROJECT}`.demographics.terminals")
-    
-    run_bq_query(f"""
-    CREATE OR REPLACE TABLE `{PROJECT}`.demographics.customersterminals
+
+    watermark = read_checkpoint(checkpoint_path, PROJECT)
+    days = executor.run("""
+    SELECT DISTINCT
+        DATE(TX_TS) AS day
+    FROM
+        `cymbal-fraudfinder`.txbackup.all
+    WHERE
+        DATE(TX_TS) >= @watermark
+    ORDER BY
+        day
+    """, job_config=bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("watermark", "DATE", watermark or "0001-01-01")
+    ]))['day']
+    print(f"Copying {len(days)} partitions of `{PROJECT}`.tx.tx starting at {watermark or 'the first one'}")
+
+    for day in days:
+        day = pd.Timestamp(day).strftime("%Y-%m-%d")
+        day_parameter = bigquery.ScalarQueryParameter("day", "DATE", day)
+        executor.run("""
+        SELECT
+        TX_ID,
+        TX_TS,
+        CUSTOMER_ID,
+        TERMINAL_ID,
+        TX_AMOUNT
+        FROM
+        `cymbal-fraudfinder`.txbackup.all
+        WHERE
+        DATE(TX_TS) = @day
+        """, job_config=bigquery.QueryJobConfig(
+            destination=f"{PROJECT}.tx.tx${day.replace('-', '')}",
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+            query_parameters=[day_parameter]
+        ))
+        executor.run(f"""
+        MERGE `{PROJECT}`.tx.txlabels T
+        USING (
+            SELECT
+            TX_ID,
+            TX_FRAUD
+            FROM
+            `cymbal-fraudfinder`.txbackup.all
+            WHERE
+            DATE(TX_TS) = @day
+        ) S
+        ON T.TX_ID = S.TX_ID
+        WHEN MATCHED THEN
+            UPDATE SET TX_FRAUD = S.TX_FRAUD
+        WHEN NOT MATCHED THEN
+            INSERT (TX_ID, TX_FRAUD) VALUES (S.TX_ID, S.TX_FRAUD)
+        """, job_config=bigquery.QueryJobConfig(query_parameters=[day_parameter]))
+        write_checkpoint(checkpoint_path, PROJECT, day)
+        print(f"Copied partition {day} of `{PROJECT}`.tx.tx and its labels")
+
+def create_table(sql, table_name):
+    run_bq_query(sql)
+    print(f"BigQuery table created: {table_name}")
+
+def get_batch_data_bq(PROJECT, graph=None, incremental=False):
+    '''
+    Creates the following tables in your project by copying from public tables:
+
+    {YOUR PROJECT}
+    |-`tx` (dataset)
+    |-`tx` (table: transactions without labels)
+    |-`txlabels` (table: transactions with fraud labels (1 or 0))
+    |-demographics
+    |-`customers` (table: profiles of customers)
+    |-`terminals` (table: profiles of terminals)
+    |-`customersterminals` (table: profiles of customers and terminals within their radius)
+
+    The copies are added to graph (a TaskGraph) if given, otherwise they run here.
+    With incremental=True, tx.tx and tx.txlabels only get the partitions newer
+    than the last run (see copy_tx_incremental)
+    '''
+
+    run_now = graph is None
+    if run_now:
+        graph = TaskGraph()
+
+    # Schemas first, then every table copy at once
+    tx_schema = graph.add(
+        "schema tx", run_bq_query,
+        f"CREATE SCHEMA IF NOT EXISTS `{PROJECT}`.tx OPTIONS(location='us-central1');"
+    )
+    demographics_schema = graph.add(
+        "schema demographics", run_bq_query,
+        f"CREATE SCHEMA IF NOT EXISTS `{PROJECT}`.demographics OPTIONS(location='us-central1');"
+    )
+
+    if incremental:
+        graph.add(f"{PROJECT}.tx.tx", copy_tx_incremental, PROJECT, depends_on=[tx_schema])
+    else:
+        graph.add(f"{PROJECT}.tx.tx", create_table, tx_copy_sql(PROJECT), f"`{PROJECT}`.tx.tx",
+                  depends_on=[tx_schema])
+        graph.add(f"{PROJECT}.tx.txlabels", create_table, txlabels_copy_sql(PROJECT), f"`{PROJECT}`.tx.txlabels",
+                  depends_on=[tx_schema])
+
+    for table in ["customers", "terminals", "customersterminals"]:
+        graph.add(f"{PROJECT}.demographics.{table}", create_table, f"""
+    CREATE OR REPLACE TABLE `{PROJECT}`.demographics.{table}
     AS (
         SELECT
         *
         FROM
-        `cymbal-fraudfinder`.demographics.customersterminals
+        `cymbal-fraudfinder`.demographics.{table}
     );
-    """)
-    print(f"BigQuery table created: `{PROJECT}`.demographics.customersterminals")
-    
+    """, f"`{PROJECT}`.demographics.{table}", depends_on=[demographics_schema])
+
+    if run_now:
+        graph.run()
     return "Done get_batch_data_bq"
 
 if __name__ == "__main__":
     PROJECT = get_project_id()
+    # Queries run on (and cached for) this project
+    os.environ.setdefault("GOOGLE_CLOUD_PROJECT", PROJECT)
     BUCKET_NAME = sys.argv[1]
-    get_batch_data_gcs(BUCKET_NAME)
-    get_batch_data_bq(PROJECT)
\ No newline at end of file
+    # --incremental: only copy the tx.tx partitions added since the last run
+    INCREMENTAL = "--incremental" in sys.argv[2:]
+    # Blob copies run alongside the table copies
+    graph = TaskGraph()
+    get_batch_data_gcs(BUCKET_NAME, graph)
+    get_batch_data_bq(PROJECT, graph, incremental=INCREMENTAL)
+    graph.run()
\ No newline at end of file